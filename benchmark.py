@@ -0,0 +1,395 @@
+"""
+Benchmark del percorso webhook e delle funzioni DB.
+
+    python benchmark.py e2e --events 2000 --concurrency 50 --mix started=1,reply=4,completed=1
+    python benchmark.py db --sizes 1000,10000,100000
+    python benchmark.py all --json bench.json
+
+L'app aiohttp gira su un DB temporaneo, con un registro di thread Discord finti
+e un server UEX locale al posto delle API reali. Nessun token Discord necessario.
+"""
+import os
+import re
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+import tempfile
+import statistics
+
+# Il DB temporaneo e il log vanno impostati prima di importare config/main
+_workdir = tempfile.mkdtemp(prefix="uex-bench-")
+os.environ["DB_PATH"] = os.path.join(_workdir, "db", "bench.db")
+os.environ.setdefault("LOG_PATH", os.path.join(_workdir, "bench.log"))
+# Pochi utenti finti mandano molti più webhook al secondo di un utente reale: il limite per user_id
+# va escluso dalla misura (impostare le variabili per misurarlo, i 429 sono riportati a parte)
+os.environ.setdefault("WEBHOOK_USER_RATE", "1000000")
+os.environ.setdefault("WEBHOOK_USER_BURST", "1000000")
+
+import aiohttp
+from aiohttp import web
+
+import directory
+import storage
+import inbox
+import reply_outbox
+import main
+import ingress
+from uex_client import client as uex
+
+
+# ---------- Statistiche ----------
+def percentiles(samples: list[float]) -> dict:
+    if not samples:
+        return {"count": 0}
+    ordered = sorted(samples)
+
+    def pick(q):
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+    return {
+        "count": len(ordered),
+        "mean_ms": round(statistics.fmean(ordered) * 1000, 3),
+        "p50_ms": round(pick(0.50) * 1000, 3),
+        "p95_ms": round(pick(0.95) * 1000, 3),
+        "p99_ms": round(pick(0.99) * 1000, 3),
+        "max_ms": round(ordered[-1] * 1000, 3),
+    }
+
+
+# ---------- Discord finto ----------
+class FakeThread:
+    """Thread Discord finto: registra l'istante di arrivo di ogni embed."""
+
+    def __init__(self, thread_id: int, registry: "FakeDiscord"):
+        self.id = thread_id
+        self.name = f"Chat bench {thread_id}"
+        self._registry = registry
+
+    async def send(self, content=None, *, embed=None, embeds=None):
+        await asyncio.sleep(self._registry.latency)
+        self._registry.messages += 1
+        now = time.perf_counter()
+        for item in embeds or ([embed] if embed else []):
+            match = re.search(r"bench-(\d+)", item.description or "")
+            if match:
+                self._registry.delivered[int(match.group(1))] = now
+        return FakeMessage(self._registry.messages)
+
+
+class FakeMessage:
+    def __init__(self, message_id: int):
+        self.id = message_id
+
+
+class FakeDiscord:
+    def __init__(self, latency: float):
+        self.latency = latency
+        self.threads: dict[int, FakeThread] = {}
+        self.delivered: dict[int, float] = {}
+        self.messages = 0
+
+    def add_thread(self, thread_id: int) -> FakeThread:
+        thread = self.threads[thread_id] = FakeThread(thread_id, self)
+        return thread
+
+    def get_channel(self, channel_id):
+        return self.threads.get(int(channel_id))
+
+
+async def _ready():
+    return None
+
+
+# ---------- UEX finto ----------
+async def start_fake_uex(port: int, latency: float) -> web.AppRunner:
+    async def user(request):
+        await asyncio.sleep(latency)
+        return web.json_response({"data": {"username": "bench"}})
+
+    async def message(request):
+        await asyncio.sleep(latency)
+        return web.json_response({"status": "ok"})
+
+    async def notifications(request):
+        await asyncio.sleep(latency)
+        return web.json_response({"data": []})
+
+    app = web.Application()
+    app.router.add_get("/user/", user)
+    app.router.add_post("/marketplace_negotiations_messages/", message)
+    app.router.add_get("/user_notifications/", notifications)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, "127.0.0.1", port).start()
+
+    base = f"http://127.0.0.1:{port}"
+    directory.API_GET_USER = f"{base}/user/"
+    directory.API_POST_MESSAGE = f"{base}/marketplace_negotiations_messages/"
+    directory.API_NOTIFICATIONS = f"{base}/user_notifications/"
+    return runner
+
+
+# ---------- Benchmark end-to-end ----------
+def parse_mix(mix: str) -> list[tuple[str, int]]:
+    weights = []
+    for part in mix.split(","):
+        name, _, weight = part.partition("=")
+        weights.append((name.strip(), int(weight or 1)))
+    return weights
+
+async def seed_users(discord_registry: FakeDiscord, users: int):
+    for n in range(users):
+        thread_id = 10_000 + n
+        discord_registry.add_thread(thread_id)
+        await storage.save_user_session(str(n), {
+            "thread_id": thread_id, "username": f"user{n}",
+            "bearer_token": "bench", "secret_key": "bench",
+        }, durable=False)
+    await storage.flush_writes()
+
+def build_event(seq: int, kind: str, users: int, reply_hashes: list[str]) -> tuple[str, str, dict]:
+    seller = random.randrange(users)
+    buyer = (seller + 1 + random.randrange(users - 1)) % users if users > 1 else seller
+    token = f"bench-{seq}"
+    if kind == "started":
+        return "negotiation_started", str(seller), {
+            "negotiation_hash": f"started-{seq}", "listing_owner_username": f"user{seller}",
+            "client_username": f"user{buyer}", "listing_title": token,
+        }
+    if kind == "reply":
+        negotiation_hash = random.choice(reply_hashes)
+        link = storage.routing_index.link(negotiation_hash)
+        seller_name, buyer_name = link["seller_id"], link["buyer_id"]
+        author = random.choice((seller_name, buyer_name))
+        return "user_reply", seller_name.removeprefix("user"), {
+            "negotiation_hash": negotiation_hash, "listing_owner_username": seller_name,
+            "client_username": author, "message": f"msg {seq}", "listing_title": token,
+        }
+    if kind == "completed":
+        event_type = random.choice(("negotiation_completed_client", "negotiation_completed_advertiser"))
+        return event_type, str(seller), {
+            "negotiation_hash": f"completed-{seq}", "client_username": f"user{buyer}",
+            "listing_title": token, "rating_stars": 5,
+        }
+    raise ValueError(f"tipo evento sconosciuto nel mix: {kind}")
+
+async def run_e2e(args) -> dict:
+    discord_registry = FakeDiscord(args.discord_latency / 1000)
+    main.bot.get_channel = discord_registry.get_channel
+    main.bot.wait_until_ready = _ready
+
+    await storage.open_db()
+    await storage.warm_routing_index()
+    uex_runner = await start_fake_uex(args.uex_port, args.uex_latency / 1000)
+    await uex.start()
+    await inbox.start(main.dispatch_webhook)
+
+    replies_sent: dict[str, float] = {}
+
+    async def notify(item, state, detail):
+        if state == "sent":
+            replies_sent[item["reply_id"]] = time.perf_counter()
+
+    await reply_outbox.start(notify)
+
+    runner = web.AppRunner(ingress.create_app())
+    await runner.setup()
+    await web.TCPSite(runner, "127.0.0.1", args.port).start()
+
+    await seed_users(discord_registry, args.users)
+    reply_hashes = []
+    for n in range(max(1, args.users // 2)):
+        negotiation_hash = f"reply-{n}"
+        await storage.save_negotiation_link(negotiation_hash, f"user{(2 * n + 1) % args.users}", f"user{2 * n % args.users}", durable=False)
+        reply_hashes.append(negotiation_hash)
+    await storage.flush_writes()
+
+    mix = parse_mix(args.mix)
+    kinds = [name for name, _ in mix]
+    weights = [weight for _, weight in mix]
+    events = [build_event(seq, random.choices(kinds, weights)[0], args.users, reply_hashes) for seq in range(args.events)]
+
+    sent_at: dict[int, float] = {}
+    ack_latency: list[float] = []
+    statuses: dict[int, int] = {}
+    accepted: set[int] = set()
+    semaphore = asyncio.Semaphore(args.concurrency)
+    url = f"http://127.0.0.1:{args.port}/webhook"
+
+    async def fire(session: aiohttp.ClientSession, seq: int, event):
+        event_type, user_id, data = event
+        async with semaphore:
+            start = time.perf_counter()
+            sent_at[seq] = start
+            async with session.post(f"{url}/{event_type}/{user_id}", json=data) as resp:
+                await resp.read()
+                ack_latency.append(time.perf_counter() - start)
+                statuses[resp.status] = statuses.get(resp.status, 0) + 1
+                if resp.status == 202:
+                    accepted.add(seq)
+
+    connector = aiohttp.TCPConnector(limit=args.concurrency)
+    async with aiohttp.ClientSession(connector=connector) as session:
+        started = time.perf_counter()
+        await asyncio.gather(*(fire(session, seq, event) for seq, event in enumerate(events)))
+        acked = time.perf_counter()
+
+        # Attesa della consegna degli embed sui thread finti, solo per i webhook accettati (202):
+        # quelli rifiutati con 429/503 non arriveranno mai
+        deadline = acked + args.drain_timeout
+        while accepted - discord_registry.delivered.keys() and time.perf_counter() < deadline:
+            await asyncio.sleep(0.01)
+        drained = time.perf_counter()
+
+        # Risposte Discord → UEX attraverso l'outbox
+        reply_latency = []
+        if args.replies:
+            reply_started = {}
+            for n in range(args.replies):
+                item = await reply_outbox.enqueue(str(n % args.users), random.choice(reply_hashes), f"bench reply {n}", 0, n)
+                reply_started[item["reply_id"]] = time.perf_counter()
+            deadline = time.perf_counter() + args.drain_timeout
+            while len(replies_sent) < args.replies and time.perf_counter() < deadline:
+                await asyncio.sleep(0.01)
+            reply_latency = [replies_sent[rid] - t for rid, t in reply_started.items() if rid in replies_sent]
+
+    e2e_latency = [discord_registry.delivered[seq] - sent_at[seq] for seq in discord_registry.delivered if seq in sent_at]
+
+    await runner.cleanup()
+    await reply_outbox.stop()
+    await inbox.stop()
+    await uex.close()
+    await uex_runner.cleanup()
+    await storage.close_db()
+
+    return {
+        "config": {
+            "events": args.events, "concurrency": args.concurrency, "mix": args.mix, "users": args.users,
+            "discord_latency_ms": args.discord_latency, "uex_latency_ms": args.uex_latency,
+        },
+        "statuses": statuses,
+        "rejected": sum(count for status, count in statuses.items() if status in (429, 503)),
+        "ack": {**percentiles(ack_latency), "events_per_sec": round(len(events) / (acked - started), 1)},
+        "end_to_end": {
+            **percentiles(e2e_latency),
+            "accepted": len(accepted),
+            "delivered": len(discord_registry.delivered),
+            "discord_messages": discord_registry.messages,
+            "events_per_sec": round(len(discord_registry.delivered) / (drained - started), 1),
+        },
+        "replies": percentiles(reply_latency),
+    }
+
+
+# ---------- Micro-benchmark DB ----------
+async def _measure(function, args_list: list, before=None) -> dict:
+    samples = []
+    for args in args_list:
+        if before:
+            before()
+        start = time.perf_counter()
+        await function(*args)
+        samples.append(time.perf_counter() - start)
+    result = percentiles(samples)
+    result["ops_per_sec"] = round(len(samples) / sum(samples), 1) if samples else 0
+    return result
+
+async def run_db(args) -> dict:
+    results = {}
+    for size in (int(size) for size in args.sizes.split(",")):
+        storage.DB_PATH = os.path.join(_workdir, "db", f"micro-{size}.db")
+        storage.session_cache.clear()
+        await storage.open_db()
+
+        sessions, links = [], []
+        for n in range(size):
+            sessions.append((str(n), "", 10_000 + n, f"user{n}", "bench", "bench", None, "{}"))
+            links.append((f"hash-{n}", f"user{n}", f"user{(n + 1) % size}"))
+        async with storage.writer() as conn:
+            await conn.executemany(storage.SQL_SAVE_SESSION, sessions)
+            await conn.executemany(storage.SQL_SAVE_LINK, links)
+
+        sample_ids = [(str(random.randrange(size)),) for _ in range(args.iterations)]
+        sample_names = [(f"user{random.randrange(size)}",) for _ in range(args.iterations)]
+        sample_hashes = [(f"hash-{random.randrange(size)}",) for _ in range(args.iterations)]
+
+        storage.routing_index.ready = False
+        cold = await _measure(storage.get_user_session, sample_ids, before=storage.session_cache.clear)
+        for (user_id,) in sample_ids:
+            await storage.get_user_session(user_id)
+        size_results = {
+            "get_user_session_cold": cold,
+            "get_user_session_cached": await _measure(storage.get_user_session, sample_ids),
+            "find_session_by_username": await _measure(storage.find_session_by_username, sample_names),
+            "get_negotiation_link_db": await _measure(storage.get_negotiation_link, sample_hashes),
+        }
+        await storage.warm_routing_index()
+        size_results["get_negotiation_link_index"] = await _measure(storage.get_negotiation_link, sample_hashes)
+        results[str(size)] = size_results
+
+        await storage.close_db()
+        storage.routing_index.ready = False
+    return results
+
+
+# ---------- CLI ----------
+def print_report(report: dict):
+    if "e2e" in report:
+        e2e = report["e2e"]
+        print(f"\n== End-to-end webhook ({e2e['config']['events']} eventi, concorrenza {e2e['config']['concurrency']}) ==")
+        print(f"status HTTP: {e2e['statuses']} • rifiutati (429/503): {e2e['rejected']}")
+        for name in ("ack", "end_to_end", "replies"):
+            stats = e2e[name]
+            if stats.get("count"):
+                print(f"{name:>11}: p50={stats['p50_ms']}ms p95={stats['p95_ms']}ms p99={stats['p99_ms']}ms"
+                      + (f" • {stats['events_per_sec']} eventi/s" if "events_per_sec" in stats else ""))
+        print(f"messaggi Discord inviati: {e2e['end_to_end']['discord_messages']} per {e2e['end_to_end']['delivered']} "
+              f"eventi consegnati su {e2e['end_to_end']['accepted']} accettati")
+    if "db" in report:
+        print("\n== Funzioni DB ==")
+        for size, functions in report["db"].items():
+            print(f"-- {size} sessioni")
+            for name, stats in functions.items():
+                print(f"{name:>28}: p50={stats['p50_ms']}ms p99={stats['p99_ms']}ms • {stats['ops_per_sec']} op/s")
+
+async def run(args) -> dict:
+    report = {"timestamp": time.time(), "python": sys.version.split()[0]}
+    if args.command in ("e2e", "all"):
+        report["e2e"] = await run_e2e(args)
+    if args.command in ("db", "all"):
+        report["db"] = await run_db(args)
+    return report
+
+def main_cli():
+    parser = argparse.ArgumentParser(description="Benchmark del bot UEX")
+    parser.add_argument("command", choices=("e2e", "db", "all"))
+    parser.add_argument("--events", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--mix", default="started=1,reply=4,completed=1")
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--replies", type=int, default=0, help="risposte Discord → UEX da inviare tramite l'outbox")
+    parser.add_argument("--discord-latency", type=float, default=50, help="latenza simulata di Discord in ms")
+    parser.add_argument("--uex-latency", type=float, default=50, help="latenza simulata di UEX in ms")
+    parser.add_argument("--drain-timeout", type=float, default=60)
+    parser.add_argument("--port", type=int, default=20287)
+    parser.add_argument("--uex-port", type=int, default=20288)
+    parser.add_argument("--sizes", default="1000,10000,100000")
+    parser.add_argument("--iterations", type=int, default=2000)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--json", help="salva il report JSON per il confronto tra versioni")
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    report = asyncio.run(run(args))
+    print_report(report)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"\n📄 Report salvato in {args.json}")
+
+
+if __name__ == "__main__":
+    main_cli()
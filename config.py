@@ -0,0 +1,116 @@
+import os
+
+from dotenv import load_dotenv
+
+
+# ---------- Config ----------
+load_dotenv()
+DISCORD_TOKEN = os.getenv("DISCORD_TOKEN")
+TUNNEL_URL = os.getenv("TUNNEL_URL")
+DB_PATH = os.getenv("DB_PATH")
+LOG_PATH = os.getenv("LOG_PATH")
+
+# ---------- Logging ----------
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+LOG_FORMAT = os.getenv("LOG_FORMAT", "json")                           # json (una riga per record) o text
+LOG_MAX_BYTES = int(os.getenv("LOG_MAX_BYTES", str(10 * 1024 * 1024)))  # rotazione per dimensione
+LOG_BACKUPS = int(os.getenv("LOG_BACKUPS", "5"))
+LOG_SAMPLE_RATE = float(os.getenv("LOG_SAMPLE_RATE", "1"))              # frazione dei log INFO per-webhook conservati
+
+# ---------- Cache sessioni ----------
+SESSION_CACHE_SIZE = int(os.getenv("SESSION_CACHE_SIZE", "10000"))
+SESSION_CACHE_TTL = float(os.getenv("SESSION_CACHE_TTL", "300"))
+
+# ---------- Database ----------
+DB_READERS = int(os.getenv("DB_READERS", "4"))                      # connessioni WAL in sola lettura
+DB_STATEMENT_CACHE = int(os.getenv("DB_STATEMENT_CACHE", "128"))    # statement preparati per connessione
+DB_BUSY_TIMEOUT_MS = int(os.getenv("DB_BUSY_TIMEOUT_MS", "5000"))
+DB_FLUSH_INTERVAL_MS = float(os.getenv("DB_FLUSH_INTERVAL_MS", "5"))   # finestra di group commit
+DB_BATCH_SIZE = int(os.getenv("DB_BATCH_SIZE", "100"))                 # scritture massime per transazione
+
+# ---------- Sharding gateway ----------
+DISCORD_SHARDED = os.getenv("DISCORD_SHARDED", "0") == "1"            # usa AutoShardedBot
+SHARD_COUNT = int(os.getenv("SHARD_COUNT")) if os.getenv("SHARD_COUNT") else None   # vuoto = numero consigliato da Discord
+SHARD_IDS = [int(i) for i in os.getenv("SHARD_IDS").split(",")] if os.getenv("SHARD_IDS") else None   # shard di questo processo
+
+# ---------- Server webhook ----------
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "20187"))
+WEBHOOK_PROCESSES = int(os.getenv("WEBHOOK_PROCESSES", "0"))     # 0 = server nel processo del bot, N = processi con SO_REUSEPORT
+METRICS_PORT = int(os.getenv("METRICS_PORT", "20188"))           # /metrics del gateway quando WEBHOOK_PROCESSES > 0 o WEBHOOK_LISTEN=0 (0 = nessuno)
+WEBHOOK_LISTEN = os.getenv("WEBHOOK_LISTEN", "1") == "1"         # 0 nei processi shard secondari: niente porta webhook né processi di ingresso
+WEBHOOK_MAX_CONCURRENCY = int(os.getenv("WEBHOOK_MAX_CONCURRENCY", "256"))   # richieste in corso oltre cui si risponde 503
+WEBHOOK_MAX_BODY = int(os.getenv("WEBHOOK_MAX_BODY", str(64 * 1024)))         # byte, oltre si risponde 413
+WEBHOOK_MAX_BACKLOG = int(os.getenv("WEBHOOK_MAX_BACKLOG", "10000"))         # eventi in coda (inbox + scritture DB) oltre cui 503
+WEBHOOK_USER_RATE = float(os.getenv("WEBHOOK_USER_RATE", "5"))               # webhook al secondo per user_id...
+WEBHOOK_USER_BURST = int(os.getenv("WEBHOOK_USER_BURST", "20"))              # ...con questo burst, poi 429
+SHUTDOWN_TIMEOUT = float(os.getenv("SHUTDOWN_TIMEOUT", "20"))                  # secondi per finire webhook, invii e risposte in corso
+SHUTDOWN_READY_DELAY = float(os.getenv("SHUTDOWN_READY_DELAY", "0"))           # secondi di /ready a 503 prima di chiudere il listener
+
+# ---------- Webhook inbox ----------
+INBOX_WORKERS = int(os.getenv("INBOX_WORKERS", "4"))              # i worker non aspettano l'invio a Discord
+INBOX_MAX_ATTEMPTS = int(os.getenv("INBOX_MAX_ATTEMPTS", "6"))          # poi l'evento va in stato 'dead'
+INBOX_RETRY_BASE = float(os.getenv("INBOX_RETRY_BASE", "2"))            # secondi, raddoppia a ogni tentativo
+INBOX_RETRY_MAX = float(os.getenv("INBOX_RETRY_MAX", "300"))
+INBOX_POLL_MS = float(os.getenv("INBOX_POLL_MS", "50"))                # intervallo di polling degli eventi salvati da altri processi
+INBOX_POLL_BATCH = int(os.getenv("INBOX_POLL_BATCH", "500"))
+
+# ---------- Invii Discord ----------
+SEND_COALESCE_MS = float(os.getenv("SEND_COALESCE_MS", "300"))         # finestra per raggruppare gli embed per thread
+UNREAD_RENAMES_PER_WINDOW = int(os.getenv("UNREAD_RENAMES_PER_WINDOW", "2"))   # rename del thread concessi da Discord...
+UNREAD_RENAME_WINDOW = float(os.getenv("UNREAD_RENAME_WINDOW", "600"))         # ...in questa finestra (secondi)
+
+# ---------- Risoluzione thread ----------
+THREAD_CACHE_SIZE = int(os.getenv("THREAD_CACHE_SIZE", "10000"))
+THREAD_CACHE_TTL = float(os.getenv("THREAD_CACHE_TTL", "300"))         # thread letti via REST riusati per questi secondi
+THREAD_MISSING_TTL = float(os.getenv("THREAD_MISSING_TTL", "600"))     # cache negativa dei thread inesistenti
+THREAD_FETCH_RATE = float(os.getenv("THREAD_FETCH_RATE", "5"))         # fetch_channel al secondo
+THREAD_FETCH_BURST = int(os.getenv("THREAD_FETCH_BURST", "10"))
+
+# ---------- Polling notifiche (fallback dei webhook) ----------
+POLL_ENABLED = os.getenv("POLL_ENABLED", "0") == "1"
+POLL_INTERVAL = float(os.getenv("POLL_INTERVAL", "6"))             # intervallo minimo per utente (secondi)
+POLL_MAX_INTERVAL = float(os.getenv("POLL_MAX_INTERVAL", "600"))   # intervallo per utenti senza notifiche
+POLL_CONCURRENCY = int(os.getenv("POLL_CONCURRENCY", "8"))         # richieste di polling contemporanee
+POLL_RATE = float(os.getenv("POLL_RATE", "10"))                    # richieste di polling al secondo (tutti gli utenti)
+POLL_GRACE = float(os.getenv("POLL_GRACE", "60"))                  # secondi concessi al webhook prima del polling
+
+# ---------- Janitor ----------
+JANITOR_INTERVAL = float(os.getenv("JANITOR_INTERVAL", "3600"))            # secondi tra due passate
+JANITOR_BATCH = int(os.getenv("JANITOR_BATCH", "500"))                      # righe eliminate per transazione
+LINK_RETENTION_DAYS = float(os.getenv("LINK_RETENTION_DAYS", "30"))         # link di negoziazione inattivi
+SESSION_RETENTION_DAYS = float(os.getenv("SESSION_RETENTION_DAYS", "365"))  # sessioni inattive (0 = mai)
+NOTIFICATION_RETENTION_DAYS = float(os.getenv("NOTIFICATION_RETENTION_DAYS", "90"))  # message id → hash per le reply
+FAILED_RETENTION_DAYS = float(os.getenv("FAILED_RETENTION_DAYS", "30"))     # webhook 'dead' e risposte fallite/incerte
+JANITOR_RECONCILE_RATE = float(os.getenv("JANITOR_RECONCILE_RATE", "1"))    # thread verificati via REST al secondo
+JANITOR_RECONCILE_BATCH = int(os.getenv("JANITOR_RECONCILE_BATCH", "1000")) # sessioni verificate per passata
+JANITOR_VACUUM_PAGES = int(os.getenv("JANITOR_VACUUM_PAGES", "2000"))       # pagine restituite per passata
+
+# ---------- Digest ----------
+DIGEST_MAX_MINUTES = int(os.getenv("DIGEST_MAX_MINUTES", "1440"))      # finestra massima sceglibile con /digest
+DIGEST_MAX_EVENTS = int(os.getenv("DIGEST_MAX_EVENTS", "50"))          # oltre questo numero il riepilogo parte subito
+DIGEST_RETRY_BASE = float(os.getenv("DIGEST_RETRY_BASE", "5"))         # secondi, raddoppia a ogni invio fallito
+DIGEST_RETRY_MAX = float(os.getenv("DIGEST_RETRY_MAX", "600"))
+
+# ---------- Dedup webhook ----------
+DEDUP_WINDOW = float(os.getenv("DEDUP_WINDOW", "600"))                  # secondi in cui un duplicato viene scartato
+DEDUP_CACHE_SIZE = int(os.getenv("DEDUP_CACHE_SIZE", "50000"))
+
+# ---------- Client UEX ----------
+UEX_POOL_SIZE = int(os.getenv("UEX_POOL_SIZE", "50"))                  # connessioni keep-alive verso UEX
+UEX_DNS_CACHE_TTL = int(os.getenv("UEX_DNS_CACHE_TTL", "300"))
+UEX_TIMEOUT_GET_USER = float(os.getenv("UEX_TIMEOUT_GET_USER", "15"))
+UEX_TIMEOUT_POST_MESSAGE = float(os.getenv("UEX_TIMEOUT_POST_MESSAGE", "10"))
+UEX_TIMEOUT_NOTIFICATIONS = float(os.getenv("UEX_TIMEOUT_NOTIFICATIONS", "10"))
+UEX_MAX_RETRIES = int(os.getenv("UEX_MAX_RETRIES", "3"))                # solo per le chiamate idempotenti
+UEX_RETRY_BASE = float(os.getenv("UEX_RETRY_BASE", "0.5"))
+UEX_RETRY_MAX = float(os.getenv("UEX_RETRY_MAX", "8"))
+UEX_USER_RATE = float(os.getenv("UEX_USER_RATE", "1"))                 # richieste/secondo per utente
+UEX_USER_BURST = int(os.getenv("UEX_USER_BURST", "5"))
+UEX_BREAKER_THRESHOLD = int(os.getenv("UEX_BREAKER_THRESHOLD", "5"))    # errori consecutivi prima di aprire il circuito
+UEX_BREAKER_RESET = float(os.getenv("UEX_BREAKER_RESET", "30"))         # secondi prima di riprovare
+
+# ---------- Reply outbox ----------
+OUTBOX_WORKERS = int(os.getenv("OUTBOX_WORKERS", "8"))                  # invii contemporanei verso UEX
+OUTBOX_MAX_ATTEMPTS = int(os.getenv("OUTBOX_MAX_ATTEMPTS", "8"))
+OUTBOX_RETRY_BASE = float(os.getenv("OUTBOX_RETRY_BASE", "5"))
+OUTBOX_RETRY_MAX = float(os.getenv("OUTBOX_RETRY_MAX", "600"))
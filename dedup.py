@@ -0,0 +1,75 @@
+import json
+import time
+import hashlib
+
+import storage
+from cache import TTLCache
+from config import DEDUP_WINDOW, DEDUP_CACHE_SIZE
+
+
+# ---------- Dedup webhook ----------
+# Finestra in memoria per i duplicati ravvicinati, tabella webhook_dedup per quelli
+# che arrivano dopo un riavvio. Il controllo avviene prima di salvare l'evento nell'inbox.
+_recent = TTLCache(maxsize=DEDUP_CACHE_SIZE, ttl=DEDUP_WINDOW)
+dedup_stats = {"checked": 0, "hits": 0}
+
+# Ogni quante impronte nuove si ripuliscono le righe scadute della tabella
+_PRUNE_EVERY = 1000
+_marks_since_prune = 0
+
+# Campi identificativi del singolo messaggio, se UEX li include nel payload
+_ID_FIELDS = ("id", "message_id", "notification_id", "date_added", "timestamp", "created_at")
+
+
+def fingerprint(event_type: str, user_id: str, data: dict) -> str | None:
+    """
+    Impronta del contenuto dell'evento. I due webhook di chiusura
+    (negotiation_completed_client / _advertiser) producono la stessa impronta.
+    None se l'evento non si può deduplicare: un messaggio senza id né timestamp
+    ("ok" scritto due volte) non è distinguibile da un retry, e meglio un doppione che un messaggio perso.
+    """
+    kind = "negotiation_completed" if event_type.startswith("negotiation_completed") else event_type
+    negotiation_hash = data.get("negotiation_hash")
+    if "message" in data and not any(data.get(field) for field in _ID_FIELDS):
+        return None
+    if negotiation_hash:
+        parts = [
+            kind, str(user_id), str(negotiation_hash),
+            str(data.get("message", "")), str(data.get("client_username", "")),
+            *(str(data.get(field, "")) for field in _ID_FIELDS),
+        ]
+    else:
+        # Eventi senza negoziazione: conta l'intero payload
+        parts = [kind, str(user_id), json.dumps(data, sort_keys=True)]
+    return hashlib.sha256("\x1f".join(parts).encode()).hexdigest()
+
+async def is_duplicate(fp: str | None) -> bool:
+    """True se l'impronta è già stata vista nella finestra; altrimenti la registra."""
+    global _marks_since_prune
+    if fp is None:
+        return False
+    dedup_stats["checked"] += 1
+    if fp in _recent:
+        dedup_stats["hits"] += 1
+        return True
+
+    # Registrata subito in memoria: una richiesta identica concorrente risulta già duplicata
+    _recent.set(fp, True)
+    now = time.time()
+    if await storage.dedup_seen(fp, now - DEDUP_WINDOW):
+        dedup_stats["hits"] += 1
+        return True
+
+    await storage.dedup_mark(fp, now)
+    _marks_since_prune += 1
+    if _marks_since_prune >= _PRUNE_EVERY:
+        _marks_since_prune = 0
+        await storage.dedup_prune(now - DEDUP_WINDOW)
+    return False
+
+async def forget(fp: str | None):
+    """Annulla la registrazione, per esempio se l'evento non è stato accettato e verrà ritrasmesso."""
+    if fp is None:
+        return
+    _recent.pop(fp)
+    await storage.dedup_forget(fp)
@@ -0,0 +1,246 @@
+import time
+import uuid
+import asyncio
+import logging
+
+import discord
+
+import storage
+from retry import backoff_delay
+from sender import scheduler
+from sharding import shards
+from routing import index as routing
+from unread import indicator as unread
+from config import DIGEST_MAX_EVENTS, DIGEST_RETRY_BASE, DIGEST_RETRY_MAX
+
+
+# ---------- Limiti embed Discord ----------
+MAX_FIELDS = 25
+MAX_FIELD_NAME = 256
+MAX_FIELD_VALUE = 1024
+MAX_EMBED_CHARS = 5500      # margine sotto i 6000 per titolo e footer
+FOOTER = "Made with love by Passluk"
+NEGOTIATION_URL = "https://uexcorp.space/marketplace/negotiate/hash/{}"
+
+
+def _clip(text: str, limit: int) -> str:
+    return text if len(text) <= limit else text[:limit - 1] + "…"
+
+
+# ---------- Digest per thread ----------
+class DigestBuffer:
+    """
+    Accumula gli eventi dei thread in modalità digest e allo scadere della finestra li invia
+    in un solo messaggio, con un campo per negoziazione. La finestra parte dal primo evento;
+    oltre DIGEST_MAX_EVENTS eventi il riepilogo parte subito.
+    Gli eventi restano in digest_entries fino all'invio: ripartono al riavvio e un invio
+    fallito viene ritentato con backoff.
+    """
+
+    def __init__(self, max_events: int = DIGEST_MAX_EVENTS):
+        self.max_events = max_events
+        self.stats = {"events": 0, "digests": 0, "errors": 0, "dropped": 0}
+        self._threads: dict[int, discord.abc.Messageable] = {}
+        self._groups: dict[int, dict] = {}      # thread_id → negotiation_hash → {"title", "lines", "ids"}
+        self._counts: dict[int, int] = {}
+        self._due: dict[int, float] = {}
+        self._attempts: dict[int, int] = {}     # invii falliti consecutivi per thread
+        self._flushing: set[asyncio.Task] = set()
+        self._get_channel = None
+        self._wake: asyncio.Event | None = None
+        self._task: asyncio.Task | None = None
+
+    async def start(self, get_channel=None):
+        """
+        Ricarica dal DB gli eventi non ancora inviati e avvia il flusher.
+        `await get_channel(thread_id)` risolve i thread degli eventi ricaricati (None se non esiste più).
+        """
+        if self._task is not None:
+            return
+        self._get_channel = get_channel
+        now, wall = time.monotonic(), time.time()
+        for entry_id, thread_id, negotiation_hash, title, line, due_at in await storage.digest_pending():
+            self._append(thread_id, entry_id, negotiation_hash, title, line)
+            due = now + max(0.0, due_at - wall)
+            self._due[thread_id] = min(self._due.get(thread_id, due), due)
+        if self._counts:
+            logging.info(f"🗞️ Ricaricati {self.pending()} eventi digest per {len(self._counts)} thread")
+        self._wake = asyncio.Event()
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self, timeout: float | None = None):
+        """
+        Ferma il flusher, invia subito i riepiloghi in sospeso e attende anche quelli già partiti.
+        Ciò che non è inviato entro `timeout` secondi resta nel DB per il prossimo avvio.
+        """
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        for thread_id in list(self._groups):
+            self._spawn_flush(thread_id)
+        if not self._flushing:
+            return
+        _, late = await asyncio.wait(set(self._flushing), timeout=timeout)
+        for task in late:
+            task.cancel()
+        await asyncio.gather(*late, return_exceptions=True)
+        if late:
+            logging.warning(f"⚠️ {len(late)} riepiloghi non inviati alla chiusura: ripartiranno al prossimo avvio")
+
+    def pending(self) -> int:
+        return sum(self._counts.values())
+
+    def _append(self, thread_id: int, entry_id: str, negotiation_hash: str | None, title: str | None, line: str):
+        group = self._groups.setdefault(thread_id, {}).setdefault(negotiation_hash, {"title": title, "lines": [], "ids": []})
+        group["lines"].append(line)
+        group["ids"].append(entry_id)
+        if title:
+            group["title"] = title
+        self._counts[thread_id] = self._counts.get(thread_id, 0) + 1
+
+    async def add(self, thread: discord.abc.Messageable, window: float, negotiation_hash: str | None, title: str | None, line: str):
+        entry_id = uuid.uuid4().hex
+        self._threads[thread.id] = thread
+        self._append(thread.id, entry_id, negotiation_hash, title, line)
+        self.stats["events"] += 1
+
+        if thread.id not in self._due:
+            self._due[thread.id] = time.monotonic() + window
+        if self._counts[thread.id] >= self.max_events:
+            self._due[thread.id] = 0
+        if self._wake is not None:
+            self._wake.set()
+
+        # La scadenza va salvata in epoch: al riavvio il monotonic riparte da capo
+        due_at = time.time() + max(0.0, self._due[thread.id] - time.monotonic())
+        shard_id = shards.shard_for_guild(routing.guild_for_thread(thread.id))
+        await storage.digest_add(entry_id, thread.id, shard_id, negotiation_hash, title, line, due_at)
+
+    async def flush(self, thread_id: int):
+        self._due.pop(thread_id, None)
+        thread = self._threads.pop(thread_id, None)
+        groups = self._groups.pop(thread_id, {})
+        count = self._counts.pop(thread_id, 0)
+        if not groups:
+            return
+
+        hashes, sent = list(groups), 0
+        try:
+            if thread is None and self._get_channel is not None:
+                thread = await self._get_channel(thread_id)
+            if thread is None:
+                self._attempts.pop(thread_id, None)
+                self.stats["dropped"] += count
+                logging.warning(f"⚠️ Thread {thread_id} non trovato: scartato il riepilogo di {count} eventi")
+                await storage.digest_done(_entry_ids(groups.values()))
+                return
+
+            # Con una sola negoziazione le reply al riepilogo risalgono all'hash come per le notifiche singole
+            single = hashes[0] if len(hashes) == 1 else None
+            for embed in build_embeds(groups, count):
+                message = await scheduler.send(thread, embed, key=single or "digest")
+                if single:
+                    await storage.save_notification_message(message.id, single, thread_id, "digest")
+                # Un campo per negoziazione: se un embed successivo fallisce queste non vengono reinviate
+                done = hashes[sent:sent + len(embed.fields)]
+                sent += len(done)
+                await storage.digest_done(_entry_ids(groups[h] for h in done))
+        except (discord.NotFound, discord.Forbidden) as e:
+            # Thread eliminato o non più accessibile: ritentare non servirebbe
+            self._attempts.pop(thread_id, None)
+            rest = [groups[h] for h in hashes[sent:]]
+            self.stats["errors"] += 1
+            self.stats["dropped"] += sum(len(group["lines"]) for group in rest)
+            logging.warning(f"⚠️ Riepilogo scartato sul thread {thread_id}: {e}")
+            await storage.digest_done(_entry_ids(rest))
+        except Exception as e:
+            self.stats["errors"] += 1
+            self._retry(thread_id, thread, {h: groups[h] for h in hashes[sent:]}, e)
+        else:
+            self._attempts.pop(thread_id, None)
+            self.stats["digests"] += 1
+            if not isinstance(thread, discord.PartialMessageable):
+                unread.mark(thread)
+
+    def _spawn_flush(self, thread_id: int):
+        task = asyncio.create_task(self.flush(thread_id))
+        self._flushing.add(task)
+        task.add_done_callback(self._flushing.discard)
+
+    def _retry(self, thread_id: int, thread, groups: dict, error: Exception):
+        """Rimette in coda gli eventi non inviati; quelli arrivati nel frattempo li seguono nello stesso riepilogo."""
+        for negotiation_hash, newer in self._groups.pop(thread_id, {}).items():
+            group = groups.setdefault(negotiation_hash, {"title": newer["title"], "lines": [], "ids": []})
+            group["lines"] += newer["lines"]
+            group["ids"] += newer["ids"]
+            if newer["title"]:
+                group["title"] = newer["title"]
+        self._groups[thread_id] = groups
+        self._counts[thread_id] = sum(len(group["lines"]) for group in groups.values())
+        if thread is not None:
+            self._threads.setdefault(thread_id, thread)
+
+        attempts = self._attempts[thread_id] = self._attempts.get(thread_id, 0) + 1
+        delay = backoff_delay(attempts, DIGEST_RETRY_BASE, DIGEST_RETRY_MAX)
+        self._due[thread_id] = time.monotonic() + delay
+        if self._wake is not None:
+            self._wake.set()
+        logging.warning(
+            f"⚠️ Invio del riepilogo ({self._counts[thread_id]} eventi) fallito sul thread {thread_id}, "
+            f"nuovo tentativo tra {delay:.0f}s: {error}"
+        )
+
+    async def _run(self):
+        while True:
+            self._wake.clear()
+            now = time.monotonic()
+            for thread_id in [tid for tid, at in self._due.items() if at <= now]:
+                del self._due[thread_id]
+                self._spawn_flush(thread_id)
+
+            timeout = max(0.0, min(self._due.values()) - time.monotonic()) if self._due else None
+            try:
+                await asyncio.wait_for(self._wake.wait(), timeout=timeout)
+            except asyncio.TimeoutError:
+                pass
+
+
+def _entry_ids(groups) -> list[str]:
+    return [entry_id for group in groups for entry_id in group["ids"]]
+
+def _field_value(negotiation_hash: str | None, lines: list[str]) -> str:
+    link = f"\n🔗 [Apri su UEX]({NEGOTIATION_URL.format(negotiation_hash)})" if negotiation_hash else ""
+    budget = MAX_FIELD_VALUE - len(link)
+    # Si tengono gli eventi più recenti; quelli esclusi vengono solo contati
+    kept, size = [], 0
+    for line in reversed(lines):
+        line = _clip(line, budget)
+        if size + len(line) + 1 > budget - 20:
+            break
+        kept.append(line)
+        size += len(line) + 1
+    skipped = len(lines) - len(kept)
+    head = [f"… e altri {skipped} eventi"] if skipped else []
+    return "\n".join(head + kept[::-1]) + link
+
+def build_embeds(groups: dict, count: int) -> list[discord.Embed]:
+    """Un campo per negoziazione; nuovi embed quando si superano 25 campi o il limite di caratteri."""
+    embeds, embed, size = [], None, 0
+    for negotiation_hash, group in groups.items():
+        name = _clip(f"📦 {group['title'] or 'Sconosciuto'} ({len(group['lines'])})", MAX_FIELD_NAME)
+        value = _field_value(negotiation_hash, group["lines"])
+        if embed is None or len(embed.fields) >= MAX_FIELDS or size + len(name) + len(value) > MAX_EMBED_CHARS:
+            embed = discord.Embed(
+                title=f"🗞️ Riepilogo: {count} eventi in {len(groups)} negoziazioni",
+                color=discord.Color.gold(),
+            )
+            embed.set_footer(text=FOOTER)
+            embeds.append(embed)
+            size = 0
+        embed.add_field(name=name, value=value, inline=False)
+        size += len(name) + len(value)
+    return embeds
+
+
+digests = DigestBuffer()
@@ -0,0 +1,20 @@
+"""
+Nomi dei tipi evento UEX gestiti dal bot.
+
+Modulo senza dipendenze: lo importano i processi di ingresso, che non devono caricare
+discord.py e gli handler di events.py solo per etichettare le metriche.
+"""
+
+NEGOTIATION_STARTED = "negotiation_started"
+USER_REPLY = "user_reply"
+NEGOTIATION_COMPLETED_CLIENT = "negotiation_completed_client"
+NEGOTIATION_COMPLETED_ADVERTISER = "negotiation_completed_advertiser"
+# Non arriva da UEX: lo accoda il poller quando un webhook è andato perso
+USER_NOTIFICATION = "user_notification"
+
+REGISTERED = frozenset({
+    NEGOTIATION_STARTED, USER_REPLY, NEGOTIATION_COMPLETED_CLIENT, NEGOTIATION_COMPLETED_ADVERTISER, USER_NOTIFICATION,
+})
+
+def is_registered(event_type: str) -> bool:
+    return event_type in REGISTERED
@@ -0,0 +1,284 @@
+import json
+import string
+import asyncio
+import logging
+
+import discord
+
+from sender import scheduler
+from poller import poller
+from digest import digests
+from unread import indicator as unread
+import storage
+import event_types
+from routing import index as routing
+from sharding import shards
+from logging_setup import SAMPLED
+from storage import save_negotiation_link, delete_negotiation_link
+
+
+# ---------- Limiti embed Discord ----------
+MAX_TITLE = 256
+MAX_DESCRIPTION = 4096
+MAX_VALUE = 1024            # limite di default per ogni valore inserito in un template
+FOOTER = "Made with love by Passluk"
+
+
+def truncate(text, limit: int) -> str:
+    text = str(text)
+    return text if len(text) <= limit else text[:limit - 1] + "…"
+
+
+# ---------- Template embed ----------
+class TextTemplate:
+    """
+    Template analizzato una sola volta all'avvio: il rendering è solo una join dei pezzi
+    letterali con i valori troncati, e il risultato resta entro `limit` caratteri.
+    """
+
+    def __init__(self, template: str, limit: int, limits: dict | None = None):
+        self.limit = limit
+        self.limits = limits or {}
+        self._parts = [(literal, field) for literal, field, _, _ in string.Formatter().parse(template)]
+
+    def render(self, values: dict) -> str:
+        out = []
+        for literal, field in self._parts:
+            out.append(literal)
+            if field is not None:
+                out.append(truncate(values.get(field, ""), self.limits.get(field, MAX_VALUE)))
+        return truncate("".join(out), self.limit)
+
+
+class EmbedTemplate:
+    """Titolo e descrizione come TextTemplate nei limiti di Discord, più colore e footer."""
+
+    def __init__(self, title: str, description: str, color: discord.Color, limits: dict | None = None):
+        self.color = color
+        self._title = TextTemplate(title, MAX_TITLE, limits)
+        self._description = TextTemplate(description, MAX_DESCRIPTION, limits)
+
+    def render(self, values: dict) -> discord.Embed:
+        embed = discord.Embed(
+            title=self._title.render(values),
+            description=self._description.render(values),
+            color=self.color,
+        )
+        embed.set_footer(text=FOOTER)
+        return embed
+
+
+class Unroutable(Exception):
+    """Il destinatario dell'evento non è raggiungibile: il webhook termina con 404."""
+
+
+# ---------- Handler ----------
+class EventHandler:
+    """
+    Un handler dichiara i campi obbligatori, i default e il template; la pipeline comune
+    (validazione → effetti → thread destinatario → embed → invio) è in `dispatch`.
+    Con `digest` impostato l'evento può finire nel riepilogo dei thread in modalità digest.
+    """
+    template: EmbedTemplate
+    digest: TextTemplate | None = None
+    required: tuple = ()
+    defaults: dict = {}
+
+    async def prepare(self, event_type: str, user_id: str, data: dict):
+        """Effetti collaterali prima dell'invio (link di negoziazione, ecc.)."""
+
+    async def target(self, event_type: str, user_id: str, data: dict) -> int:
+        thread_id = routing.thread_for_user(user_id)
+        if not thread_id:
+            # La sessione può essere stata creata da un altro processo dopo il warm dell'indice
+            session = await storage.get_user_session(user_id)
+            if session and session.get("thread_id"):
+                routing.set_session(user_id, session)
+                thread_id = routing.thread_for_user(user_id)
+        if not thread_id:
+            raise Unroutable(f"Nessun Thread_id Trovato per user_id: {user_id}")
+        return thread_id
+
+    def values(self, event_type: str, user_id: str, data: dict) -> dict:
+        values = dict(self.defaults)
+        values.update((key, value) for key, value in data.items() if value is not None)
+        return values
+
+
+_handlers: dict[str, EventHandler] = {}
+
+def register(*event_types: str):
+    def decorator(cls):
+        handler = cls()
+        for event_type in event_types:
+            _handlers[event_type] = handler
+        return cls
+    return decorator
+
+def handler_for(event_type: str) -> EventHandler:
+    return _handlers.get(event_type, _fallback)
+
+
+@register(event_types.NEGOTIATION_STARTED)
+class NegotiationStarted(EventHandler):
+    required = ("negotiation_hash",)
+    defaults = {"client_username": "Anonimo", "listing_title": "Sconosciuto"}
+    template = EmbedTemplate(
+        "📢 Nuova negoziazione iniziata",
+        "👤 **{client_username}**\n"
+        "📦 **{listing_title}**\n"
+        "🔗 [Apri su UEX](https://uexcorp.space/marketplace/negotiate/hash/{negotiation_hash})",
+        discord.Color.green(),
+    )
+    digest = TextTemplate("📢 Nuova negoziazione da **{client_username}**", MAX_VALUE, {"client_username": 100})
+
+    async def prepare(self, event_type, user_id, data):
+        buyer, seller = data.get("client_username"), data.get("listing_owner_username")
+        logging.info(f"🚀 Nuova negoziazione: hash: {data['negotiation_hash']} da {buyer}", extra=SAMPLED)
+        # Non serve attendere il commit: l'indice di routing è già aggiornato e la coda
+        # di scrittura lo salva prima della rimozione dell'evento dall'inbox
+        await save_negotiation_link(negotiation_hash=data["negotiation_hash"], buyer_id=buyer, seller_id=seller, durable=False)
+        logging.info(f"✅ Link creato tra buyer: {buyer} e seller: {seller}", extra=SAMPLED)
+
+
+@register(event_types.USER_REPLY)
+class UserReply(EventHandler):
+    required = ("negotiation_hash", "client_username")
+    defaults = {"message": "", "listing_title": "Sconosciuto"}
+    template = EmbedTemplate(
+        "💬 Nuovo messaggio",
+        "👤 **{client_username}** ha scritto:\n"
+        "> {message}\n\n"
+        "📦 **{listing_title}**\n"
+        "🔗 [Apri su UEX](https://uexcorp.space/marketplace/negotiate/hash/{negotiation_hash})",
+        discord.Color.gold(),
+        limits={"message": 3000},
+    )
+    digest = TextTemplate("💬 **{client_username}**: {message}", MAX_VALUE, {"client_username": 100, "message": 300})
+
+    async def prepare(self, event_type, user_id, data):
+        logging.info(f"💬 Webhook reply ricevuto → hash: {data['negotiation_hash']}, da user_id={data['client_username']}", extra=SAMPLED)
+
+    async def target(self, event_type, user_id, data):
+        link = await storage.get_negotiation_link(data["negotiation_hash"])
+        if not link:
+            raise Unroutable(f"Nessun collegamento trovato per negoziazione {data['negotiation_hash']}")
+        await storage.touch_negotiation_link(data["negotiation_hash"])
+
+        # Il venditore ha scritto → il messaggio va al thread del buyer, altrimenti a quello del venditore
+        if data["client_username"] != data.get("listing_owner_username"):
+            return await super().target(event_type, user_id, data)
+
+        buyer_thread_id = routing.thread_for_username(link.get("buyer_id"))
+        if not buyer_thread_id and shards.partial:
+            # La sessione del buyer può essere stata creata da un altro processo dopo il warm dell'indice
+            session = await storage.find_session_by_username(link.get("buyer_id"))
+            if session:
+                routing.set_session(session["user_id"], session)
+                buyer_thread_id = routing.thread_for_username(link.get("buyer_id"))
+        if not buyer_thread_id:
+            raise Unroutable(f"Buyer_Thread_Id not found per {link.get('buyer_id')}")
+        return buyer_thread_id
+
+
+@register(event_types.NEGOTIATION_COMPLETED_CLIENT, event_types.NEGOTIATION_COMPLETED_ADVERTISER)
+class NegotiationCompleted(EventHandler):
+    required = ("negotiation_hash",)
+    defaults = {"client_username": "Anonimo", "listing_title": "Sconosciuto", "rating_stars": 0, "rating_comments": "Nessuno"}
+    template = EmbedTemplate(
+        "✅ Negoziazione completata da {client_username}",
+        "📦 **{listing_title}**\n"
+        "⭐ Valutazione: {rating_stars}\n"
+        "💬 Commento: {rating_comments}\n"
+        "🔗 [Apri su UEX](https://uexcorp.space/marketplace/negotiate/hash/{negotiation_hash})",
+        discord.Color.red(),
+    )
+
+    async def prepare(self, event_type, user_id, data):
+        logging.info(f"🏁 Fine negoziazione → eliminazione link hash: {data['negotiation_hash']}", extra=SAMPLED)
+        await delete_negotiation_link(data["negotiation_hash"], durable=False)
+
+
+@register(event_types.USER_NOTIFICATION)
+class UserNotification(EventHandler):
+    """Notifiche recuperate dal poller quando il webhook non è arrivato: il testo è quello di UEX."""
+    defaults = {"message": ""}
+    template = EmbedTemplate(
+        "🔔 Notifica UEX",
+        "{message}\n\n"
+        "🔗 [Apri su UEX]({url})",
+        discord.Color.blue(),
+        limits={"message": 3000},
+    )
+
+    def values(self, event_type, user_id, data):
+        values = super().values(event_type, user_id, data)
+        values["url"] = f"https://uexcorp.space/{str(data.get('redir') or '').lstrip('/')}"
+        return values
+
+
+class UnknownEvent(EventHandler):
+    """Eventi UEX non ancora gestiti: il payload viene mostrato così com'è, troncato."""
+    template = EmbedTemplate("ℹ️ Evento: {event_type}", "{payload}", discord.Color.blue(), limits={"payload": MAX_DESCRIPTION})
+
+    def values(self, event_type, user_id, data):
+        return {"event_type": event_type, "payload": json.dumps(data, indent=2, ensure_ascii=False)}
+
+
+_fallback = UnknownEvent()
+
+
+# ---------- Pipeline comune ----------
+async def dispatch(event_type: str, user_id: str, data, get_channel) -> dict:
+    """
+    Restituisce {"status", "text"} come i dispatcher dell'inbox: >= 500 viene ritentato.
+    Con "sent" l'evento è accodato per l'invio e l'inbox lo chiude quando l'invio termina.
+    `await get_channel(thread_id)` restituisce il thread (o un PartialMessageable per i
+    thread di shard gestiti da altri processi) oppure None se non esiste più.
+    """
+    if not isinstance(data, dict):
+        logging.warning(f"⚠️ Payload non valido per event='{event_type}': atteso un oggetto JSON")
+        return {"status": 400, "text": "invalid payload"}
+
+    handler = handler_for(event_type)
+    missing = [field for field in handler.required if not data.get(field)]
+    if missing:
+        logging.warning(f"⚠️ Campi mancanti per event='{event_type}': {', '.join(missing)}")
+        return {"status": 400, "text": f"missing fields: {', '.join(missing)}"}
+
+    await handler.prepare(event_type, user_id, data)
+    try:
+        thread_id = await handler.target(event_type, user_id, data)
+    except Unroutable as e:
+        logging.warning(f"⚠️ {e}")
+        return {"status": 404, "text": str(e)}
+
+    thread = await get_channel(thread_id)
+    if not thread:
+        logging.warning(f"⚠️ Thread {thread_id} non trovato per event='{event_type}' → user_id={user_id}")
+        return {"status": 404, "text": "thread not found"}
+
+    negotiation_hash = data.get("negotiation_hash")
+    if event_type != event_types.USER_NOTIFICATION:
+        # Il poller non riconsegna le notifiche di questa negoziazione già arrivate via webhook
+        poller.note_webhook(user_id, negotiation_hash)
+
+    window = routing.digest_window(thread_id)
+    if window and handler.digest is not None:
+        await digests.add(thread, window, negotiation_hash, data.get("listing_title"), handler.digest.render(handler.values(event_type, user_id, data)))
+        await storage.touch_session(user_id)
+        return {"status": 200, "text": "Webhook aggiunto al digest"}
+
+    # Il worker dell'inbox non aspetta la finestra di coalescing: chiude l'evento quando `sent` termina
+    sent = scheduler.enqueue(thread, handler.template.render(handler.values(event_type, user_id, data)), key=negotiation_hash)
+    await storage.touch_session(user_id)
+    return {"status": 200, "text": "Webhook elaborato", "sent": asyncio.ensure_future(_after_send(sent, thread, negotiation_hash, event_type))}
+
+async def _after_send(sent: asyncio.Future, thread, negotiation_hash: str | None, event_type: str):
+    message = await sent
+    if negotiation_hash:
+        # Le reply a questo messaggio risalgono alla negoziazione dal message id
+        await storage.save_notification_message(message.id, negotiation_hash, thread.id, event_type)
+    # Il rename del thread richiede l'oggetto in cache: lo fa solo il processo che possiede lo shard
+    if not isinstance(thread, discord.PartialMessageable):
+        unread.mark(thread)
@@ -0,0 +1,202 @@
+import time
+import uuid
+import asyncio
+import logging
+
+import storage
+from sharding import shards
+from retry import backoff_delay
+from config import (
+    INBOX_WORKERS, INBOX_MAX_ATTEMPTS, INBOX_RETRY_BASE, INBOX_RETRY_MAX, INBOX_POLL_MS, INBOX_POLL_BATCH,
+    WEBHOOK_PROCESSES, WEBHOOK_LISTEN,
+)
+
+
+# ---------- Webhook inbox ----------
+# Ogni webhook viene salvato in webhook_inbox prima della risposta 202 e poi
+# consegnato al dispatcher da un pool di worker, con retry e stato 'dead'.
+# I processi di ingresso senza worker salvano gli eventi come 'queued': il processo
+# del gateway li preleva con inbox_claim e li porta in 'pending'.
+_queue: asyncio.Queue | None = None
+_workers: list[asyncio.Task] = []
+_busy: set[asyncio.Task] = set()       # worker con un evento in consegna
+_sending: set[asyncio.Task] = set()    # eventi già instradati in attesa dell'invio a Discord
+_closing = False
+_dispatcher = None
+inbox_stats = {"received": 0, "processed": 0, "retried": 0, "dead": 0}
+
+
+async def enqueue(event_type: str, user_id: str, body: str) -> str:
+    """
+    Salva l'evento in modo durevole e lo mette in coda per i worker locali. Se in questo
+    processo non girano worker, o l'utente è su uno shard gestito da un altro processo,
+    l'evento resta 'queued' per il processo che possiede lo shard.
+    """
+    event_id = uuid.uuid4().hex
+    shard_id = await _shard_for_user(user_id)
+    if _queue is None or not shards.is_local(shard_id):
+        await storage.inbox_add(event_id, event_type, user_id, body, status="queued", shard_id=shard_id)
+    else:
+        await storage.inbox_add(event_id, event_type, user_id, body, shard_id=shard_id if shard_id is not None else shards.home)
+        _queue.put_nowait((event_id, event_type, user_id, body, 0))
+    inbox_stats["received"] += 1
+    return event_id
+
+async def _shard_for_user(user_id: str) -> int | None:
+    if shards.count <= 1:
+        return None
+    session = await storage.get_user_session(user_id)
+    return shards.shard_for_guild(session.get("guild_id")) if session else None
+
+def depth() -> int:
+    return (_queue.qsize() if _queue is not None else 0) + len(_sending)
+
+def shared_inbox() -> bool:
+    """True se altri processi (ingresso, altri shard) possono salvare eventi 'queued' per questo."""
+    return WEBHOOK_PROCESSES > 0 or not WEBHOOK_LISTEN or shards.partial
+
+async def start(dispatcher, workers: int = INBOX_WORKERS, poll: bool | None = None):
+    """
+    Avvia i worker. `dispatcher(event_type, user_id, body)` deve restituire
+    {"status": ..., "text": ...}: status >= 500 o un'eccezione causano un retry.
+    Se il risultato contiene "sent" (un awaitable), l'evento resta in sospeso finché
+    l'invio non termina e il worker passa subito al successivo.
+    Gli eventi rimasti 'pending' da un'esecuzione precedente vengono rimessi in coda.
+    Con `poll` (di default solo se shared_inbox()) gli eventi 'queued' degli altri processi
+    vengono prelevati ogni INBOX_POLL_MS; senza, solo quelli già presenti all'avvio.
+    """
+    global _queue, _dispatcher, _closing
+    if _workers:
+        return
+    _closing = False
+
+    _queue = asyncio.Queue()
+    _dispatcher = dispatcher
+
+    pending = await storage.inbox_pending()
+    for event_id, event_type, user_id, body, attempts, next_attempt_at in pending:
+        _schedule((event_id, event_type, user_id, body, attempts), next_attempt_at - time.time())
+    if pending:
+        logging.info(f"📥 Inbox: {len(pending)} webhook in sospeso rimessi in coda")
+
+    for n in range(max(1, workers)):
+        _workers.append(asyncio.create_task(_worker(n)))
+    if poll is None:
+        poll = shared_inbox()
+    if poll:
+        _workers.append(asyncio.create_task(_poll()))
+    else:
+        # Processo unico: nessun altro scrive righe 'queued', restano solo quelle di un'esecuzione precedente
+        while await _claim() >= INBOX_POLL_BATCH:
+            pass
+    logging.info(f"📥 Inbox avviata con {max(1, workers)} worker")
+
+async def stop(timeout: float = 0):
+    """
+    Ferma i worker. Quelli che stanno consegnando un evento, e gli invii già accodati, hanno
+    `timeout` secondi per finire: un evento già inviato a Discord non resta 'pending' e non
+    viene reinviato al riavvio. Gli eventi ancora in coda restano nel DB e ripartono al prossimo avvio.
+    """
+    global _closing
+    _closing = True
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    idle = [task for task in _workers if task not in _busy]
+    for task in idle:
+        task.cancel()
+    # Prima i worker (che possono ancora accodare invii), poi gli invii
+    late = await _wait_or_cancel([task for task in _workers if task in _busy], deadline - loop.time())
+    late += await _wait_or_cancel(list(_sending), deadline - loop.time())
+    if late:
+        logging.warning(f"⚠️ Inbox: {late} consegne interrotte alla chiusura")
+    await asyncio.gather(*idle, return_exceptions=True)
+    _workers.clear()
+
+async def _wait_or_cancel(tasks: list[asyncio.Task], timeout: float) -> int:
+    late = set(tasks)
+    if tasks and timeout > 0:
+        _, late = await asyncio.wait(tasks, timeout=timeout)
+    for task in late:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    return len(late)
+
+def _schedule(item: tuple, delay: float):
+    if delay > 0:
+        asyncio.get_running_loop().call_later(delay, _queue.put_nowait, item)
+    else:
+        _queue.put_nowait(item)
+
+async def _poll():
+    # Query sull'indice (status, next_attempt_at): a vuoto costa una lettura per intervallo
+    while True:
+        # Se il batch è pieno ci sono altri eventi in attesa: niente pausa
+        if await _claim() < INBOX_POLL_BATCH:
+            await asyncio.sleep(INBOX_POLL_MS / 1000)
+
+async def _claim() -> int:
+    try:
+        claimed = await storage.inbox_claim(INBOX_POLL_BATCH)
+    except Exception as e:
+        logging.warning(f"⚠️ Polling inbox fallito: {e}")
+        return 0
+    for event_id, event_type, user_id, body in claimed:
+        inbox_stats["received"] += 1
+        _queue.put_nowait((event_id, event_type, user_id, body, 0))
+    return len(claimed)
+
+async def _worker(n: int):
+    task = asyncio.current_task()
+    while not _closing:
+        item = await _queue.get()
+        _busy.add(task)
+        try:
+            await _process(item)
+        except Exception as e:
+            logging.exception(f"💥 Errore nel worker inbox #{n}: {e}")
+        finally:
+            _busy.discard(task)
+            _queue.task_done()
+
+async def _process(item: tuple):
+    try:
+        result = await _dispatcher(*item[1:4])
+        error = result["text"] if result["status"] >= 500 else None
+    except Exception as e:
+        result, error = {}, f"{type(e).__name__}: {e}"
+
+    if error is None and result.get("sent") is not None:
+        task = asyncio.create_task(_await_sent(item, result["sent"]))
+        _sending.add(task)
+        task.add_done_callback(_sending.discard)
+        return
+    await _settle(item, error)
+
+async def _await_sent(item: tuple, sent):
+    try:
+        await sent
+        error = None
+    except Exception as e:
+        error = f"{type(e).__name__}: {e}"
+    await _settle(item, error)
+
+async def _settle(item: tuple, error: str | None):
+    """Evento consegnato (error None), da ritentare o da scartare dopo INBOX_MAX_ATTEMPTS."""
+    event_id, event_type, user_id, body, attempts = item
+    if error is None:
+        inbox_stats["processed"] += 1
+        await storage.inbox_done(event_id)
+        return
+
+    attempts += 1
+    if attempts >= INBOX_MAX_ATTEMPTS:
+        inbox_stats["dead"] += 1
+        await storage.inbox_dead(event_id, attempts, error)
+        logging.error(f"☠️ Webhook {event_id} ({event_type}, user_id={user_id}) scartato dopo {attempts} tentativi: {error}")
+        return
+
+    delay = backoff_delay(attempts, INBOX_RETRY_BASE, INBOX_RETRY_MAX)
+    inbox_stats["retried"] += 1
+    await storage.inbox_retry(event_id, attempts, time.time() + delay, error)
+    _schedule((event_id, event_type, user_id, body, attempts), delay)
+    logging.warning(f"🔁 Webhook {event_id} ({event_type}) fallito, nuovo tentativo {attempts + 1} tra {delay:.1f}s: {error}")
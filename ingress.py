@@ -0,0 +1,288 @@
+"""
+Ingresso HTTP dei webhook UEX.
+
+Di default gira nel processo del bot. Con WEBHOOK_PROCESSES=N il bot avvia N processi
+`python ingress.py --worker <n>` che condividono la porta con SO_REUSEPORT e salvano
+gli eventi nell'inbox SQLite; il processo del gateway li preleva con un polling
+indicizzato e resta libero per heartbeat ed eventi Discord.
+"""
+import os
+import sys
+import json
+import math
+import time
+import signal
+import asyncio
+import logging
+import argparse
+
+from aiohttp import web
+
+import inbox
+import dedup
+import metrics
+import storage
+import event_types
+import logging_setup
+from cache import TTLCache
+from ratelimit import TokenBucket
+from logging_setup import SAMPLED, log_context
+from metrics import WEBHOOK_REQUESTS, WEBHOOK_LATENCY, WEBHOOK_REJECTED
+from config import (
+    LOG_PATH, WEBHOOK_PORT, WEBHOOK_MAX_CONCURRENCY, WEBHOOK_MAX_BODY, WEBHOOK_MAX_BACKLOG,
+    WEBHOOK_USER_RATE, WEBHOOK_USER_BURST, SHUTDOWN_TIMEOUT, SHUTDOWN_READY_DELAY,
+)
+
+
+# ---------- HTTP/Aiohttp webhook ----------
+# Tipi evento non registrati finiscono nella label "other" per non far esplodere le serie delle metriche
+def metric_event_type(event_type: str) -> str:
+    return event_type if event_types.is_registered(event_type) else "other"
+
+async def handle_webhook(request):
+    start = time.perf_counter()
+    with log_context(event_type=request.match_info["event_type"], user_id=request.match_info["user_id"]):
+        response = await accept_webhook(request)
+    event_label = metric_event_type(request.match_info["event_type"])
+    WEBHOOK_REQUESTS.inc(event_type=event_label, status=response.status)
+    WEBHOOK_LATENCY.observe(time.perf_counter() - start, event_type=event_label)
+    return response
+
+async def accept_webhook(request):
+    try:
+
+        event_type = request.match_info["event_type"]
+        user_id = request.match_info["user_id"]
+        try:
+            body = await request.text()
+        except web.HTTPRequestEntityTooLarge:
+            # Body senza Content-Length: il limite scatta durante la lettura
+            return _reject("too_large", 413, "body too large")
+        try:
+            data = json.loads(body) if body else {}
+        except ValueError:
+            logging.warning(f"⚠️ Webhook con JSON non valido: event='{event_type}' → user_id={user_id}")
+            return web.Response(status=400, text="invalid JSON body")
+
+        # Retry di UEX e webhook gemelli vengono scartati prima di toccare inbox e Discord
+        fp = dedup.fingerprint(event_type, user_id, data if isinstance(data, dict) else {})
+        if await dedup.is_duplicate(fp):
+            logging.info(f"♻️ Webhook duplicato scartato: event='{event_type}' → user_id={user_id}", extra=SAMPLED)
+            return web.Response(status=200, text="duplicate")
+
+        # ACK immediato: l'evento è già salvato nell'inbox, i worker lo consegnano a Discord
+        try:
+            event_id = await inbox.enqueue(event_type, user_id, body)
+        except Exception:
+            # Non accettato: il ritrasmesso di UEX non deve risultare duplicato
+            await dedup.forget(fp)
+            raise
+        logging.info(f"📥 Webhook accodato {event_id}: event='{event_type}' → user_id={user_id}", extra=SAMPLED)
+        return web.Response(status=202, text="accepted")
+    except Exception as e:
+        logging.exception(f"💥 Errore handler aiohttp: {e}")
+        return web.Response(status=500, text=f"Error: {e}")
+
+async def handle_health(response):
+	return web.Response(status=200, text=f"online")
+
+async def handle_ready(request):
+    # /health dice solo che il processo è vivo; /ready se accetta webhook (no durante l'avvio e lo spegnimento)
+    if not _accepting:
+        return web.Response(status=503, text="draining" if _draining else "starting")
+    return web.Response(status=200, text="ready")
+
+async def handle_metrics(request):
+    return web.Response(text=metrics.render(), content_type="text/plain", charset="utf-8",
+                        headers={"X-Prometheus-Format": "0.0.4"})
+
+
+# ---------- Backpressure ----------
+# Il rate per user_id isola un mittente in loop; il limite di richieste in corso e quello
+# sulla coda proteggono tutti gli altri. Meglio un 429/503 con Retry-After subito che un
+# ACK lento per tutti: UEX ritrasmette e il dedup scarta i doppioni.
+_user_buckets = TTLCache(maxsize=100000, ttl=600)
+_inflight = 0
+_accepting = False
+_draining = False
+# Nei processi di ingresso inbox e coda di scrittura locali sono quasi vuote: la coda vera
+# sono le righe 'queued' nel DB, rilette al più ogni BACKLOG_REFRESH secondi
+BACKLOG_REFRESH = 1.0
+_ingress_process = False
+_queued = 0
+_queued_at = 0.0
+overload_stats = {"rate_limited": 0, "overloaded": 0, "backlog": 0, "too_large": 0, "draining": 0}
+
+def _reject(reason: str, status: int, text: str, retry_after: float | None = None) -> web.Response:
+    overload_stats[reason] += 1
+    WEBHOOK_REJECTED.inc(reason=reason)
+    # Con WEBHOOK_USER_RATE=0 l'attesa è infinita: si indica comunque un valore finito
+    headers = {"Retry-After": str(max(1, math.ceil(min(retry_after, 3600))))} if retry_after is not None else None
+    return web.Response(status=status, text=text, headers=headers)
+
+async def backlog() -> int:
+    global _queued, _queued_at
+    if _ingress_process and time.monotonic() - _queued_at >= BACKLOG_REFRESH:
+        # Aggiornato prima della query: le richieste concorrenti usano il valore precedente
+        _queued_at = time.monotonic()
+        try:
+            _queued = await storage.inbox_queued()
+        except Exception as e:
+            logging.warning(f"⚠️ Conteggio degli eventi in coda fallito: {e}")
+    return inbox.depth() + storage.pending_writes() + (_queued if _ingress_process else 0)
+
+def _user_bucket(user_id: str) -> TokenBucket:
+    bucket = _user_buckets.get(user_id)
+    if bucket is None:
+        bucket = TokenBucket(WEBHOOK_USER_RATE, WEBHOOK_USER_BURST)
+        _user_buckets.set(user_id, bucket)
+    return bucket
+
+@web.middleware
+async def backpressure(request, handler):
+    global _inflight
+    user_id = request.match_info.get("user_id")
+    if user_id is None:
+        # /health e /metrics non sono limitati
+        return await handler(request)
+
+    if _draining:
+        # In chiusura: UEX (o nginx con proxy_next_upstream http_503) riprova altrove
+        return _reject("draining", 503, "shutting down", 5)
+    if request.content_length is not None and request.content_length > WEBHOOK_MAX_BODY:
+        return _reject("too_large", 413, "body too large")
+    if await backlog() >= WEBHOOK_MAX_BACKLOG:
+        return _reject("backlog", 503, "backlog full", 5)
+    if _inflight >= WEBHOOK_MAX_CONCURRENCY:
+        return _reject("overloaded", 503, "overloaded", 1)
+    # Il token si consuma per ultimo: un 503 non deve togliere burst ai retry di UEX
+    wait = _user_bucket(user_id).try_take()
+    if wait > 0:
+        logging.info(f"🚦 Webhook oltre il limite per user_id={user_id}", extra=SAMPLED)
+        return _reject("rate_limited", 429, "rate limited", wait)
+
+    _inflight += 1
+    try:
+        return await handler(request)
+    finally:
+        _inflight -= 1
+
+
+def create_app(webhooks: bool = True) -> web.Application:
+    """Con webhooks=False espone solo /health e /metrics (processo gateway in modalità multi-processo)."""
+    app = web.Application(middlewares=[backpressure], client_max_size=WEBHOOK_MAX_BODY)
+    if webhooks:
+        app.router.add_post("/webhook/{event_type}/{user_id}", handle_webhook)
+    app.router.add_get("/health",handle_health)
+    app.router.add_get("/ready", handle_ready)
+    app.router.add_get("/metrics", handle_metrics)
+    return app
+
+async def start_server(app: web.Application, port: int = WEBHOOK_PORT, reuse_port: bool = False) -> web.AppRunner:
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, "0.0.0.0", port, reuse_port=reuse_port)
+    await site.start()
+    set_accepting(True)
+    logging.info(f"🚀 Server HTTP/1.1 (aiohttp) avviato su porta {port}")
+    return runner
+
+
+# ---------- Spegnimento ----------
+def on_stop_signal(callback):
+    """Chiama `callback` nel loop corrente a SIGTERM/SIGINT, anche dove add_signal_handler manca (Windows)."""
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        try:
+            loop.add_signal_handler(sig, callback)
+        except NotImplementedError:
+            signal.signal(sig, lambda signum, frame: loop.call_soon_threadsafe(callback))
+
+def set_accepting(accepting: bool):
+    global _accepting
+    _accepting = accepting and not _draining
+
+async def drain(runner: web.AppRunner, timeout: float = SHUTDOWN_TIMEOUT):
+    """
+    Chiusura senza perdite: /ready passa a 503, i nuovi webhook ricevono 503 con Retry-After,
+    quelli già in corso finiscono (fino a `timeout`) e solo allora si chiude il listener.
+    Un webhook con 202 è già nell'inbox, quindi non va perso.
+    """
+    global _draining, _accepting
+    _draining, _accepting = True, False
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    # Tempo per i load balancer che interrogano /ready di togliere il processo dal pool
+    await asyncio.sleep(min(SHUTDOWN_READY_DELAY, timeout))
+    while _inflight and loop.time() < deadline:
+        await asyncio.sleep(0.05)
+    if _inflight:
+        logging.warning(f"⚠️ {_inflight} webhook ancora in corso alla chiusura del server")
+    await runner.cleanup()
+    logging.info("🛑 Server webhook chiuso")
+
+
+# ---------- Processi di ingresso ----------
+_processes: dict[int, asyncio.subprocess.Process] = {}
+_supervisors: list[asyncio.Task] = []
+
+async def spawn_workers(count: int):
+    """Avvia `count` processi di ingresso e li riavvia se terminano."""
+    for worker in range(count):
+        _supervisors.append(asyncio.create_task(_supervise(worker)))
+
+async def stop_workers(timeout: float = SHUTDOWN_TIMEOUT):
+    """SIGTERM ai processi di ingresso, che fanno il loro drain; oltre `timeout` vengono terminati."""
+    for task in _supervisors:
+        task.cancel()
+    await asyncio.gather(*_supervisors, return_exceptions=True)
+    _supervisors.clear()
+    for process in _processes.values():
+        if process.returncode is None:
+            process.terminate()
+    try:
+        await asyncio.wait_for(
+            asyncio.gather(*(process.wait() for process in _processes.values()), return_exceptions=True), timeout + 5
+        )
+    except asyncio.TimeoutError:
+        for process in _processes.values():
+            if process.returncode is None:
+                process.kill()
+    _processes.clear()
+
+async def _supervise(worker: int):
+    script = os.path.abspath(__file__)
+    while True:
+        process = await asyncio.create_subprocess_exec(sys.executable, script, "--worker", str(worker))
+        _processes[worker] = process
+        logging.info(f"🧩 Processo di ingresso #{worker} avviato (pid {process.pid})")
+        code = await process.wait()
+        logging.error(f"💥 Processo di ingresso #{worker} terminato (codice {code}), riavvio tra 1s")
+        await asyncio.sleep(1)
+
+async def serve(worker: int, port: int):
+    global _ingress_process
+    _ingress_process = True
+    # Lo schema è già migrato dal processo gateway prima di avviare i worker; le letture
+    # qui sono solo dedup e conteggio della coda, basta un reader
+    await storage.open_db(migrate=False, readers=1)
+    runner = await start_server(create_app(), port, reuse_port=True)
+
+    stop = asyncio.Event()
+    on_stop_signal(stop.set)
+    await stop.wait()
+
+    logging.info(f"🛑 Processo di ingresso #{worker} in chiusura")
+    await drain(runner)
+    await storage.close_db()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Processo di ingresso dei webhook UEX")
+    parser.add_argument("--worker", type=int, default=0)
+    parser.add_argument("--port", type=int, default=WEBHOOK_PORT)
+    args = parser.parse_args()
+
+    # Un file per processo: la rotazione di un RotatingFileHandler non è sicura tra processi
+    logging_setup.setup_logging(f"{LOG_PATH}.ingress-{args.worker}" if LOG_PATH else None)
+    asyncio.run(serve(args.worker, args.port))
@@ -0,0 +1,112 @@
+import time
+import asyncio
+import logging
+
+import discord
+
+import storage
+from sharding import shards
+from threads import resolver
+from ratelimit import TokenBucket
+from config import (
+    JANITOR_INTERVAL, JANITOR_BATCH, LINK_RETENTION_DAYS, SESSION_RETENTION_DAYS, NOTIFICATION_RETENTION_DAYS,
+    FAILED_RETENTION_DAYS, JANITOR_RECONCILE_RATE, JANITOR_RECONCILE_BATCH, JANITOR_VACUUM_PAGES,
+)
+
+
+# ---------- Janitor ----------
+# Passata periodica di manutenzione: elimina link, sessioni, notifiche, webhook 'dead' e risposte
+# fallite scaduti a piccoli batch, verifica che i thread delle sessioni esistano ancora (a velocità
+# limitata, riprendendo da dove si era fermata) e restituisce le pagine libere con l'incremental vacuum.
+_task: asyncio.Task | None = None
+_cursor = 0     # ultimo rowid di sessions verificato
+janitor_stats = {
+    "runs": 0, "links_expired": 0, "sessions_expired": 0, "notifications_expired": 0,
+    "dead_events_expired": 0, "failed_replies_expired": 0, "threads_checked": 0, "threads_missing": 0,
+}
+
+DAY = 86400
+
+
+def start(interval: float = JANITOR_INTERVAL):
+    global _task
+    if _task is None:
+        _task = asyncio.create_task(_run(interval))
+
+async def stop():
+    global _task
+    if _task is not None:
+        _task.cancel()
+        await asyncio.gather(_task, return_exceptions=True)
+        _task = None
+
+async def _run(interval: float):
+    # Prima passata dopo l'avvio, lasciando al bot il tempo di connettersi e riempire la cache
+    await asyncio.sleep(min(interval, 60))
+    while True:
+        try:
+            await run_once()
+        except Exception as e:
+            logging.exception(f"💥 Errore nel janitor: {e}")
+        await asyncio.sleep(interval)
+
+async def run_once():
+    start_time = time.perf_counter()
+    now = time.time()
+    links = await _expire(storage.expire_negotiation_links, now - LINK_RETENTION_DAYS * DAY, "links_expired")
+    sessions = 0
+    if SESSION_RETENTION_DAYS > 0:
+        sessions = await _expire(storage.expire_sessions, now - SESSION_RETENTION_DAYS * DAY, "sessions_expired")
+    notifications = await _expire(
+        storage.expire_notification_messages, now - NOTIFICATION_RETENTION_DAYS * DAY, "notifications_expired"
+    )
+    # Restano per un po' a disposizione di chi indaga, poi vanno: altrimenti crescono senza limite
+    dead_events = await _expire(storage.expire_inbox_dead, now - FAILED_RETENTION_DAYS * DAY, "dead_events_expired")
+    failed_replies = await _expire(storage.expire_outbox_failed, now - FAILED_RETENTION_DAYS * DAY, "failed_replies_expired")
+    missing = await reconcile_threads()
+    free_pages = await storage.incremental_vacuum(JANITOR_VACUUM_PAGES)
+    janitor_stats["runs"] += 1
+    logging.info(
+        f"🧹 Janitor: {links} link, {sessions} sessioni, {notifications} notifiche, {dead_events} webhook 'dead' e "
+        f"{failed_replies} risposte fallite scaduti, {missing} thread inesistenti, "
+        f"{free_pages} pagine libere ({time.perf_counter() - start_time:.1f}s)"
+    )
+
+async def _expire(expire, before: float, stat: str) -> int:
+    total = 0
+    while True:
+        removed = await expire(before, JANITOR_BATCH)
+        total += len(removed)
+        if len(removed) < JANITOR_BATCH:
+            break
+        # Tra un batch e l'altro il writer resta libero per le scritture dei webhook
+        await asyncio.sleep(0)
+    janitor_stats[stat] += total
+    return total
+
+async def reconcile_threads(limit: int = JANITOR_RECONCILE_BATCH, rate: float = JANITOR_RECONCILE_RATE) -> int:
+    """
+    Verifica fino a `limit` sessioni. I thread nella cache del gateway si considerano vivi;
+    gli altri passano dal resolver (che rimuove le sessioni dei thread eliminati) al
+    massimo `rate` volte al secondo, senza riempire la cache dei thread.
+    """
+    global _cursor
+    if not resolver.client.is_ready():
+        # Senza la cache del gateway ogni thread richiederebbe una fetch
+        return 0
+    rows = await storage.session_threads_after(_cursor, limit)
+    _cursor = rows[-1][0] if len(rows) == limit else 0
+    bucket = TokenBucket(rate, 1)
+    missing = 0
+    for _, thread_id, guild_id in rows:
+        if not shards.owns(guild_id) or resolver.client.get_channel(thread_id) is not None:
+            continue
+        await bucket.acquire()
+        janitor_stats["threads_checked"] += 1
+        try:
+            if await resolver.resolve(thread_id, unarchive=False, cache=False) is None:
+                missing += 1
+        except discord.HTTPException as e:
+            logging.warning(f"⚠️ Verifica del thread {thread_id} non riuscita: {e}")
+    janitor_stats["threads_missing"] += missing
+    return missing
@@ -0,0 +1,159 @@
+import re
+import sys
+import json
+import queue
+import atexit
+import random
+import logging
+import contextlib
+import contextvars
+import logging.handlers
+from datetime import datetime, timezone
+
+from config import LOG_PATH, LOG_LEVEL, LOG_FORMAT, LOG_MAX_BYTES, LOG_BACKUPS, LOG_SAMPLE_RATE
+from metrics import LOG_RECORDS_SAMPLED_OUT
+
+
+# ---------- Logging non bloccante ----------
+# Il loop asyncio mette solo il record in una coda in memoria: formattazione,
+# redazione dei segreti e scrittura su disco avvengono nel thread del QueueListener.
+_listener: logging.handlers.QueueListener | None = None
+
+TEXT_FORMAT = "%(asctime)s [%(levelname)s] %(message)s"
+
+# Da passare come extra= ai log INFO ripetuti per ogni webhook: vengono campionati
+SAMPLED = {"sampled": True}
+
+CONTEXT_FIELDS = ("event_type", "user_id", "negotiation_hash")
+_context: contextvars.ContextVar[dict] = contextvars.ContextVar("log_context", default={})
+
+
+# ---------- Contesto strutturato ----------
+@contextlib.contextmanager
+def log_context(**fields):
+    """I record emessi nel blocco (anche da altri moduli) riportano questi campi."""
+    token = _context.set({**_context.get(), **fields})
+    try:
+        yield
+    finally:
+        _context.reset(token)
+
+def bind_log_context(**fields):
+    """Aggiunge campi al contesto corrente; vengono rimossi all'uscita del log_context che lo contiene."""
+    _context.set({**_context.get(), **fields})
+
+
+class _ContextFilter(logging.Filter):
+    # Gira nel thread che logga: è l'unico punto in cui il contextvar è visibile
+    def filter(self, record: logging.LogRecord) -> bool:
+        for name, value in _context.get().items():
+            if value is not None and not hasattr(record, name):
+                setattr(record, name, value)
+        return True
+
+
+class _SamplingFilter(logging.Filter):
+    # WARNING e superiori passano sempre, i log INFO marcati SAMPLED solo in parte
+    def __init__(self, rate: float):
+        super().__init__()
+        self.rate = rate
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if self.rate >= 1 or record.levelno > logging.INFO or not getattr(record, "sampled", False):
+            return True
+        if random.random() < self.rate:
+            return True
+        LOG_RECORDS_SAMPLED_OUT.inc()
+        return False
+
+
+# ---------- Redazione segreti ----------
+_SECRET_PATTERNS = (
+    # bearer:<token> secret:<key>, secret_key=..., 'bearer_token': '...', "Authorization": "..."
+    re.compile(r"""(?i)(['"]?\b(?:bearer[_-]?token|secret[_-]?key|secret|bearer|authorization|password|token)\b['"]?\s*[:=]\s*['"]?(?:bearer\s+)?)([^\s'",}<>]+)"""),
+    # Authorization: Bearer <token> senza chiave davanti
+    re.compile(r"(?i)(\bbearer\s+)([A-Za-z0-9._~+/=-]{8,})"),
+)
+
+def redact(text: str) -> str:
+    for pattern in _SECRET_PATTERNS:
+        text = pattern.sub(r"\1***", text)
+    return text
+
+
+class _RedactingFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        return redact(super().format(record))
+
+
+class _JsonFormatter(logging.Formatter):
+    """Una riga JSON per record, con i campi di contesto al primo livello."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": redact(record.getMessage()),
+        }
+        for name in CONTEXT_FIELDS:
+            value = getattr(record, name, None)
+            if value is not None:
+                entry[name] = str(value)
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry["exc"] = redact(record.exc_text)
+        return json.dumps(entry, ensure_ascii=False)
+
+
+class _QueueHandler(logging.handlers.QueueHandler):
+    # La formattazione resta al listener: qui si risolvono solo gli argomenti del messaggio
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record = logging.makeLogRecord(record.__dict__)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+# ---------- Setup ----------
+def setup_logging(path: str | None = LOG_PATH):
+    """Sostituisce gli handler del root logger con una QueueHandler; idempotente."""
+    global _listener
+    if _listener is not None:
+        return
+
+    # Un solo handler, dietro la coda e i filtri: il file se LOG_PATH è impostato, altrimenti stderr
+    if path:
+        handler = logging.handlers.RotatingFileHandler(
+            path, maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUPS, encoding="utf-8"
+        )
+        handler.setFormatter(_JsonFormatter() if LOG_FORMAT == "json" else _RedactingFormatter(TEXT_FORMAT))
+    else:
+        handler = logging.StreamHandler(sys.stderr)
+        handler.setFormatter(_RedactingFormatter(TEXT_FORMAT))
+
+    log_queue = queue.SimpleQueue()
+    queue_handler = _QueueHandler(log_queue)
+    queue_handler.addFilter(_SamplingFilter(LOG_SAMPLE_RATE))
+    queue_handler.addFilter(_ContextFilter())
+
+    root = logging.getLogger()
+    for existing in list(root.handlers):
+        root.removeHandler(existing)
+    root.addHandler(queue_handler)
+    root.setLevel(LOG_LEVEL)
+
+    _listener = logging.handlers.QueueListener(log_queue, handler, respect_handler_level=True)
+    _listener.start()
+    atexit.register(stop_logging)
+
+def stop_logging():
+    """Svuota la coda e ferma il thread di scrittura."""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
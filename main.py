@@ -1,146 +1,85 @@
-import os
 import re
 import json
+import hashlib
 import asyncio
 import logging
-from datetime import datetime
-
-import aiohttp
-import aiosqlite
-from aiohttp import web
 
 import discord
 from discord import app_commands, ui
 from discord.ext import commands
 
-from dotenv import load_dotenv
-import directory  # contiene ALL_API_URL
-
-
-# ---------- Config ----------
-load_dotenv()
-DISCORD_TOKEN = os.getenv("DISCORD_TOKEN")
-TUNNEL_URL = os.getenv("TUNNEL_URL")
-DB_PATH = os.getenv("DB_PATH")
-LOG_PATH = os.getenv("LOG_PATH")
-
-# ---------- Logging ----------
-logging.basicConfig(
-    filename=LOG_PATH,
-    level=logging.INFO,
-    filemode='a',
-    format="%(asctime)s [%(levelname)s] %(message)s"
+import inbox
+import janitor
+import events
+import metrics
+import dedup
+import ingress
+import logging_setup
+import reply_outbox
+from sender import scheduler
+from unread import indicator as unread
+from routing import index as routing
+from sharding import shards
+from threads import resolver
+from poller import poller
+from digest import digests
+from metrics import WEBHOOK_PROCESSING, QUEUE_DEPTH
+from uex_client import client as uex, CircuitOpenError
+from logging_setup import SAMPLED, log_context, bind_log_context
+from config import DISCORD_TOKEN, TUNNEL_URL, WEBHOOK_PORT, WEBHOOK_PROCESSES, WEBHOOK_LISTEN, METRICS_PORT, DISCORD_SHARDED, SHARD_COUNT, SHARD_IDS, POLL_ENABLED, DIGEST_MAX_MINUTES, SHUTDOWN_TIMEOUT
+from storage import (
+    open_db, close_db, get_meta, set_meta, get_user_session, save_user_session, remove_user_session, remove_sessions_by_thread,
+    get_user_thread_id, touch_session, get_notification_hash, save_notification_message, count_sessions, session_cache, warm_routing_index, pending_writes,
 )
 
-# ---------- DB globale ----------
-db_conn: aiosqlite.Connection = None
-db_lock = asyncio.Lock()
 
-# ---------- Sessione HTTP globale ----------
-aiohttp_session = None
+# ---------- Logging ----------
+logging_setup.setup_logging()
+
+# ---------- Metriche ----------
+QUEUE_DEPTH.set_function(inbox.depth, queue="webhook_inbox")
+QUEUE_DEPTH.set_function(scheduler.depth, queue="discord_send")
+QUEUE_DEPTH.set_function(unread.pending, queue="thread_renames")
+QUEUE_DEPTH.set_function(reply_outbox.depth, queue="reply_outbox")
+QUEUE_DEPTH.set_function(pending_writes, queue="db_writes")
+QUEUE_DEPTH.set_function(poller.pending, queue="notification_polls")
+QUEUE_DEPTH.set_function(digests.pending, queue="digest_events")
+metrics.install_discord_ratelimit_hook()
 
 # ---------- Discord Bot ----------
 intents = discord.Intents.default()
 intents.message_content = True
 intents.members = True
-bot = commands.Bot(command_prefix="!", intents=intents)
-
-# ---------- Inizializzazione DB ----------
-async def init_db():
-    global db_conn
-    os.makedirs(os.path.dirname(DB_PATH), exist_ok=True)
-    db_conn = await aiosqlite.connect(DB_PATH)
-    await db_conn.execute("PRAGMA journal_mode=WAL;")
-    await db_conn.execute("""
-        CREATE TABLE IF NOT EXISTS sessions (
-            user_id TEXT PRIMARY KEY,
-            uex_username TEXT NOT NULL,
-            session_data TEXT NOT NULL,
-            last_update TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-        )
-    """)
-    await db_conn.commit()
-    logging.info("📦 Database SQLite inizializzato in WAL mode")
-
-async def init_negotiation_links_table():
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute("""
-            CREATE TABLE IF NOT EXISTS negotiation_links (
-                negotiation_hash TEXT PRIMARY KEY,
-                buyer_id TEXT NOT NULL,
-                seller_id TEXT NOT NULL
-            )
-        """)
-        await db.commit()
-
-
-
-# ---------- Funzioni DB ----------
-async def get_user_session(user_id: str) -> dict | None:
-    async with db_lock:
-        async with db_conn.execute("SELECT session_data FROM sessions WHERE user_id=?", (user_id,)) as cursor:
-            row = await cursor.fetchone()
-            if row:
-                return json.loads(row[0])
-            return None
-
-async def save_user_session(user_id: str, session: dict):
-    async with db_lock:
-        data_json = json.dumps(session)
-        uex_username = session.get("uex_username", "")  # valore di default vuoto
-        await db_conn.execute(
-            "INSERT OR REPLACE INTO sessions (user_id, uex_username, session_data, last_update) VALUES (?, ?, ?, CURRENT_TIMESTAMP)",
-        (user_id,uex_username, data_json))
-        await db_conn.commit()
-        logging.info(f"💾 Sessione salvata per utente {user_id}")
-
-async def remove_user_session(user_id: str):
-    async with db_lock:
-        await db_conn.execute("DELETE FROM sessions WHERE user_id=?", (user_id,))
-        await db_conn.commit()
-        logging.info(f"🗑️ Sessione rimossa per utente {user_id}")
-
-async def get_user_thread_id(user_id: str) -> str | None:
-    session = await get_user_session(user_id)
-    if session:
-        return session.get("thread_id")
-    return None
-
+if DISCORD_SHARDED:
+    # Con SHARD_IDS ogni processo apre solo i suoi shard; SHARD_COUNT deve essere lo stesso ovunque
+    bot = commands.AutoShardedBot(command_prefix="!", intents=intents, shard_count=SHARD_COUNT, shard_ids=SHARD_IDS)
+else:
+    bot = commands.Bot(command_prefix="!", intents=intents)
+resolver.bind(bot)
+
+# ---------- Funzioni UEX ----------
 async def fetch_and_store_uex_username(user_id, secret_key, bearer_token, username_to_test):
     try:
-        timeout = aiohttp.ClientTimeout(total=15)  # ⏱️ aumenta timeout a 15s
-        headers = {
-            "Authorization": f"Bearer {bearer_token}",
-            "Content-Type": "application/json",
-        }
-
-        # Se abbiamo una secret key, usiamola come header
-        if secret_key:
-            headers["secret-key"] = secret_key
-            url = directory.API_GET_USER  # Non serve parametro username
-        else:
-            # Fallback: usiamo il parametro ?username=
-            url = f"{directory.API_GET_USER}?username={username_to_test}"
-
-        async with aiohttp.ClientSession(timeout=timeout) as session:
-            async with session.get(url, headers=headers) as resp:
-                text = await resp.text()
-                if resp.status != 200:
-                    logging.warning(f"⚠️ Errore fetch UEX user {user_id}: status={resp.status} text={text}")
-                    return None
+        status, text = await uex.get_user(str(user_id), bearer_token, secret_key, username_to_test)
+        if status != 200:
+            logging.warning(f"⚠️ Errore fetch UEX user {user_id}: status={status} text={text}")
+            return None
 
-                data = await resp.json()
-                username = data.get("data", {}).get("username") or data.get("username")
+        data = json.loads(text)
+        username = data.get("data", {}).get("username") or data.get("username")
 
-                # ✅ Aggiorna nel DB
-                session_data = await get_user_session(str(user_id))
-                if session_data:
-                    session_data["username"] = username
-                    await save_user_session(str(user_id), session_data)
-                    logging.info(f"💾 Username UEX salvato per {user_id}: {username}")
+        # ✅ Aggiorna nel DB
+        session_data = await get_user_session(str(user_id))
+        if session_data:
+            session_data["username"] = username
+            await save_user_session(str(user_id), session_data)
+            logging.info(f"💾 Username UEX salvato per {user_id}: {username}")
 
-                return username
+        return username
 
+    except CircuitOpenError:
+        logging.warning(f"🔌 UEX non disponibile, username non verificato per {user_id}")
+        return None
     except asyncio.TimeoutError:
         logging.error(f"⏱️ Timeout UEX API per utente {user_id}")
         return None
@@ -149,322 +88,47 @@ async def fetch_and_store_uex_username(user_id, secret_key, bearer_token, userna
         return None
 
 
-    """
-    Restituisce il thread_id associato all'username UEX, se esiste.
-    """
-    async with aiosqlite.connect(DB_PATH) as db:
-        async with db.execute("""
-            SELECT user_id, session_data
-            FROM sessions
-            WHERE uex_username = ?
-        """, (uex_username,)) as cursor:
-            row = await cursor.fetchone()
-
-            if not row:
-                logging.warning(f"⚠️ Nessuna sessione trovata per uex_username={uex_username}")
-                return None
-
-            user_id, session_json = row
-
-            try:
-                session = json.loads(session_json)
-            except Exception as e:
-                logging.error(f"💥 Errore nel parsing JSON di session_data per user_id={user_id}: {e}")
-                return None
-
-            thread_id = session.get("thread_id")
-            if thread_id:
-                logging.info(f"🧩 thread_id={thread_id} trovato per uex_username={uex_username} (user_id={user_id})")
-                return thread_id
-            else:
-                logging.warning(f"⚠️ Nessun thread_id nella sessione di {uex_username}")
-                return None
-
-
-
-
-async def save_negotiation_link(negotiation_hash: str, buyer_id: str, seller_id: str):
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute("""
-            INSERT OR REPLACE INTO negotiation_links (negotiation_hash, buyer_id, seller_id)        
-            VALUES (?, ?, ?)
-        """, (negotiation_hash, buyer_id, seller_id))
-        await db.commit()
-        logging.info(f"🔗 Link salvato: {negotiation_hash} → buyer={buyer_id}, seller={seller_id}")
-
-async def get_negotiation_link(negotiation_hash: str):
-    async with aiosqlite.connect(DB_PATH) as db:
-        async with db.execute("""
-            SELECT buyer_id, seller_id FROM negotiation_links WHERE negotiation_hash = ?
-        """, (negotiation_hash,)) as cursor:
-            row = await cursor.fetchone()
-            if row:
-                return {"buyer_id": row[0], "seller_id": row[1]}
-    return None
-
-async def delete_negotiation_link(negotiation_hash: str):
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute("DELETE FROM negotiation_links WHERE negotiation_hash = ?", (negotiation_hash,))
-        await db.commit()
-        logging.info(f"❌ Link eliminato: {negotiation_hash}")
-
-async def find_session_by_username(username: str):
-    async with aiosqlite.connect(DB_PATH) as db:
-        async with db.execute("""
-            SELECT user_id, session_data FROM sessions
-        """) as cursor:
-            async for row in cursor:
-                uid, session_json = row
-                session = json.loads(session_json)
-                if session.get("username") == username:
-                    return {"user_id": uid, **session}
-    return None
-
-
-async def handle_webhook_unificato(request, event_type: str, user_id: str):
+async def handle_webhook_unificato(event_type: str, user_id: str, body: str):
     try:
-        body = await request.text()
         data = json.loads(body) if body else {}
-        logging.info(f"📨 Webhook ricevuto: event='{event_type}' → user_id={user_id} → body: {data}")
-    
-        
-        if event_type == "negotiation_started":
-            
-            seller = data.get("listing_owner_username")
-            buyer = data.get("client_username")
-            hash = data.get("negotiation_hash")
-            
-            logging.info(f"🚀 Nuova negoziazione: hash: {hash} da {buyer}")
-
-            await save_negotiation_link(
-                    negotiation_hash=hash,
-                    buyer_id=buyer,
-                    seller_id=seller
-                )
-            
-            # Recupera sessione utente
-            thread_id = await get_user_thread_id(str(user_id))
-            if not thread_id:
-                logging.warning(f"⚠️ Nessun Thread_id Trovato per Seller: {seller}")
-                return {"status": 404, "text": "Seller_thread_id not found"}
-            
-            # Recupera Thread Seller
-            thread = bot.get_channel( thread_id )
-            if not thread:
-                logging.warning(f"⚠️ Thread non trovato per Seller: {seller}")
-                return {"status": 404, "text": "thread not found"}
-            
-            # Avviso al Venditore di una Nuova Trattativa
-            embed = discord.Embed(color=discord.Color.blue())
-            embed.set_footer(
-                text=f"Made with love by Passluk"
-            )
-            embed.title = "📢 Nuova negoziazione iniziata"
-            embed.description = (
-                f"👤 **{data.get('client_username', 'Anonimo')}**\n"
-                f"📦 **{data.get('listing_title', 'Sconosciuto')}**\n"
-                f"🔗 [Apri su UEX](https://uexcorp.space/marketplace/negotiate/hash/{data.get('negotiation_hash', '')})"
-            )
-            embed.color = discord.Color.green()
-            await thread.send(embed=embed)
-            logging.info(f"✅ Link creato tra buyer: {buyer} e seller: {seller}")
-            
-            
-        # === Caso 2: messaggio di reply ===
-        elif event_type == "user_reply":
-            
-            seller = data.get("listing_owner_username")
-            user = data.get("client_username")
-            hash = data.get("negotiation_hash")
-            
-            logging.info(f"💬 Webhook reply ricevuto → hash: {hash}, da user_id={user}")
-
-            link = await get_negotiation_link(hash)
-            if not link:
-                logging.warning(f"⚠️ Nessun collegamento trovato per negoziazione {hash}")
-                return {"status": 404, "text": "negotiation link not found"}
-            
-            if user == None:
-                logging.warning(f"Invalid Username")
-                return {"status": 404, "text": "Invalid Username"}
-            
-            
-
-            if user == seller:
-                # manda il mex al buyer
-                
-                buyer_username = link.get("buyer_id")
-                
-                
-                session_buyer = await find_session_by_username(buyer_username)
-                if not session_buyer:
-                    logging.warning(f"⚠️ Buyer_Session not found")
-                    return {"status": 404, "text": "Buyer_Sessions not found"}
-                
-                
-                buyer_thread_id = session_buyer.get("thread_id")
-                if not buyer_thread_id: 
-                    logging.warning(f"⚠️ Buyer_Thread_Id not found")
-                    return {"status": 404, "text": "Buyer_thread_id not found"}
-                
-                
-                # Recupera Thread Buyer
-                thread = bot.get_channel( buyer_thread_id )
-                if not thread:
-                    logging.warning(f"⚠️ Thread non trovato per Seller: {seller}")
-                    return {"status": 404, "text": "thread not found"}
-                
-                
-                
-                # Avviso al Buyer di una nuova Notifica
-                embed = discord.Embed(color=discord.Color.blue())
-                embed.set_footer(
-                    text=f"Made with love by Passluk"
-                )
-                embed.title = "💬 Nuovo messaggio"
-                embed.description = (
-                    f"👤 **{seller}** ha scritto:\n"
-                    f"> {data.get('message', '')}\n\n"
-                    f"📦 **{data.get('listing_title', 'Sconosciuto')}**\n"
-                    f"🔗 [Apri su UEX](https://uexcorp.space/marketplace/negotiate/hash/{hash})"
-                )
-                embed.color = discord.Color.gold()
-                await thread.send(embed=embed)
-
-            
-            
-            elif user != seller:
-                # manda un mex al seller
-                
-                
-                
-                # Recupera sessione utente
-                thread_id = await get_user_thread_id(str(user_id))
-                if not thread_id:
-                    logging.warning(f"⚠️ Nessun Thread_id Trovato per Seller: {seller}")
-                    return {"status": 404, "text": "Seller_thread_id not found"}
-                
-                # Recupera Thread Seller
-                thread = bot.get_channel( thread_id )
-                if not thread:
-                    logging.warning(f"⚠️ Thread non trovato per Seller: {seller}")
-                    return {"status": 404, "text": "thread not found"}
-                
-                # Avviso al Venditore di una Nuova Notifica
-                embed = discord.Embed(color=discord.Color.blue())
-                embed.set_footer(
-                    text=f"Made with love by Passluk"
-                )
-                embed.title = "💬 Nuovo messaggio"
-                embed.description = (
-                    f"👤 **{user}** ha scritto:\n"
-                    f"> {data.get('message', '')}\n\n"
-                    f"📦 **{data.get('listing_title', 'Sconosciuto')}**\n"
-                    f"🔗 [Apri su UEX](https://uexcorp.space/marketplace/negotiate/hash/{hash})"
-                )
-                embed.color = discord.Color.gold()
-                await thread.send(embed=embed)
-                
-            else:
-                logging.warning(f"⚠️ Username '{user}' non corrisponde né al buyer né al seller per hash={hash}")
-                return {"status": 400, "text": "Unknown message source"}
-            
-            
-            
-        # === Caso 3: negoziazione terminata ===
-        elif event_type in ("negotiation_completed_client", "negotiation_completed_advertiser"):
-
-            hash = data.get("negotiation_hash")
-            logging.info(f"🏁 Fine negoziazione → eliminazione link hash: {hash}")
-            
-            # Recupera sessione utente
-            thread_id = await get_user_thread_id(str(user_id))
-            if not thread_id:
-                logging.warning(f"⚠️ Nessun Thread_id Trovato per Seller: {seller}")
-                return {"status": 404, "text": "Seller_thread_id not found"}
-            
-            # Recupera Thread Seller
-            thread = bot.get_channel( thread_id )
-            if not thread:
-                logging.warning(f"⚠️ Thread non trovato per Seller: {seller}")
-                return {"status": 404, "text": "thread not found"}
-        
-
-            # Avviso al Venditore di una Nuova Trattativa
-            embed = discord.Embed(color=discord.Color.blue())
-            embed.set_footer(
-                text=f"Made with love by Passluk"
-            )
-            embed.title = f"✅ Negoziazione completata da {data.get('client_username', 'Anonimo')}"
-            embed.description = (
-                f"📦 **{data.get('listing_title', 'Sconosciuto')}**\n"
-                f"⭐ Valutazione: {data.get('rating_stars', 0)}\n"
-                f"💬 Commento: {data.get('rating_comments', 'Nessuno')}\n"
-                f"🔗 [Apri su UEX](https://uexcorp.space/marketplace/negotiate/hash/{hash})"
-            )
-            embed.color = discord.Color.red()
-            await delete_negotiation_link(hash)
-            await thread.send(embed=embed)
-            
-        
-        
-        else:
-            
-            # Recupera sessione utente
-            thread_id = await get_user_thread_id(str(user_id))
-            if not thread_id:
-                logging.warning(f"⚠️ Nessun Thread_id Trovato per Seller: {seller}")
-                return {"status": 404, "text": "Seller_thread_id not found"}
-            
-            # Recupera Thread Seller
-            thread = bot.get_channel( thread_id )
-            if not thread:
-                logging.warning(f"⚠️ Thread non trovato per Seller: {seller}")
-                return {"status": 404, "text": "thread not found"}
-            
-            # Avviso al Seller errore
-            embed = discord.Embed(color=discord.Color.blue())
-            embed.set_footer(
-                text=f"Made with love by Passluk"
-            )
-            embed.title = f"ℹ️ Evento: {event_type}"
-            embed.description = json.dumps(data, indent=2)
-            await thread.send(embed=embed)
+        if isinstance(data, dict):
+            bind_log_context(negotiation_hash=data.get("negotiation_hash"))
+        logging.info(f"📨 Webhook ricevuto: event='{event_type}' → user_id={user_id}", extra=SAMPLED)
+        logging.debug(f"📨 Body webhook: {data}")
 
-        logging.info(f"✅ Webhook elaborato con successo per event='{event_type}' → user_id={user_id}")
-        return {"status": 200, "text": "Webhook elaborato"}
+        # Handler, template e instradamento per tipo evento sono in events.py
+        result = await events.dispatch(event_type, user_id, data, resolve_channel)
+        if result["status"] == 200:
+            logging.info(f"✅ Webhook elaborato con successo per event='{event_type}' → user_id={user_id}", extra=SAMPLED)
+        return result
 
     except Exception as e:
         logging.exception(f"💥 Errore in handle_webhook_unificato: {e}")
         return {"status": 500, "text": f"internal error: {e}"}
         
 
-# ---------- HTTP/Aiohttp webhook ----------
-async def handle_webhook(request):
-    try:
-        
-        event_type = request.match_info["event_type"]
-        user_id = request.match_info["user_id"]
-        result = await handle_webhook_unificato(request, event_type, user_id)
-        logging.info(f"arrivata una richiesta utente: {user_id}")
-        return web.Response(status=result["status"], text=result["text"])
-    except Exception as e:
-        logging.exception(f"💥 Errore handler aiohttp: {e}")
-        return web.Response(status=500, text=f"Error: {e}")
+async def resolve_channel(thread_id: int):
+    guild_id = routing.guild_for_thread(thread_id)
+    if shards.owns(guild_id):
+        # Cache del gateway → cache TTL → fetch_channel limitato, con riapertura dei thread archiviati
+        return await resolver.resolve(thread_id)
+    # Thread di uno shard gestito da un altro processo: l'invio via REST non passa dal gateway
+    return bot.get_partial_messageable(thread_id, guild_id=guild_id, type=discord.ChannelType.private_thread)
+
+async def resolve_digest_channel(thread_id: int):
+    # I riepiloghi ricaricati dal DB all'avvio possono scadere prima del login
+    await bot.wait_until_ready()
+    return await resolve_channel(thread_id)
 
-async def handle_health(response):
-	return web.Response(status=200, text=f"online")
 
+# ---------- Dispatch webhook ----------
+# Ricezione HTTP, dedup e accodamento sono in ingress.py
+async def dispatch_webhook(event_type: str, user_id: str, body: str):
+    # Gli eventi salvati prima che il gateway sia pronto aspettano la cache dei canali
+    await bot.wait_until_ready()
+    with WEBHOOK_PROCESSING.time(event_type=ingress.metric_event_type(event_type)), log_context(event_type=event_type, user_id=user_id):
+        return await handle_webhook_unificato(event_type, user_id, body)
 
-async def start_aiohttp_server():
-    app = web.Application()
-    app.router.add_post("/webhook/{event_type}/{user_id}", handle_webhook)
-    app.router.add_get("/health",handle_health)
-    runner = web.AppRunner(app)
-    await runner.setup()
-    site = web.TCPSite(runner, "0.0.0.0", 20187)
-    await site.start()
-    logging.info("🚀 Server HTTP/1.1 (aiohttp) avviato su porta 20187")
 
 # ---------- Bottone per aprire thread ----------
 class OpenThreadButton(ui.View):
@@ -478,17 +142,20 @@ class OpenThreadButton(ui.View):
 
         try:
             thread_id = await get_user_thread_id(user_id)
-            if thread_id:
-                try:
-                    existing_thread = await interaction.client.fetch_channel(int(thread_id))
-                    if existing_thread and not existing_thread.archived:
-                        await interaction.response.send_message(
-                            "⚠️ Hai già una chat attiva! Controlla i tuoi thread privati.",
-                            ephemeral=True
-                        )
-                        return
-                except discord.NotFound:
-                    await remove_user_session(user_id)
+            # Un thread archiviato viene riaperto; se non esiste più il resolver rimuove la sessione
+            old_thread = await resolver.resolve(thread_id) if thread_id else None
+            # Archiviato e bloccato: il resolver non lo riapre e l'utente non può scriverci.
+            # Come per un Forbidden non è raggiungibile, quindi si crea una chat nuova
+            locked = isinstance(old_thread, discord.Thread) and old_thread.archived and old_thread.locked
+            if old_thread is not None and not locked:
+                await interaction.response.send_message(
+                    "⚠️ Hai già una chat attiva! Controlla i tuoi thread privati.",
+                    ephemeral=True
+                )
+                return
+            if locked:
+                resolver.forget(old_thread.id)
+                logging.info(f"🔒 Thread {old_thread.id} archiviato e bloccato → nuova chat per utente {user_id}")
 
             thread = await channel.create_thread(
                 name=f"Chat {interaction.user.name.capitalize()}",
@@ -496,7 +163,7 @@ class OpenThreadButton(ui.View):
                 invitable=False,
             )
             await thread.add_user(interaction.user)
-            session = {"thread_id": thread.id, "notifications": []}
+            session = {"thread_id": thread.id, "guild_id": thread.guild.id, "notifications": []}
             await save_user_session(user_id, session)
 
             invisible = "\u200B"
@@ -561,36 +228,124 @@ class OpenThreadButton(ui.View):
                 Il bot le userà solo per accedere alle tue notifiche personali su UEX.
                 """
             )
-            await interaction.response.send_message("✅ Thread creato! Controlla il tuo thread privato.", ephemeral=True)
+            if locked:
+                await interaction.response.send_message(
+                    "🔒 La tua chat precedente è stata bloccata: ne ho creata una nuova, rifai la configurazione lì.",
+                    ephemeral=True
+                )
+            else:
+                await interaction.response.send_message("✅ Thread creato! Controlla il tuo thread privato.", ephemeral=True)
 
         except Exception as e:
             logging.error(f"❌ Errore in open_thread: {e}")
             await interaction.response.send_message("❌ Si è verificato un errore durante la creazione del thread.", ephemeral=True)
 
-# ---------- Evento on_ready ----------
-@bot.event
-async def on_ready():
-    
-    show_logo()
-    
-    global aiohttp_session
+# ---------- Avvio ----------
+# L'avvio avviene una sola volta: DB, worker e server webhook partono prima del login,
+# setup_hook registra view e comandi prima della connessione al gateway, e on_ready
+# (che scatta anche a ogni riconnessione) non riapre più nulla.
+async def start_services():
     logging.info("🗂️ Avvio Database")
-    await init_db()
-    await init_negotiation_links_table()
+    await open_db()
+    await warm_routing_index()
     logging.info("✅ Database Avviato")
+    await inbox.start(dispatch_webhook)
+    await reply_outbox.start(update_reply_status)
 
-    if aiohttp_session is None:
-        aiohttp_session = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=5))
-        logging.info("🌐 Sessione aiohttp inizializzata")
+    await uex.start()
+    unread.start()
+    await digests.start(resolve_digest_channel)
+    janitor.start()
+    if POLL_ENABLED:
+        await poller.start()
 
-    logging.info(f"✅ Bot online come {bot.user}")
     logging.info(f"📡 URL base webhook: {TUNNEL_URL}")
     logging.info("🌐 Avvio server webhook...")
-    bot.loop.create_task(start_aiohttp_server())
-
+    global http_runner, loop_monitor
+    if not WEBHOOK_LISTEN:
+        # Processo shard secondario: i webhook li riceve un altro processo e arrivano dall'inbox condivisa
+        if METRICS_PORT:
+            http_runner = await ingress.start_server(ingress.create_app(webhooks=False), METRICS_PORT)
+    elif WEBHOOK_PROCESSES > 0:
+        # I webhook arrivano dai processi di ingresso tramite l'inbox: qui restano solo /health, /ready e /metrics
+        http_runner = await ingress.start_server(ingress.create_app(webhooks=False), METRICS_PORT)
+        await ingress.spawn_workers(WEBHOOK_PROCESSES)
+    else:
+        http_runner = await ingress.start_server(ingress.create_app(), WEBHOOK_PORT)
+    loop_monitor = asyncio.create_task(metrics.monitor_event_loop())
+
+# ---------- Spegnimento ----------
+# Ordine inverso all'avvio, con un'unica scadenza SHUTDOWN_TIMEOUT:
+# 1. niente più webhook (/ready a 503) e attesa di quelli in corso;
+# 2. stop di poller, janitor e monitor del loop, fine delle consegne, invio dei digest e degli invii in corso;
+# 3. scritture in coda committate, checkpoint del WAL, chiusura della sessione UEX e infine del bot.
+# Ciò che resta in coda è già nel DB e riparte al prossimo avvio.
+http_runner = None
+loop_monitor: asyncio.Task | None = None
+
+async def shutdown(timeout: float = SHUTDOWN_TIMEOUT):
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    remaining = lambda: max(0.0, deadline - loop.time())
+    logging.info(f"🛑 Spegnimento in corso (max {timeout:.0f}s)")
+
+    if WEBHOOK_LISTEN and WEBHOOK_PROCESSES > 0:
+        await ingress.stop_workers(remaining())
+    if http_runner is not None:
+        await ingress.drain(http_runner, remaining())
+
+    await poller.stop()
+    await janitor.stop()
+    if loop_monitor is not None:
+        loop_monitor.cancel()
+        await asyncio.gather(loop_monitor, return_exceptions=True)
+    # Prima l'inbox: gli eventi che termina possono ancora finire nei digest, inviati subito dopo
+    await inbox.stop(remaining())
+    await digests.stop(remaining())
+    await reply_outbox.stop(remaining())
+    left = await scheduler.drain(remaining())
+    if left:
+        logging.warning(f"⚠️ {left} embed non inviati alla chiusura")
+    await unread.stop()
+
+    await close_db()
+    await uex.close()
+    logging.info("👋 Spegnimento completato")
+
+def command_tree_hash() -> str:
+    """Hash delle definizioni dei comandi slash: cambia solo se cambiano nome, opzioni o permessi."""
+    payload = []
+    for command in bot.tree.get_commands():
+        try:
+            payload.append(command.to_dict(bot.tree))
+        except TypeError:
+            # discord.py < 2.4
+            payload.append(command.to_dict())
+    payload.sort(key=lambda item: item["name"])
+    return hashlib.sha256(json.dumps(payload, sort_keys=True).encode()).hexdigest()
+
+async def sync_command_tree():
+    key = f"command_tree_hash:{bot.application_id}"
+    tree_hash = command_tree_hash()
+    if await get_meta(key) == tree_hash:
+        logging.info("✅ Comandi invariati, sync saltato")
+        return
     await bot.tree.sync()
+    await set_meta(key, tree_hash)
     logging.info("✅ Commands synchronized.")
+
+async def setup_hook():
     bot.add_view(OpenThreadButton())
+    await sync_command_tree()
+
+bot.setup_hook = setup_hook
+
+# ---------- Evento on_ready ----------
+@bot.event
+async def on_ready():
+    # Scatta a ogni (ri)connessione del gateway: tutto il resto è già avviato
+    shards.configure(bot.shard_count, getattr(bot, "shard_ids", None))
+    logging.info(f"✅ Bot online come {bot.user}")
 
 # ---------- Evento on_message ----------
 @bot.event
@@ -605,15 +360,16 @@ async def on_message(message: discord.Message):
     if session is None:
         return
     
-    # ✅ Rimuove l’indicatore verde se l’utente scrive nel thread
-    try:
-        thread = message.channel
-        if isinstance(thread, discord.Thread) and "🟩" in thread.name:
-            new_name = thread.name.replace(" 🟩", "")
-            await thread.edit(name=new_name)
-            logging.info(f"🟩 Indicatore rimosso per utente {uid}")
-    except Exception as e:
-        logging.warning(f"⚠️ Impossibile aggiornare nome thread: {e}")
+    # ✅ Rimuove l’indicatore verde se l’utente scrive nel suo thread (il rename avviene in background);
+    # gli altri thread non sono gestiti dal bot e non vanno rinominati
+    if message.channel.id == session.get("thread_id"):
+        unread.clear(message.channel)
+    await touch_session(uid)
+
+    # Sessioni create prima dello sharding: il guild serve per instradare i webhook allo shard giusto
+    if not session.get("guild_id") and session.get("thread_id") == message.channel.id:
+        session["guild_id"] = message.guild.id
+        await save_user_session(uid, session, durable=False)
 
     # ---------- Inserimento chiavi Bearer/Secret/Username ----------
     if not session.get("bearer_token") or not session.get("secret_key") or not session.get("username"):
@@ -633,15 +389,15 @@ async def on_message(message: discord.Message):
                 secret = match.group(2).strip().replace("<", "").replace(">", "")
                 username_to_test = match.group(3).strip().replace("<", "").replace(">", "")
 
-                logging.info(f"Bearer Token: {bearer}")
-                logging.info(f"SECRET KEY: {secret}")
-                logging.info(f"Username: {username_to_test}")
+                logging.info(f"🔑 Credenziali ricevute per utente {uid} (username: {username_to_test})")
 
                 # Salva nel DB
                 session["bearer_token"] = bearer
                 session["secret_key"] = secret
                 session["username"] = username_to_test
                 await save_user_session(uid, session)
+                if POLL_ENABLED:
+                    poller.add(uid)
 
                 # 🔍 Recupera e verifica username UEX
                 try:
@@ -662,67 +418,77 @@ async def on_message(message: discord.Message):
             
 
     # ---------- Se l'utente sta rispondendo a una notifica ----------
-    if message.reference and message.reference.resolved:
-        replied_msg = message.reference.resolved
-
-        # Trova l'hash della notifica dall'embed
-        embed = replied_msg.embeds[0] if replied_msg.embeds else None
-        notif_hash = None
-
-        if embed and embed.description:
-            match = re.search(r"/hash/([a-f0-9-]+)", embed.description)
-            if match:
-                notif_hash = match.group(1)
+    if message.reference and message.reference.message_id:
+        # Hash della negoziazione dall'indice dei messaggi inviati: non serve il messaggio in cache
+        notif_hash = await get_notification_hash(message.reference.message_id)
+        if not notif_hash:
+            notif_hash = hash_from_embed(message.reference.resolved)
 
         if not notif_hash:
             await message.channel.send("❌ Impossibile trovare l'hash della notifica da questo messaggio.")
             return
 
-        # Prepara la richiesta API
-        headers = {
-            "Authorization": f"Bearer {session['bearer_token']}",
-            "secret-key": session["secret_key"],
-            "Content-Type": "application/json"
-        }
-
-        payload = {
-            "is_production": 1,
-            "hash": notif_hash,
-            "message": content
-        }
-
-        logging.info(f"hash: {notif_hash}. Message: {content}")
+        logging.info(f"↩️ Risposta di {uid} alla notifica {notif_hash}", extra=SAMPLED)
 
+        # L'invio a UEX avviene in background: lo stato compare come reazione sul messaggio
         try:
-            async with aiohttp_session.post(directory.API_POST_MESSAGE, headers=headers, json=payload) as resp:
-                if resp.status == 200:
-                    # ✅ Embed più curato per mostrare il messaggio inviato
-                    embed = discord.Embed(
-                        title="💬 Messaggio inviato a UEX",
-                        description=f"**Hai risposto:**\n> {content}",
-                        color=discord.Color.green()
-                    )
-
-                    embed.add_field(name="📦 Negoziazione", value=f"🔗 [Apri su UEX](https://uexcorp.space/marketplace/negotiate/hash/{notif_hash})", inline=False)
-                    embed.set_footer(
-                        text=f"Made with love by Passluk"
-                    )
-
-                    await message.channel.send(embed=embed)
-                    logging.info(f"[{datetime.now().strftime('%H:%M:%S')}] ✉️ Utente {uid} ha risposto alla notifica {notif_hash}")
-                else:
-                    text = await resp.text()
-                    await message.channel.send(f"⚠️ Errore nell’invio ({resp.status}): {text[:200]}")
-                    logging.warning(f"Errore UEX reply {resp.status} per utente {uid}: {text}")
-
+            await reply_outbox.enqueue(uid, notif_hash, content, message.channel.id, message.id)
         except Exception as e:
-            await message.channel.send(f"💥 Errore di connessione: {e}")
-            logging.exception(f"💥 Errore durante l'invio reply utente {uid}: {e}")
+            await message.channel.send(f"💥 Errore nel salvataggio della risposta: {e}")
+            logging.exception(f"💥 Errore durante l'accodamento reply utente {uid}: {e}")
 
 
     await bot.process_commands(message)
 
 
+def hash_from_embed(replied_msg) -> str | None:
+    """Notifiche inviate prima dell'indice dei messaggi: l'hash si legge dal link nell'embed."""
+    if not isinstance(replied_msg, discord.Message) or not replied_msg.embeds:
+        return None
+    description = replied_msg.embeds[0].description
+    match = re.search(r"/hash/([a-f0-9-]+)", description) if description else None
+    return match.group(1) if match else None
+
+
+# ---------- Stato delle risposte verso UEX ----------
+REPLY_REACTIONS = {"queued": "⏳", "retry": "🔁", "sent": "✅", "failed": "❌", "uncertain": "❓"}
+
+async def update_reply_status(item: dict, state: str, detail):
+    # Le risposte ripescate all'avvio aspettano la connessione al gateway
+    await bot.wait_until_ready()
+    channel = await resolver.resolve(item["channel_id"], unarchive=False)
+    if channel is None:
+        return
+
+    message = channel.get_partial_message(item["message_id"])
+    reaction = REPLY_REACTIONS[state]
+    previous = item.get("reaction")
+    if previous != reaction:
+        if previous:
+            await message.remove_reaction(previous, bot.user)
+        await message.add_reaction(reaction)
+        item["reaction"] = reaction
+
+    if state == "sent":
+        # ✅ Embed più curato per mostrare il messaggio inviato
+        embed = discord.Embed(
+            title="💬 Messaggio inviato a UEX",
+            description=f"**Hai risposto:**\n> {item['message']}",
+            color=discord.Color.green()
+        )
+
+        embed.add_field(name="📦 Negoziazione", value=f"🔗 [Apri su UEX](https://uexcorp.space/marketplace/negotiate/hash/{item['negotiation_hash']})", inline=False)
+        embed.set_footer(
+            text=f"Made with love by Passluk"
+        )
+        sent = await scheduler.send(channel, embed, key=item["negotiation_hash"])
+        await save_notification_message(sent.id, item["negotiation_hash"], channel.id, "reply_sent")
+    elif state == "failed":
+        await channel.send(f"⚠️ Errore nell’invio: {str(detail)[:200]}")
+    elif state == "uncertain":
+        await channel.send(f"❓ Non è certo che la risposta sia arrivata a UEX ({str(detail)[:200]}): controlla su UEX prima di reinviarla.")
+
+
 # ---------- Gestione thread eliminati ----------
 @bot.event
 async def on_thread_delete(thread: discord.Thread):
@@ -731,27 +497,24 @@ async def on_thread_delete(thread: discord.Thread):
     nel DB per gli utenti collegati a quel thread.
     """
     try:
-        async with aiosqlite.connect(DB_PATH) as db_conn:
-            # Recupera tutti gli utenti associati a quel thread (se hai salvato thread_id nel DB)
-            cursor = await db_conn.execute(
-                "SELECT user_id FROM sessions WHERE session_data LIKE ?",
-                (f'%{thread.id}%',)
-            )
-            users_to_delete = await cursor.fetchall()
-
-            # Elimina tutte le sessioni trovate
-            if users_to_delete:
-                for (user_id,) in users_to_delete:
-                    await db_conn.execute("DELETE FROM sessions WHERE user_id = ?", (user_id,))
-                await db_conn.commit()
-                logging.info(f"🗑️ Thread eliminato → rimosse sessioni per {len(users_to_delete)} utenti (thread_id={thread.id})")
-            else:
-                logging.debug(f"ℹ️ Nessuna sessione trovata per il thread eliminato {thread.id}")
+        resolver.forget(thread.id)
+        unread.discard(thread.id)
+        # Lookup sull'indice di thread_id ed eliminazione in un'unica transazione
+        users_deleted = await remove_sessions_by_thread(thread.id)
+        if users_deleted:
+            logging.info(f"🗑️ Thread eliminato → rimosse sessioni per {len(users_deleted)} utenti (thread_id={thread.id})")
+        else:
+            logging.debug(f"ℹ️ Nessuna sessione trovata per il thread eliminato {thread.id}")
 
     except Exception as e:
         logging.exception(f"💥 Errore in on_thread_delete: {e}")
 
 
+@bot.event
+async def on_thread_update(before: discord.Thread, after: discord.Thread):
+    resolver.remember(after)
+
+
 # ---------- Gestione utente che lascia il thread ----------
 @bot.event
 async def on_thread_member_remove(thread: discord.Thread, member: discord.Member):
@@ -760,13 +523,8 @@ async def on_thread_member_remove(thread: discord.Thread, member: discord.Member
     se era associata a quel thread.
     """
     try:
-        async with aiosqlite.connect(DB_PATH) as db_conn:
-            # Rimuove la sessione di quell’utente
-            await db_conn.execute(
-                "DELETE FROM sessions WHERE user_id = ?",
-                (str(member.id),)
-            )
-            await db_conn.commit()
+        # Rimuove la sessione di quell’utente
+        await remove_user_session(str(member.id))
 
         logging.info(f"🚪 Utente {member.id} ha lasciato il thread {thread.id} → sessione rimossa dal DB")
 
@@ -783,17 +541,7 @@ async def on_thread_member_remove(thread: discord.Thread, member: discord.Member
 @app_commands.checks.has_permissions(manage_guild=True)
 async def stats(interaction: discord.Interaction):
     try:
-        async with db_lock:
-            async with db_conn.execute("SELECT COUNT(*) FROM sessions") as cursor:
-                row = await cursor.fetchone()
-                users_count = row[0] if row else 0
-
-            async with db_conn.execute("SELECT session_data FROM sessions") as cursor:
-                threads_active = 0
-                async for row in cursor:
-                    session = json.loads(row[0])
-                    if session.get("thread_id"):
-                        threads_active += 1
+        users_count, threads_active = await count_sessions()
 
         embed = discord.Embed(
             title="📊 Statistiche Bot",
@@ -801,6 +549,29 @@ async def stats(interaction: discord.Interaction):
         )
         embed.add_field(name="👥 Utenti registrati", value=str(users_count), inline=True)
         embed.add_field(name="💬 Threads attivi", value=str(threads_active), inline=True)
+        embed.add_field(name="📤 Coda invii", value=str(scheduler.depth()), inline=True)
+        embed.add_field(name="📨 Risposte verso UEX", value=str(reply_outbox.depth()), inline=True)
+        embed.add_field(name="♻️ Webhook duplicati", value=f"{dedup.dedup_stats['hits']} / {dedup.dedup_stats['checked']}", inline=True)
+        embed.add_field(name="🚦 Webhook rifiutati", value=" • ".join(f"{reason} {count}" for reason, count in ingress.overload_stats.items()), inline=False)
+        cache_stats = session_cache.stats()
+        if isinstance(bot, commands.AutoShardedBot):
+            threads_per_guild = routing.threads_per_guild()
+            lines = []
+            for shard_id, shard in sorted(bot.shards.items()):
+                guilds = [guild for guild in bot.guilds if guild.shard_id == shard_id]
+                threads = sum(threads_per_guild.get(guild.id, 0) for guild in guilds)
+                lines.append(f"#{shard_id}: {len(guilds)} server • {threads} thread • {shard.latency * 1000:.0f} ms")
+            embed.add_field(name=f"🧩 Shard ({bot.shard_count})", value="\n".join(lines) or "-", inline=False)
+        embed.add_field(
+            name="🧠 Cache sessioni",
+            value=f"{cache_stats['size']} voci • hit {cache_stats['hits']} / miss {cache_stats['misses']} ({cache_stats['hit_rate']:.0%})",
+            inline=False
+        )
+        embed.add_field(
+            name="🧵 Risoluzione thread",
+            value=" • ".join(f"{outcome} {count}" for outcome, count in resolver.stats.items()),
+            inline=False
+        )
 
         await interaction.response.send_message(embed=embed, ephemeral=True)
         logging.info(f"Eseguito Comando Stats. Current User: {users_count}. Active Threads: {threads_active}")
@@ -809,6 +580,36 @@ async def stats(interaction: discord.Interaction):
         await interaction.response.send_message("❌ Errore nel recupero delle statistiche.", ephemeral=True)
 
 
+# ---------- Comando /digest ----------
+@bot.tree.command(name="digest", description="Ricevi le notifiche in un riepilogo periodico invece che una per una")
+@app_commands.describe(minuti="Ogni quanti minuti ricevere il riepilogo (0 = notifiche singole)")
+async def digest_command(interaction: discord.Interaction, minuti: app_commands.Range[int, 0, DIGEST_MAX_MINUTES]):
+    try:
+        uid = str(interaction.user.id)
+        session = await get_user_session(uid)
+        if session is None:
+            await interaction.response.send_message("❌ Apri prima la tua chat privata con il bottone.", ephemeral=True)
+            return
+
+        if minuti:
+            session["digest_minutes"] = minuti
+        else:
+            session.pop("digest_minutes", None)
+        await save_user_session(uid, session)
+
+        if minuti:
+            await interaction.response.send_message(f"🗞️ Modalità digest attiva: riceverai un riepilogo ogni {minuti} minuti.", ephemeral=True)
+        else:
+            await interaction.response.send_message("🔔 Modalità digest disattivata: riceverai ogni notifica appena arriva.", ephemeral=True)
+            # Quello che era già in attesa parte subito
+            if session.get("thread_id"):
+                await digests.flush(int(session["thread_id"]))
+        logging.info(f"🗞️ Digest per utente {uid}: {minuti or 'disattivato'} minuti")
+    except Exception as e:
+        logging.exception(f"❌ Errore nel comando /digest: {e}")
+        await interaction.response.send_message("❌ Errore nel salvataggio dell'impostazione.", ephemeral=True)
+
+
 # ---------- Comando /add ----------
 @bot.tree.command(name="add", description="Aggiunge il bottone per creare le chat private in un canale")
 @app_commands.describe(canale="Il canale dove inviare il messaggio con il bottone")
@@ -881,5 +682,28 @@ def show_logo():
 
 
 # ---------- Run Bot ----------
+async def main():
+    show_logo()
+    stop = asyncio.Event()
+    ingress.on_stop_signal(stop.set)
+
+    async with bot:
+        await start_services()
+        gateway = asyncio.create_task(bot.start(DISCORD_TOKEN))
+        stopping = asyncio.create_task(stop.wait())
+        await asyncio.wait({gateway, stopping}, return_when=asyncio.FIRST_COMPLETED)
+        stopping.cancel()
+        try:
+            await shutdown()
+        finally:
+            # Il gateway si chiude per ultimo: fino a qui servono le sue API REST per gli invii
+            await bot.close()
+        await gateway
+
+
 if __name__ == "__main__":
-    bot.run(DISCORD_TOKEN)
+    # Gli handler sono già configurati da logging_setup: niente bot.run e niente handler sincrono di discord.py
+    try:
+        asyncio.run(main())
+    except KeyboardInterrupt:
+        pass
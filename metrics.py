@@ -0,0 +1,183 @@
+import time
+import asyncio
+import logging
+import functools
+import contextlib
+
+
+# ---------- Metriche in formato Prometheus ----------
+# Implementazione minima senza dipendenze: contatori, gauge e istogrammi con label,
+# esportati in text format 0.0.4 dalla route /metrics.
+_registry: list = []
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def _format_labels(names: tuple, values: tuple, extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, help_text: str, labelnames: tuple = ()):
+        self.name = name
+        self.help = help_text
+        self.labelnames = tuple(labelnames)
+        _registry.append(self)
+
+    def _key(self, labels: dict) -> tuple:
+        return tuple(str(labels.get(name, "")) for name in self.labelnames)
+
+    def header(self) -> list[str]:
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, name, help_text, labelnames=()):
+        super().__init__(name, help_text, labelnames)
+        self._values: dict[tuple, float] = {}
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels) -> float:
+        return self._values.get(self._key(labels), 0)
+
+    def render(self) -> list[str]:
+        return [f"{self.name}{_format_labels(self.labelnames, key)} {value}" for key, value in self._values.items()]
+
+
+class Gauge(_Metric):
+    """Gauge impostato a mano o letto al momento dell'export da una funzione."""
+    kind = "gauge"
+
+    def __init__(self, name, help_text, labelnames=()):
+        super().__init__(name, help_text, labelnames)
+        self._values: dict[tuple, float] = {}
+        self._functions: dict[tuple, object] = {}
+
+    def set(self, value: float, **labels):
+        self._values[self._key(labels)] = value
+
+    def set_function(self, function, **labels):
+        self._functions[self._key(labels)] = function
+
+    def render(self) -> list[str]:
+        values = dict(self._values)
+        for key, function in self._functions.items():
+            try:
+                values[key] = function()
+            except Exception as e:
+                logging.debug(f"Gauge {self.name} non disponibile: {e}")
+        return [f"{self.name}{_format_labels(self.labelnames, key)} {value}" for key, value in values.items()]
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help_text, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help_text, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self._series: dict[tuple, list] = {}   # key → [conteggi per bucket..., somma, conteggio]
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        series = self._series.get(key)
+        if series is None:
+            series = self._series[key] = [0] * len(self.buckets) + [0.0, 0]
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                series[i] += 1
+        series[-2] += value
+        series[-1] += 1
+
+    @contextlib.contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def render(self) -> list[str]:
+        lines = []
+        for key, series in self._series.items():
+            for bound, count in zip(self.buckets, series):
+                labels = _format_labels(self.labelnames, key, 'le="%s"' % bound)
+                lines.append(f"{self.name}_bucket{labels} {count}")
+            labels = _format_labels(self.labelnames, key, 'le="+Inf"')
+            lines.append(f"{self.name}_bucket{labels} {series[-1]}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labelnames, key)} {series[-2]}")
+            lines.append(f"{self.name}_count{_format_labels(self.labelnames, key)} {series[-1]}")
+        return lines
+
+
+def render() -> str:
+    lines = []
+    for metric in _registry:
+        lines.extend(metric.header())
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+# ---------- Metriche del bot ----------
+WEBHOOK_REQUESTS = Counter("uex_webhook_requests_total", "Webhook ricevuti per tipo evento e status HTTP", ("event_type", "status"))
+WEBHOOK_LATENCY = Histogram("uex_webhook_request_seconds", "Tempo di risposta (ACK) dei webhook", ("event_type",))
+WEBHOOK_REJECTED = Counter("uex_webhook_rejected_total", "Webhook rifiutati per sovraccarico (rate_limited, overloaded, backlog, too_large)", ("reason",))
+WEBHOOK_PROCESSING = Histogram("uex_webhook_processing_seconds", "Tempo di elaborazione dei webhook nei worker", ("event_type",))
+DB_QUERY_LATENCY = Histogram("uex_db_query_seconds", "Latenza delle funzioni DB", ("function",))
+DISCORD_SEND_LATENCY = Histogram("uex_discord_send_seconds", "Latenza degli invii di messaggi su Discord")
+DISCORD_RATE_LIMITED = Counter("uex_discord_rate_limited_total", "Risposte 429 ricevute da Discord")
+UEX_API_LATENCY = Histogram("uex_api_request_seconds", "Latenza delle chiamate alle API UEX", ("endpoint",))
+UEX_API_REQUESTS = Counter("uex_api_requests_total", "Chiamate alle API UEX per esito", ("endpoint", "outcome"))
+EVENT_LOOP_LAG = Gauge("uex_event_loop_lag_seconds", "Ritardo dell'event loop nell'ultimo campionamento")
+EVENT_LOOP_LAG_HISTOGRAM = Histogram("uex_event_loop_lag_seconds_histogram", "Distribuzione del ritardo dell'event loop")
+LOG_RECORDS_SAMPLED_OUT = Counter("uex_log_records_sampled_out_total", "Log INFO per-webhook scartati dal campionamento")
+THREAD_LOOKUPS = Counter("uex_thread_lookups_total", "Risoluzioni thread per esito (gateway, cached, fetched, missing, negative)", ("outcome",))
+QUEUE_DEPTH = Gauge("uex_queue_depth", "Elementi in attesa per coda", ("queue",))
+
+
+def timed(histogram: Histogram, **labels):
+    """Decoratore per coroutine: osserva la durata di ogni chiamata su `histogram`."""
+    def decorator(function):
+        @functools.wraps(function)
+        async def wrapper(*args, **kwargs):
+            with histogram.time(**labels):
+                return await function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+# ---------- Hook di strumentazione ----------
+class _DiscordRateLimitHandler(logging.Handler):
+    # discord.py gestisce da solo i 429 e li segnala solo nel log di discord.http, con una riga
+    # "We are being rate limited" per ogni risposta 429: è l'unico punto in cui vengono contati
+    def emit(self, record: logging.LogRecord):
+        if str(record.msg).startswith("We are being rate limited."):
+            DISCORD_RATE_LIMITED.inc()
+
+def install_discord_ratelimit_hook():
+    logger = logging.getLogger("discord.http")
+    if not any(isinstance(handler, _DiscordRateLimitHandler) for handler in logger.handlers):
+        handler = _DiscordRateLimitHandler(level=logging.WARNING)
+        logger.addHandler(handler)
+
+async def monitor_event_loop(interval: float = 0.5):
+    """Misura di quanto il risveglio di uno sleep arriva in ritardo: è il lag dell'event loop."""
+    loop = asyncio.get_running_loop()
+    while True:
+        start = loop.time()
+        await asyncio.sleep(interval)
+        lag = max(0.0, loop.time() - start - interval)
+        EVENT_LOOP_LAG.set(lag)
+        EVENT_LOOP_LAG_HISTOGRAM.observe(lag)
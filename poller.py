@@ -0,0 +1,225 @@
+import re
+import json
+import math
+import time
+import random
+import asyncio
+import logging
+
+import inbox
+import dedup
+import storage
+import event_types
+from cache import TTLCache
+from sharding import shards
+from ratelimit import TokenBucket
+from logging_setup import SAMPLED, log_context
+from uex_client import client as uex, CircuitOpenError
+from config import POLL_INTERVAL, POLL_MAX_INTERVAL, POLL_CONCURRENCY, POLL_RATE, POLL_GRACE
+
+
+EVENT_TYPE = event_types.USER_NOTIFICATION
+HASH_RE = re.compile(r"/hash/([a-f0-9-]+)")
+
+
+# ---------- Timing wheel ----------
+class TimingWheel:
+    """
+    Ruota di `slots` slot da `tick` secondi: schedule e cancel in O(1), e a ogni tick si
+    guardano solo gli elementi scaduti in quello slot. Il ritardo massimo è slots - 1 tick.
+    """
+
+    def __init__(self, slots: int, tick: float = 1.0):
+        self.tick = tick
+        self._slots: list[set] = [set() for _ in range(max(2, slots))]
+        self._where: dict = {}
+        self._cursor = 0
+
+    def __len__(self):
+        return len(self._where)
+
+    def __contains__(self, item):
+        return item in self._where
+
+    def schedule(self, item, delay: float):
+        self.cancel(item)
+        ticks = min(len(self._slots) - 1, max(1, math.ceil(delay / self.tick)))
+        index = (self._cursor + ticks) % len(self._slots)
+        self._slots[index].add(item)
+        self._where[item] = index
+
+    def cancel(self, item):
+        index = self._where.pop(item, None)
+        if index is not None:
+            self._slots[index].discard(item)
+
+    def advance(self) -> set:
+        """Avanza di un tick e restituisce gli elementi scaduti."""
+        self._cursor = (self._cursor + 1) % len(self._slots)
+        due, self._slots[self._cursor] = self._slots[self._cursor], set()
+        for item in due:
+            del self._where[item]
+        return due
+
+
+# ---------- Poller notifiche ----------
+class NotificationPoller:
+    """
+    Recupera da API_NOTIFICATIONS le notifiche i cui webhook non sono arrivati.
+    Ogni utente ha il suo intervallo (da POLL_INTERVAL a POLL_MAX_INTERVAL, si accorcia
+    quando arrivano notifiche e si allunga quando non ce ne sono) e un high-water mark
+    sull'id delle notifiche. Le notifiche nuove passano da dedup e inbox come un webhook,
+    a meno che un webhook della stessa negoziazione le abbia già consegnate.
+    """
+
+    def __init__(self, min_interval: float = POLL_INTERVAL, max_interval: float = POLL_MAX_INTERVAL,
+                 concurrency: int = POLL_CONCURRENCY, rate: float = POLL_RATE, grace: float = POLL_GRACE):
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.grace = grace
+        self.wheel = TimingWheel(int(max_interval * 1.2) + 2)
+        self.stats = {"polls": 0, "errors": 0, "found": 0, "covered": 0, "enqueued": 0}
+        self._intervals: dict[str, float] = {}
+        self._hwm: dict[str, int] = {}
+        self._webhooks = TTLCache(maxsize=100000, ttl=max_interval + grace)    # (user_id, hash) → ultimo webhook
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self._bucket = TokenBucket(rate, max(1, rate))
+        self._polling: set[str] = set()
+        self._task: asyncio.Task | None = None
+
+    async def start(self):
+        if self._task is not None:
+            return
+        users = [user_id for user_id, guild_id in await storage.pollable_sessions() if shards.owns(guild_id)]
+        for user_id in users:
+            # Primo giro distribuito su tutto l'intervallo minimo: niente raffica all'avvio
+            self.wheel.schedule(user_id, random.uniform(0, self.min_interval))
+        self._task = asyncio.create_task(self._run())
+        logging.info(f"🔄 Poller notifiche avviato per {len(users)} utenti")
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    def add(self, user_id):
+        """Nuove credenziali: l'utente entra nella ruota con l'intervallo minimo."""
+        user_id = str(user_id)
+        self._intervals[user_id] = self.min_interval
+        if user_id not in self._polling:
+            self.wheel.schedule(user_id, self._jitter(self.min_interval))
+
+    def note_webhook(self, user_id, negotiation_hash: str | None):
+        if negotiation_hash:
+            self._webhooks.set((str(user_id), negotiation_hash), time.time())
+
+    def pending(self) -> int:
+        return len(self.wheel)
+
+    @staticmethod
+    def _jitter(interval: float) -> float:
+        return interval * random.uniform(0.9, 1.1)
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        next_tick = loop.time()
+        while True:
+            next_tick += self.wheel.tick
+            await asyncio.sleep(max(0.0, next_tick - loop.time()))
+            for user_id in self.wheel.advance():
+                self._polling.add(user_id)
+                asyncio.create_task(self._poll(user_id))
+
+    async def _poll(self, user_id: str):
+        interval = self._intervals.get(user_id, self.min_interval)
+        try:
+            async with self._semaphore:
+                await self._bucket.acquire()
+                with log_context(user_id=user_id):
+                    found = await self._poll_user(user_id)
+            if found is None:
+                self._forget(user_id)
+                return
+            # Attività → intervallo minimo, silenzio → backoff fino a POLL_MAX_INTERVAL
+            interval = self.min_interval if found else min(self.max_interval, interval * 1.5)
+        except CircuitOpenError:
+            interval = self.max_interval
+        except Exception as e:
+            self.stats["errors"] += 1
+            interval = min(self.max_interval, interval * 2)
+            logging.warning(f"⚠️ Polling notifiche fallito per {user_id}: {e}")
+        finally:
+            self._polling.discard(user_id)
+
+        self._intervals[user_id] = interval
+        self.wheel.schedule(user_id, self._jitter(interval))
+
+    def _forget(self, user_id: str):
+        self._intervals.pop(user_id, None)
+        self._hwm.pop(user_id, None)
+
+    async def _poll_user(self, user_id: str) -> int | None:
+        """Restituisce quante notifiche nuove sono arrivate, o None se l'utente non è più da controllare."""
+        session = await storage.get_user_session(user_id)
+        if not session or not session.get("bearer_token") or not session.get("secret_key") or not shards.owns(session.get("guild_id")):
+            return None
+
+        self.stats["polls"] += 1
+        status, text = await uex.get_notifications(user_id, session["bearer_token"], session["secret_key"])
+        if status != 200:
+            raise RuntimeError(f"UEX {status}: {text[:200]}")
+        notifications = json.loads(text).get("data") or []
+        notifications.sort(key=lambda item: int(item.get("id") or 0))
+
+        hwm = await self._load_hwm(user_id)
+        if hwm is None:
+            # Primo controllo: si parte dalle notifiche attuali senza riconsegnare lo storico
+            newest = int(notifications[-1].get("id") or 0) if notifications else 0
+            await self._save_hwm(user_id, newest)
+            return 0
+
+        fresh = [item for item in notifications if int(item.get("id") or 0) > hwm]
+        new_hwm, now = hwm, time.time()
+        for notification in fresh:
+            # Troppo recente: il webhook può ancora arrivare, si riguarda al prossimo giro
+            if now - float(notification.get("date_added") or 0) < self.grace:
+                break
+            new_hwm = int(notification.get("id") or 0)
+            self.stats["found"] += 1
+            await self._deliver(user_id, notification)
+
+        if new_hwm != hwm:
+            await self._save_hwm(user_id, new_hwm)
+        return len(fresh)
+
+    async def _deliver(self, user_id: str, notification: dict):
+        match = HASH_RE.search(str(notification.get("redir") or ""))
+        data = dict(notification, negotiation_hash=match.group(1) if match else None)
+
+        last_webhook = self._webhooks.get((user_id, data["negotiation_hash"])) if data["negotiation_hash"] else None
+        if last_webhook is not None and last_webhook >= float(notification.get("date_added") or 0):
+            self.stats["covered"] += 1
+            return
+
+        fp = dedup.fingerprint(EVENT_TYPE, user_id, data)
+        if await dedup.is_duplicate(fp):
+            return
+        event_id = await inbox.enqueue(EVENT_TYPE, user_id, json.dumps(data))
+        self.stats["enqueued"] += 1
+        logging.info(f"🔔 Notifica {notification.get('id')} recuperata dal polling → {event_id}", extra=SAMPLED)
+
+    async def _load_hwm(self, user_id: str) -> int | None:
+        if user_id not in self._hwm:
+            value = await storage.get_meta(f"poll_hwm:{user_id}")
+            if value is None:
+                return None
+            self._hwm[user_id] = int(value)
+        return self._hwm[user_id]
+
+    async def _save_hwm(self, user_id: str, hwm: int):
+        self._hwm[user_id] = hwm
+        await storage.set_meta(f"poll_hwm:{user_id}", str(hwm))
+
+
+poller = NotificationPoller()
@@ -0,0 +1,32 @@
+import time
+import asyncio
+
+
+# ---------- Token bucket ----------
+class TokenBucket:
+    """Bucket da `capacity` gettoni che si ricarica di `rate` gettoni al secondo."""
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def try_take(self, tokens: float = 1) -> float:
+        """Preleva i gettoni se disponibili e restituisce 0, altrimenti i secondi da attendere."""
+        self._refill()
+        if self._tokens >= tokens:
+            self._tokens -= tokens
+            return 0.0
+        if self.rate <= 0:
+            return float("inf")
+        return (tokens - self._tokens) / self.rate
+
+    async def acquire(self, tokens: float = 1):
+        while (wait := self.try_take(tokens)) > 0:
+            await asyncio.sleep(wait)
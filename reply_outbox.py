@@ -0,0 +1,220 @@
+import time
+import uuid
+import asyncio
+import logging
+from collections import deque
+
+import aiohttp
+
+import storage
+from retry import backoff_delay
+from sharding import shards
+from routing import index as routing
+from logging_setup import SAMPLED, bind_log_context
+from uex_client import client as uex, CircuitOpenError
+from config import OUTBOX_WORKERS, OUTBOX_MAX_ATTEMPTS, OUTBOX_RETRY_BASE, OUTBOX_RETRY_MAX
+
+
+# ---------- Reply outbox ----------
+# Le risposte scritte su Discord vengono salvate in reply_outbox e inviate a UEX in
+# background. Una corsia per negotiation_hash mantiene l'ordine dei messaggi: finché
+# il primo della corsia non è consegnato (o scartato) i successivi aspettano.
+_lanes: dict[str, deque] = {}
+_tasks: dict[str, asyncio.Task] = {}
+_sending: set[str] = set()      # corsie con un invio a UEX in corso
+_closing = False
+_slots: asyncio.Semaphore | None = None
+_notify = None
+outbox_stats = {"queued": 0, "sent": 0, "retried": 0, "failed": 0, "uncertain": 0}
+
+# Stati notificati al callback: queued, retry, sent, failed, uncertain
+SENT, RETRY, FAILED, UNCERTAIN = "sent", "retry", "failed", "uncertain"
+INTERRUPTED = "invio interrotto dal riavvio del bot"
+
+
+async def start(notify):
+    """
+    `notify(item, state, detail)` viene chiamato a ogni cambio di stato di una risposta
+    (queued / retry / sent / failed / uncertain) per aggiornare il messaggio originale su Discord.
+    La POST a UEX non è idempotente: una risposta che potrebbe essere arrivata (timeout, connessione
+    persa durante l'invio, riavvio a metà) diventa 'uncertain' e non viene reinviata.
+    """
+    global _slots, _notify, _closing
+    if _slots is not None and not _closing:
+        return
+    _closing = False
+    _slots = asyncio.Semaphore(max(1, OUTBOX_WORKERS))
+    _notify = notify
+
+    pending = await storage.outbox_pending()
+    for reply_id, user_id, negotiation_hash, message, channel_id, message_id, attempts, next_attempt_at in pending:
+        _add({
+            "reply_id": reply_id, "user_id": user_id, "negotiation_hash": negotiation_hash,
+            "message": message, "channel_id": channel_id, "message_id": message_id,
+            "attempts": attempts, "next_attempt_at": next_attempt_at,
+        })
+    if pending:
+        logging.info(f"📤 Outbox: {len(pending)} risposte in sospeso rimesse in coda")
+
+    interrupted = await storage.outbox_interrupted(INTERRUPTED)
+    for reply_id, user_id, negotiation_hash, message, channel_id, message_id, attempts in interrupted:
+        outbox_stats["uncertain"] += 1
+        item = {
+            "reply_id": reply_id, "user_id": user_id, "negotiation_hash": negotiation_hash,
+            "message": message, "channel_id": channel_id, "message_id": message_id, "attempts": attempts,
+        }
+        _notify_later(item, UNCERTAIN, INTERRUPTED)
+    if interrupted:
+        logging.warning(f"❓ Outbox: {len(interrupted)} risposte interrotte durante l'invio, non reinviate")
+
+async def stop(timeout: float = 0):
+    """
+    Ferma le corsie. Quelle con un invio in corso hanno `timeout` secondi per registrarne l'esito,
+    così una risposta già consegnata a UEX non viene reinviata al riavvio; le altre ripartono dal DB.
+    """
+    global _closing
+    # Il semaforo resta: le corsie ancora in invio lo rilasciano, _closing impedisce nuovi invii
+    _closing = True
+    tasks = dict(_tasks)
+    sending = [task for negotiation_hash, task in tasks.items() if negotiation_hash in _sending]
+    for negotiation_hash, task in tasks.items():
+        if negotiation_hash not in _sending:
+            task.cancel()
+    if sending and timeout > 0:
+        _, late = await asyncio.wait(sending, timeout=timeout)
+        for task in late:
+            task.cancel()
+    else:
+        for task in sending:
+            task.cancel()
+    await asyncio.gather(*tasks.values(), return_exceptions=True)
+    # Quello che resta in memoria è già nel DB: al prossimo start riparte da lì, una volta sola
+    _lanes.clear()
+    _tasks.clear()
+    _sending.clear()
+
+async def enqueue(user_id: str, negotiation_hash: str, message: str, channel_id: int, message_id: int) -> dict:
+    item = {
+        "reply_id": uuid.uuid4().hex, "user_id": str(user_id), "negotiation_hash": negotiation_hash,
+        "message": message, "channel_id": channel_id, "message_id": message_id,
+        "attempts": 0, "next_attempt_at": 0,
+    }
+    # Lo shard del thread: dopo un riavvio la risposta riparte solo dal processo che lo gestisce
+    shard_id = shards.shard_for_guild(routing.guild_for_thread(channel_id))
+    await storage.outbox_add(
+        item["reply_id"], user_id, negotiation_hash, message, channel_id, message_id,
+        shard_id if shard_id is not None else shards.home
+    )
+    outbox_stats["queued"] += 1
+    _add(item)
+    # La reazione ⏳ è una chiamata REST: l'handler del gateway non la aspetta
+    _notify_later(item, "queued", None)
+    return item
+
+def depth() -> int:
+    return sum(len(lane) for lane in _lanes.values())
+
+def _add(item: dict):
+    negotiation_hash = item["negotiation_hash"]
+    _lanes.setdefault(negotiation_hash, deque()).append(item)
+    # In chiusura la risposta resta solo nel DB e parte al prossimo avvio
+    if negotiation_hash not in _tasks and not _closing:
+        _tasks[negotiation_hash] = asyncio.create_task(_run_lane(negotiation_hash))
+
+def _notify_later(item: dict, state: str, detail):
+    item["notifying"] = asyncio.create_task(_emit(item, state, detail))
+
+async def _emit(item: dict, state: str, detail):
+    if _notify is None:
+        return
+    # Gli stati arrivano al callback nell'ordine in cui si verificano
+    previous = item.get("notifying")
+    if previous is not None and previous is not asyncio.current_task():
+        del item["notifying"]
+        await asyncio.gather(previous, return_exceptions=True)
+    try:
+        await _notify(item, state, detail)
+    except Exception as e:
+        logging.warning(f"⚠️ Aggiornamento stato risposta {item['reply_id']} fallito: {e}")
+
+async def _run_lane(negotiation_hash: str):
+    # Ogni corsia è un task a sé: il contesto di log non si mescola con le altre
+    bind_log_context(negotiation_hash=negotiation_hash)
+    lane = _lanes[negotiation_hash]
+    try:
+        while lane and not _closing:
+            item = lane[0]
+            wait = item["next_attempt_at"] - time.time()
+            if wait > 0:
+                await asyncio.sleep(wait)
+
+            async with _slots:
+                if _closing:
+                    break
+                _sending.add(negotiation_hash)
+                await storage.outbox_sending(item["reply_id"])
+                state, detail = await _deliver(item)
+
+            if state == RETRY and item["attempts"] + 1 >= OUTBOX_MAX_ATTEMPTS:
+                state = FAILED
+
+            if state == SENT:
+                lane.popleft()
+                outbox_stats["sent"] += 1
+                await storage.outbox_done(item["reply_id"])
+                logging.info(f"✉️ Utente {item['user_id']} ha risposto alla notifica {negotiation_hash}", extra=SAMPLED)
+            elif state == UNCERTAIN:
+                lane.popleft()
+                outbox_stats["uncertain"] += 1
+                item["attempts"] += 1
+                await storage.outbox_uncertain(item["reply_id"], item["attempts"], str(detail))
+                logging.error(f"❓ Risposta {item['reply_id']} per {negotiation_hash} forse consegnata, non reinviata: {detail}")
+            elif state == FAILED:
+                lane.popleft()
+                outbox_stats["failed"] += 1
+                item["attempts"] += 1
+                await storage.outbox_dead(item["reply_id"], item["attempts"], str(detail))
+                logging.error(f"☠️ Risposta {item['reply_id']} per {negotiation_hash} scartata: {detail}")
+            else:
+                outbox_stats["retried"] += 1
+                item["attempts"] += 1
+                delay = backoff_delay(item["attempts"], OUTBOX_RETRY_BASE, OUTBOX_RETRY_MAX)
+                item["next_attempt_at"] = time.time() + delay
+                await storage.outbox_retry(item["reply_id"], item["attempts"], item["next_attempt_at"], str(detail))
+                logging.warning(f"🔁 Risposta {item['reply_id']} per {negotiation_hash} non inviata, nuovo tentativo tra {delay:.0f}s: {detail}")
+
+            await _emit(item, state, detail)
+            _sending.discard(negotiation_hash)
+    finally:
+        _sending.discard(negotiation_hash)
+        _tasks.pop(negotiation_hash, None)
+        if not lane:
+            _lanes.pop(negotiation_hash, None)
+
+async def _deliver(item: dict) -> tuple[str, object]:
+    session = await storage.get_user_session(item["user_id"])
+    if not session or not session.get("bearer_token") or not session.get("secret_key"):
+        return FAILED, "credenziali UEX mancanti"
+
+    try:
+        status, text = await uex.post_message(
+            item["user_id"], session["bearer_token"], session["secret_key"], item["negotiation_hash"], item["message"]
+        )
+    except CircuitOpenError as e:
+        return RETRY, str(e)
+    except aiohttp.ClientConnectorError as e:
+        # Connessione mai aperta: la richiesta non è partita
+        return RETRY, f"errore di connessione: {type(e).__name__}"
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        # Timeout o connessione persa dopo l'invio: UEX può aver già salvato il messaggio
+        return UNCERTAIN, f"esito sconosciuto: {type(e).__name__}"
+
+    if status == 200:
+        return SENT, None
+    # 408/429/503: UEX ha rifiutato la richiesta senza elaborarla
+    if status in (408, 429, 503):
+        return RETRY, f"UEX {status}: {text[:200]}"
+    # Altri 5xx (500, 502, 504): il messaggio può essere stato salvato prima dell'errore
+    if status >= 500:
+        return UNCERTAIN, f"UEX {status}: {text[:200]}"
+    return FAILED, f"UEX {status}: {text[:200]}"
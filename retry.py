@@ -0,0 +1,11 @@
+import random
+
+
+# ---------- Backoff esponenziale ----------
+def backoff_delay(attempt: int, base: float, cap: float) -> float:
+    """
+    Attesa prima del tentativo `attempt` (1 = primo retry): base * 2^(attempt-1),
+    limitata a `cap`, con jitter (tra metà e il valore pieno) per non far ripartire i retry tutti insieme.
+    """
+    ceiling = min(cap, base * (2 ** max(0, attempt - 1)))
+    return random.uniform(ceiling / 2, ceiling)
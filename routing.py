@@ -0,0 +1,97 @@
+# ---------- Indice di routing in memoria ----------
+class RoutingIndex:
+    """
+    Indice user_id → thread, username UEX → user_id e negotiation_hash → link.
+    Viene costruito all'avvio da sessions e negotiation_links e aggiornato da
+    storage a ogni save/delete: il routing di un webhook non tocca SQLite.
+    """
+
+    def __init__(self):
+        self.ready = False
+        self._threads: dict[str, int] = {}       # user_id → thread_id
+        self._guilds: dict[int, int] = {}        # thread_id → guild_id (per lo sharding)
+        self._digests: dict[int, float] = {}     # thread_id → finestra del digest in secondi
+        self._usernames: dict[str, str] = {}     # username UEX → user_id
+        self._user_names: dict[str, str] = {}    # user_id → username UEX (per gli aggiornamenti)
+        self._links: dict[str, dict] = {}        # negotiation_hash → {"buyer_id", "seller_id"}
+
+    def load(self, sessions, links):
+        """sessions: righe (user_id, username, thread_id, guild_id, digest_minutes); links: righe (hash, buyer_id, seller_id)."""
+        self._threads.clear()
+        self._guilds.clear()
+        self._digests.clear()
+        self._usernames.clear()
+        self._user_names.clear()
+        self._links.clear()
+        for user_id, username, thread_id, guild_id, digest_minutes in sessions:
+            self._set_session(str(user_id), username, thread_id, guild_id, digest_minutes)
+        for negotiation_hash, buyer_id, seller_id in links:
+            self.set_link(negotiation_hash, buyer_id, seller_id)
+        self.ready = True
+
+    def stats(self) -> dict:
+        return {"threads": len(self._threads), "usernames": len(self._usernames), "links": len(self._links)}
+
+    # ---------- Aggiornamenti ----------
+    def set_session(self, user_id, session: dict):
+        self._set_session(
+            str(user_id), session.get("username"), session.get("thread_id"), session.get("guild_id"), session.get("digest_minutes")
+        )
+
+    def _set_session(self, user_id: str, username, thread_id, guild_id=None, digest_minutes=None):
+        self.remove_session(user_id)
+        if thread_id:
+            self._threads[user_id] = int(thread_id)
+            if guild_id:
+                self._guilds[int(thread_id)] = int(guild_id)
+            if digest_minutes:
+                self._digests[int(thread_id)] = float(digest_minutes) * 60
+        if username:
+            self._usernames[username] = user_id
+            self._user_names[user_id] = username
+
+    def remove_session(self, user_id):
+        user_id = str(user_id)
+        thread_id = self._threads.pop(user_id, None)
+        if thread_id is not None:
+            self._guilds.pop(thread_id, None)
+            self._digests.pop(thread_id, None)
+        username = self._user_names.pop(user_id, None)
+        if username is not None and self._usernames.get(username) == user_id:
+            del self._usernames[username]
+
+    def set_link(self, negotiation_hash: str, buyer_id: str, seller_id: str):
+        self._links[negotiation_hash] = {"buyer_id": buyer_id, "seller_id": seller_id}
+
+    def remove_link(self, negotiation_hash: str):
+        self._links.pop(negotiation_hash, None)
+
+    # ---------- Lookup O(1) ----------
+    def thread_for_user(self, user_id) -> int | None:
+        return self._threads.get(str(user_id))
+
+    def user_for_username(self, username: str) -> str | None:
+        return self._usernames.get(username)
+
+    def thread_for_username(self, username: str) -> int | None:
+        user_id = self._usernames.get(username)
+        return self._threads.get(user_id) if user_id is not None else None
+
+    def link(self, negotiation_hash: str) -> dict | None:
+        return self._links.get(negotiation_hash)
+
+    def guild_for_thread(self, thread_id) -> int | None:
+        return self._guilds.get(int(thread_id))
+
+    def digest_window(self, thread_id) -> float | None:
+        """Secondi di accumulo degli eventi per il thread, None se il digest è spento."""
+        return self._digests.get(int(thread_id))
+
+    def threads_per_guild(self) -> dict[int, int]:
+        counts: dict[int, int] = {}
+        for guild_id in self._guilds.values():
+            counts[guild_id] = counts.get(guild_id, 0) + 1
+        return counts
+
+
+index = RoutingIndex()
@@ -0,0 +1,106 @@
+import asyncio
+import logging
+from collections import deque
+
+import discord
+
+from config import SEND_COALESCE_MS
+from metrics import DISCORD_SEND_LATENCY
+
+
+# ---------- Limiti Discord ----------
+MAX_EMBEDS_PER_MESSAGE = 10
+MAX_EMBED_CHARS_PER_MESSAGE = 6000
+
+
+# ---------- Scheduler invii per thread ----------
+class ThreadSendScheduler:
+    """
+    Coda di invio per canale: gli embed accodati entro la finestra di coalescing
+    partono in un unico messaggio (max 10 embed / 6000 caratteri) e gli invii
+    sullo stesso canale sono serializzati, così non si accumulano 429 per canale.
+    Si raggruppano solo embed con la stessa `key` (l'hash della negoziazione), anche se in coda
+    sono intercalati con altri: ogni messaggio appartiene a una sola negoziazione e una reply la
+    identifica dal message id. L'ordine resta quello di arrivo all'interno di ogni negoziazione.
+    """
+
+    def __init__(self, window: float = SEND_COALESCE_MS / 1000):
+        self.window = window
+        self.stats = {"messages": 0, "embeds": 0, "errors": 0}
+        self._queues: dict[int, deque] = {}
+        self._tasks: dict[int, asyncio.Task] = {}
+
+    def enqueue(self, channel: discord.abc.Messageable, embed: discord.Embed, key=None) -> asyncio.Future:
+        """Accoda l'embed; il future si risolve con il discord.Message in cui è stato inviato."""
+        future = asyncio.get_running_loop().create_future()
+        self._queues.setdefault(channel.id, deque()).append((embed, future, key))
+        if channel.id not in self._tasks:
+            self._tasks[channel.id] = asyncio.create_task(self._drain(channel))
+        return future
+
+    async def send(self, channel: discord.abc.Messageable, embed: discord.Embed, key=None) -> discord.Message:
+        return await self.enqueue(channel, embed, key)
+
+    def depth(self, channel_id: int | None = None) -> int:
+        if channel_id is not None:
+            return len(self._queues.get(channel_id, ()))
+        return sum(len(queue) for queue in self._queues.values())
+
+    async def drain(self, timeout: float):
+        """Attende fino a `timeout` secondi che le code dei canali si svuotino; restituisce gli embed rimasti."""
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        while self._tasks and loop.time() < deadline:
+            await asyncio.wait(list(self._tasks.values()), timeout=deadline - loop.time())
+        return self.depth()
+
+    def _take_batch(self, queue: deque) -> list:
+        batch, rest, chars = [], [], 0
+        key = queue[0][2]
+        while queue and len(batch) < MAX_EMBEDS_PER_MESSAGE:
+            item = queue.popleft()
+            if item[2] != key:
+                rest.append(item)
+                continue
+            if batch and chars + len(item[0]) > MAX_EMBED_CHARS_PER_MESSAGE:
+                # Messaggio pieno: questo embed apre il prossimo, davanti agli altri della stessa key
+                queue.appendleft(item)
+                break
+            batch.append(item)
+            chars += len(item[0])
+        queue.extendleft(reversed(rest))
+        return batch
+
+    async def _drain(self, channel: discord.abc.Messageable):
+        queue = self._queues[channel.id]
+        try:
+            while queue:
+                # Lascia arrivare gli altri eventi dello stesso burst prima di inviare
+                if len(queue) < MAX_EMBEDS_PER_MESSAGE:
+                    await asyncio.sleep(self.window)
+
+                batch = self._take_batch(queue)
+                try:
+                    with DISCORD_SEND_LATENCY.time():
+                        message = await channel.send(embeds=[embed for embed, _, _ in batch])
+                except Exception as e:
+                    # I 429 sono già contati da metrics.install_discord_ratelimit_hook
+                    self.stats["errors"] += 1
+                    logging.warning(f"⚠️ Invio di {len(batch)} embed fallito sul canale {channel.id}: {e}")
+                    for _, future, _ in batch:
+                        if not future.done():
+                            future.set_exception(e)
+                    continue
+
+                self.stats["messages"] += 1
+                self.stats["embeds"] += len(batch)
+                for _, future, _ in batch:
+                    if not future.done():
+                        future.set_result(message)
+        finally:
+            self._tasks.pop(channel.id, None)
+            if not queue:
+                self._queues.pop(channel.id, None)
+
+
+scheduler = ThreadSendScheduler()
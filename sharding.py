@@ -0,0 +1,46 @@
+from config import SHARD_COUNT, SHARD_IDS
+
+
+# ---------- Mappa degli shard ----------
+class ShardMap:
+    """
+    Quali shard del gateway girano in questo processo. Un guild appartiene allo shard
+    (guild_id >> 22) % shard_count; con un solo processo (shard_ids=None) tutti sono locali.
+    """
+
+    def __init__(self, count: int | None = SHARD_COUNT, shard_ids: list[int] | None = SHARD_IDS):
+        self.configure(count, shard_ids)
+
+    def configure(self, count: int | None, shard_ids: list[int] | None):
+        self.count = max(1, count or 1)
+        self.local = frozenset(shard_ids) if shard_ids is not None else None
+        # Predicato SQL per le righe dell'inbox di questo processo: costruito una volta, solo interi
+        if self.local is None:
+            self.sql_filter = "1"
+        else:
+            self.sql_filter = f"(shard_id IS NULL OR shard_id IN ({', '.join(str(i) for i in sorted(self.local))}))"
+
+    @property
+    def partial(self) -> bool:
+        """True se altri processi gestiscono una parte degli shard."""
+        return self.local is not None and len(self.local) < self.count
+
+    @property
+    def home(self) -> int | None:
+        """Shard a cui assegnare gli eventi presi in carico da questo processo."""
+        return min(self.local) if self.local else None
+
+    def shard_for_guild(self, guild_id) -> int | None:
+        if guild_id is None:
+            return None
+        return (int(guild_id) >> 22) % self.count
+
+    def is_local(self, shard_id: int | None) -> bool:
+        return self.local is None or shard_id is None or shard_id in self.local
+
+    def owns(self, guild_id) -> bool:
+        """I guild sconosciuti (sessioni create prima dello sharding) si considerano locali."""
+        return self.is_local(self.shard_for_guild(guild_id))
+
+
+shards = ShardMap()
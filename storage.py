@@ -0,0 +1,927 @@
+import os
+import json
+import time
+import asyncio
+import logging
+import pathlib
+import contextlib
+
+import aiosqlite
+
+from cache import TTLCache
+from routing import index as routing_index
+from sharding import shards
+from logging_setup import SAMPLED
+from metrics import timed, DB_QUERY_LATENCY
+from config import (
+    DB_PATH, DB_READERS, DB_STATEMENT_CACHE, DB_BUSY_TIMEOUT_MS, DB_FLUSH_INTERVAL_MS, DB_BATCH_SIZE,
+    SESSION_CACHE_SIZE, SESSION_CACHE_TTL,
+)
+
+
+# ---------- Connessioni ----------
+# Una sola connessione di scrittura (serializzata da _write_lock) e un pool di
+# connessioni WAL in sola lettura: le letture non aspettano mai il lock delle scritture.
+_writer: aiosqlite.Connection | None = None
+_write_lock = asyncio.Lock()
+_readers: asyncio.Queue | None = None
+_reader_conns: list[aiosqlite.Connection] = []
+
+# ---------- Coda di scrittura (group commit) ----------
+# Le scritture arrivate entro DB_FLUSH_INTERVAL_MS finiscono nella stessa transazione:
+# un solo commit (e un solo fsync) per batch invece di uno per webhook.
+_write_queue: asyncio.Queue | None = None
+_writer_task: asyncio.Task | None = None
+write_stats = {"batches": 0, "writes": 0, "errors": 0}
+
+# ---------- Cache sessioni (write-through) ----------
+# Contiene anche le assenze (None) per non interrogare il DB a ogni messaggio di utenti non registrati
+session_cache = TTLCache(maxsize=SESSION_CACHE_SIZE, ttl=SESSION_CACHE_TTL)
+_MISSING = object()
+
+
+async def _connect(readonly: bool = False) -> aiosqlite.Connection:
+    # cached_statements: sqlite3 tiene gli statement già preparati per testo SQL,
+    # per questo tutte le query sono costanti di modulo e non stringhe ricostruite.
+    if readonly:
+        uri = f"{pathlib.Path(DB_PATH).absolute().as_uri()}?mode=ro"
+        conn = await aiosqlite.connect(uri, uri=True, cached_statements=DB_STATEMENT_CACHE)
+    else:
+        conn = await aiosqlite.connect(DB_PATH, cached_statements=DB_STATEMENT_CACHE)
+    await conn.execute(f"PRAGMA busy_timeout = {DB_BUSY_TIMEOUT_MS}")
+    return conn
+
+async def open_db(migrate: bool = True, readers: int = DB_READERS):
+    """
+    Apre writer e pool di lettura e applica le migrazioni. Chiamate successive non fanno nulla.
+    Con migrate=False (processi di ingresso) lo schema deve essere già aggiornato dal gateway.
+    """
+    global _writer, _readers, _write_queue, _writer_task
+    if _writer is not None:
+        return
+
+    os.makedirs(os.path.dirname(DB_PATH), exist_ok=True)
+    writer = await _connect()
+    try:
+        await writer.execute("PRAGMA journal_mode=WAL;")
+        if migrate:
+            await _enable_incremental_vacuum(writer)
+            await migrate_db(writer)
+        else:
+            await _check_schema(writer)
+
+        _readers = asyncio.Queue()
+        for _ in range(max(1, readers)):
+            conn = await _connect(readonly=True)
+            _reader_conns.append(conn)
+            _readers.put_nowait(conn)
+    except BaseException:
+        # Con una connessione aperta il thread di aiosqlite terrebbe in vita il processo
+        for conn in _reader_conns:
+            await conn.close()
+        _reader_conns.clear()
+        _readers = None
+        await writer.close()
+        raise
+
+    _writer = writer
+    _write_queue = asyncio.Queue()
+    _writer_task = asyncio.create_task(_writer_loop())
+    logging.info(f"📦 Database SQLite inizializzato in WAL mode (1 writer, {len(_reader_conns)} reader)")
+
+async def _check_schema(conn: aiosqlite.Connection):
+    async with conn.execute("PRAGMA user_version") as cursor:
+        version = (await cursor.fetchone())[0]
+    if version < SCHEMA_VERSION:
+        raise RuntimeError(f"Schema DB v{version}, richiesto v{SCHEMA_VERSION}: va migrato dal processo gateway")
+
+async def _enable_incremental_vacuum(conn: aiosqlite.Connection):
+    # Su un DB esistente la modalità cambia solo dopo un VACUUM completo (una tantum)
+    async with conn.execute("PRAGMA auto_vacuum") as cursor:
+        if (await cursor.fetchone())[0] == 2:
+            return
+    await conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+    async with conn.execute("PRAGMA page_count") as cursor:
+        if (await cursor.fetchone())[0] > 0:
+            logging.info("🧹 Conversione del DB ad auto_vacuum incrementale (VACUUM una tantum)")
+            await conn.execute("VACUUM")
+
+async def close_db():
+    global _writer, _readers, _write_queue, _writer_task
+    if _writer_task is not None:
+        await flush_writes()
+        _writer_task.cancel()
+        _writer_task = None
+        _write_queue = None
+    for conn in _reader_conns:
+        await conn.close()
+    _reader_conns.clear()
+    _readers = None
+    if _writer is not None:
+        # Con i reader già chiusi il WAL viene riportato nel DB e azzerato: il prossimo avvio non deve rileggerlo
+        try:
+            await _writer.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        except Exception as e:
+            logging.warning(f"⚠️ Checkpoint del WAL non riuscito: {e}")
+        await _writer.close()
+        _writer = None
+    logging.info("📦 Database SQLite chiuso")
+
+@contextlib.asynccontextmanager
+async def reader():
+    """Presta una connessione in sola lettura dal pool."""
+    conn = await _readers.get()
+    try:
+        yield conn
+    finally:
+        _readers.put_nowait(conn)
+
+@contextlib.asynccontextmanager
+async def writer():
+    """Connessione di scrittura in esclusiva: commit all'uscita, rollback in caso di errore."""
+    async with _write_lock:
+        try:
+            yield _writer
+            await _writer.commit()
+        except BaseException:
+            # Anche con CancelledError: la connessione non deve restare dentro una transazione aperta
+            await _writer.rollback()
+            raise
+
+async def submit_write(*statements: tuple[str, tuple], durable: bool = True):
+    """
+    Accoda una o più istruzioni da applicare atomicamente nel prossimo batch.
+    Con durable=True attende il commit su disco, altrimenti ritorna subito (write-behind).
+    """
+    future = asyncio.get_running_loop().create_future()
+    _write_queue.put_nowait((statements, future))
+    if durable:
+        await future
+    return future
+
+async def flush_writes():
+    """Attende che tutte le scritture accodate finora siano committate."""
+    if _write_queue is not None:
+        await submit_write()
+
+def pending_writes() -> int:
+    return _write_queue.qsize() if _write_queue is not None else 0
+
+async def _writer_loop():
+    loop = asyncio.get_running_loop()
+    while True:
+        batch = [await _write_queue.get()]
+        deadline = loop.time() + DB_FLUSH_INTERVAL_MS / 1000
+        while len(batch) < DB_BATCH_SIZE:
+            if not _write_queue.empty():
+                batch.append(_write_queue.get_nowait())
+                continue
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(_write_queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+
+        try:
+            await _commit_batch(batch)
+        except Exception as e:
+            logging.exception(f"💥 Errore nel commit del batch di scrittura: {e}")
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+
+async def _commit_batch(batch: list):
+    results = []
+    async with _write_lock:
+        with DB_QUERY_LATENCY.time(function="commit_batch"):
+            try:
+                await _writer.execute("BEGIN")
+                for statements, future in batch:
+                    # Ogni richiesta nel suo savepoint: un errore non annulla le altre del batch
+                    await _writer.execute("SAVEPOINT write_op")
+                    try:
+                        for sql, params in statements:
+                            await _writer.execute(sql, params)
+                        await _writer.execute("RELEASE write_op")
+                        results.append((future, None))
+                    except Exception as e:
+                        await _writer.execute("ROLLBACK TO write_op")
+                        await _writer.execute("RELEASE write_op")
+                        results.append((future, e))
+                await _writer.commit()
+            except BaseException as e:
+                # Un CancelledError a metà batch lascerebbe aperti BEGIN e savepoint: il BEGIN successivo fallirebbe
+                await _writer.rollback()
+                if not isinstance(e, Exception):
+                    for _, future in batch:
+                        future.cancel()
+                    raise
+                results = [(future, e) for _, future in batch]
+
+    write_stats["batches"] += 1
+    for future, error in results:
+        write_stats["writes"] += 1
+        if future.done():
+            continue
+        if error is None:
+            future.set_result(None)
+        else:
+            write_stats["errors"] += 1
+            future.set_exception(error)
+            # Nessuno attende le scritture write-behind: l'errore va almeno nel log
+            future.add_done_callback(lambda f: f.exception())
+            logging.error(f"💥 Scrittura DB fallita: {error}")
+
+async def fetchone(sql: str, params=()):
+    async with reader() as conn:
+        async with conn.execute(sql, params) as cursor:
+            return await cursor.fetchone()
+
+async def fetchall(sql: str, params=()):
+    async with reader() as conn:
+        async with conn.execute(sql, params) as cursor:
+            return await cursor.fetchall()
+
+
+# ---------- Schema ----------
+# Versione dello schema salvata in PRAGMA user_version
+SCHEMA_VERSION = 12
+
+# Istante attuale in secondi epoch, come time.time()
+SQL_NOW = "CAST(strftime('%s', 'now') AS REAL)"
+
+# Gli aggiornamenti di last_seen per la stessa chiave sono scritti al massimo una volta ogni _TOUCH_EVERY secondi
+_TOUCH_EVERY = 3600
+_touched = TTLCache(maxsize=SESSION_CACHE_SIZE, ttl=_TOUCH_EVERY)
+
+# Campi della sessione salvati come colonne indicizzabili; il resto rimane in session_data
+SESSION_COLUMNS = ("thread_id", "username", "bearer_token", "secret_key", "guild_id")
+
+async def migrate_db(conn: aiosqlite.Connection):
+    """
+    Porta lo schema alla SCHEMA_VERSION applicando in ordine le migrazioni mancanti.
+    Ogni migrazione gira in una transazione e aggiorna PRAGMA user_version.
+    """
+    async with conn.execute("PRAGMA user_version") as cursor:
+        row = await cursor.fetchone()
+        version = row[0] if row else 0
+
+    for target, migration in sorted(MIGRATIONS.items()):
+        if target <= version:
+            continue
+        logging.info(f"🛠️ Migrazione schema DB v{version} → v{target}")
+        try:
+            await conn.execute("BEGIN")
+            await migration(conn)
+            await conn.execute(f"PRAGMA user_version = {target}")
+            await conn.commit()
+        except Exception:
+            await conn.rollback()
+            raise
+        version = target
+
+async def _migrate_v1(conn: aiosqlite.Connection):
+    # Schema originale: tutta la sessione dentro il JSON di session_data
+    await conn.execute("""
+        CREATE TABLE IF NOT EXISTS sessions (
+            user_id TEXT PRIMARY KEY,
+            uex_username TEXT NOT NULL,
+            session_data TEXT NOT NULL,
+            last_update TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+
+async def _migrate_v2(conn: aiosqlite.Connection):
+    # Estrae thread_id, username e credenziali dal JSON in colonne dedicate e indicizzate
+    await conn.execute("""
+        CREATE TABLE sessions_v2 (
+            user_id TEXT PRIMARY KEY,
+            uex_username TEXT NOT NULL DEFAULT '',
+            thread_id INTEGER,
+            username TEXT,
+            bearer_token TEXT,
+            secret_key TEXT,
+            session_data TEXT NOT NULL DEFAULT '{}',
+            last_update TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+
+    rows = []
+    async with conn.execute("SELECT user_id, uex_username, session_data, last_update FROM sessions") as cursor:
+        async for user_id, uex_username, session_json, last_update in cursor:
+            try:
+                session = json.loads(session_json) if session_json else {}
+            except Exception as e:
+                logging.error(f"💥 session_data non valido per user_id={user_id}, migrato vuoto: {e}")
+                session = {}
+            # Colonne esistenti alla v2: SESSION_COLUMNS cresce con le migrazioni successive
+            columns = [session.pop(key, None) for key in ("thread_id", "username", "bearer_token", "secret_key")]
+            rows.append((user_id, uex_username or "", *columns, json.dumps(session), last_update))
+
+    await conn.executemany("""
+        INSERT INTO sessions_v2 (user_id, uex_username, thread_id, username, bearer_token, secret_key, session_data, last_update)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+    """, rows)
+    await conn.execute("DROP TABLE sessions")
+    await conn.execute("ALTER TABLE sessions_v2 RENAME TO sessions")
+    await conn.execute("CREATE INDEX IF NOT EXISTS idx_sessions_thread_id ON sessions(thread_id)")
+    await conn.execute("CREATE INDEX IF NOT EXISTS idx_sessions_username ON sessions(username)")
+    logging.info(f"📦 Migrate {len(rows)} sessioni allo schema a colonne")
+
+async def _migrate_v3(conn: aiosqlite.Connection):
+    # Prima creata a parte da init_negotiation_links_table()
+    await conn.execute("""
+        CREATE TABLE IF NOT EXISTS negotiation_links (
+            negotiation_hash TEXT PRIMARY KEY,
+            buyer_id TEXT NOT NULL,
+            seller_id TEXT NOT NULL
+        )
+    """)
+
+async def _migrate_v4(conn: aiosqlite.Connection):
+    # Inbox dei webhook: l'evento è salvato prima dell'ACK e smaltito dai worker
+    await conn.execute("""
+        CREATE TABLE IF NOT EXISTS webhook_inbox (
+            event_id TEXT PRIMARY KEY,
+            event_type TEXT NOT NULL,
+            user_id TEXT NOT NULL,
+            body TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'pending',
+            attempts INTEGER NOT NULL DEFAULT 0,
+            next_attempt_at REAL NOT NULL DEFAULT 0,
+            last_error TEXT,
+            received_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+    await conn.execute("CREATE INDEX IF NOT EXISTS idx_webhook_inbox_status ON webhook_inbox(status, next_attempt_at)")
+
+async def _migrate_v5(conn: aiosqlite.Connection):
+    # Impronte dei webhook già accettati, per scartare i duplicati anche dopo un riavvio
+    await conn.execute("""
+        CREATE TABLE IF NOT EXISTS webhook_dedup (
+            fingerprint TEXT PRIMARY KEY,
+            seen_at REAL NOT NULL
+        )
+    """)
+    await conn.execute("CREATE INDEX IF NOT EXISTS idx_webhook_dedup_seen_at ON webhook_dedup(seen_at)")
+
+async def _migrate_v6(conn: aiosqlite.Connection):
+    # Outbox delle risposte Discord → UEX, consegnate in ordine per negoziazione
+    await conn.execute("""
+        CREATE TABLE IF NOT EXISTS reply_outbox (
+            reply_id TEXT PRIMARY KEY,
+            user_id TEXT NOT NULL,
+            negotiation_hash TEXT NOT NULL,
+            message TEXT NOT NULL,
+            channel_id INTEGER,
+            message_id INTEGER,
+            status TEXT NOT NULL DEFAULT 'pending',
+            attempts INTEGER NOT NULL DEFAULT 0,
+            next_attempt_at REAL NOT NULL DEFAULT 0,
+            last_error TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+    await conn.execute("CREATE INDEX IF NOT EXISTS idx_reply_outbox_status ON reply_outbox(status)")
+
+async def _migrate_v7(conn: aiosqlite.Connection):
+    # Sharding: guild del thread di ogni sessione e shard che deve elaborare ogni webhook
+    await conn.execute("ALTER TABLE sessions ADD COLUMN guild_id INTEGER")
+    await conn.execute("ALTER TABLE webhook_inbox ADD COLUMN shard_id INTEGER")
+
+async def _migrate_v8(conn: aiosqlite.Connection):
+    # Valori chiave/valore dello stato del bot (es. hash dei comandi slash sincronizzati)
+    await conn.execute("""
+        CREATE TABLE IF NOT EXISTS meta (
+            key TEXT PRIMARY KEY,
+            value TEXT,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+
+async def _migrate_v9(conn: aiosqlite.Connection):
+    # Ultima attività (epoch) di sessioni e link: il janitor elimina quelli inattivi
+    await conn.execute("ALTER TABLE sessions ADD COLUMN last_seen REAL")
+    await conn.execute("ALTER TABLE negotiation_links ADD COLUMN last_seen REAL")
+    await conn.execute(f"UPDATE sessions SET last_seen = {SQL_NOW}")
+    await conn.execute(f"UPDATE negotiation_links SET last_seen = {SQL_NOW}")
+    await conn.execute("CREATE INDEX IF NOT EXISTS idx_sessions_last_seen ON sessions(last_seen)")
+    await conn.execute("CREATE INDEX IF NOT EXISTS idx_negotiation_links_last_seen ON negotiation_links(last_seen)")
+
+async def _migrate_v10(conn: aiosqlite.Connection):
+    # Messaggi di notifica inviati dal bot: una reply trova l'hash dal message id senza leggere l'embed
+    await conn.execute("""
+        CREATE TABLE IF NOT EXISTS notification_messages (
+            message_id INTEGER PRIMARY KEY,
+            negotiation_hash TEXT NOT NULL,
+            thread_id INTEGER,
+            event_type TEXT,
+            created_at REAL NOT NULL
+        )
+    """)
+    await conn.execute("CREATE INDEX IF NOT EXISTS idx_notification_messages_created_at ON notification_messages(created_at)")
+
+async def _migrate_v11(conn: aiosqlite.Connection):
+    # Eventi in attesa del riepilogo digest: l'evento lascia l'inbox solo dopo essere stato salvato qui
+    await conn.execute("""
+        CREATE TABLE IF NOT EXISTS digest_entries (
+            entry_id TEXT PRIMARY KEY,
+            thread_id INTEGER NOT NULL,
+            shard_id INTEGER,
+            negotiation_hash TEXT,
+            title TEXT,
+            line TEXT NOT NULL,
+            due_at REAL NOT NULL
+        )
+    """)
+
+async def _migrate_v12(conn: aiosqlite.Connection):
+    # Shard del thread di ogni risposta: più processi sullo stesso DB si dividono l'outbox come l'inbox
+    await conn.execute("ALTER TABLE reply_outbox ADD COLUMN shard_id INTEGER")
+
+MIGRATIONS = {
+    1: _migrate_v1,
+    2: _migrate_v2,
+    3: _migrate_v3,
+    4: _migrate_v4,
+    5: _migrate_v5,
+    6: _migrate_v6,
+    7: _migrate_v7,
+    8: _migrate_v8,
+    9: _migrate_v9,
+    10: _migrate_v10,
+    11: _migrate_v11,
+    12: _migrate_v12,
+}
+
+
+# ---------- Query ----------
+SESSION_FIELDS = "thread_id, username, bearer_token, secret_key, guild_id, session_data"
+
+SQL_GET_SESSION = f"SELECT {SESSION_FIELDS} FROM sessions WHERE user_id = ?"
+SQL_FIND_SESSION_BY_USERNAME = f"SELECT user_id, {SESSION_FIELDS} FROM sessions WHERE username = ?"
+SQL_SAVE_SESSION = f"""
+    INSERT OR REPLACE INTO sessions (user_id, uex_username, thread_id, username, bearer_token, secret_key, guild_id, session_data, last_update, last_seen)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, CURRENT_TIMESTAMP, {SQL_NOW})
+"""
+SQL_DELETE_SESSION = "DELETE FROM sessions WHERE user_id = ?"
+SQL_SESSIONS_BY_THREAD = "SELECT user_id FROM sessions WHERE thread_id = ?"
+SQL_DELETE_SESSIONS_BY_THREAD = "DELETE FROM sessions WHERE thread_id = ?"
+SQL_COUNT_SESSIONS = "SELECT COUNT(*), COUNT(thread_id) FROM sessions"
+SQL_ROUTING_SESSIONS = """
+    SELECT user_id, username, thread_id, guild_id, json_extract(session_data, '$.digest_minutes') FROM sessions
+"""
+SQL_POLLABLE_SESSIONS = """
+    SELECT user_id, guild_id FROM sessions
+    WHERE thread_id IS NOT NULL AND bearer_token IS NOT NULL AND secret_key IS NOT NULL
+"""
+SQL_TOUCH_SESSION = "UPDATE sessions SET last_seen = ? WHERE user_id = ?"
+SQL_EXPIRE_SESSIONS = """
+    DELETE FROM sessions WHERE rowid IN (SELECT rowid FROM sessions WHERE last_seen < ? LIMIT ?)
+    RETURNING user_id
+"""
+SQL_SESSION_THREADS_AFTER = """
+    SELECT rowid, thread_id, guild_id FROM sessions
+    WHERE rowid > ? AND thread_id IS NOT NULL ORDER BY rowid LIMIT ?
+"""
+
+SQL_SAVE_LINK = f"""
+    INSERT OR REPLACE INTO negotiation_links (negotiation_hash, buyer_id, seller_id, last_seen)
+    VALUES (?, ?, ?, {SQL_NOW})
+"""
+SQL_GET_LINK = "SELECT buyer_id, seller_id FROM negotiation_links WHERE negotiation_hash = ?"
+SQL_DELETE_LINK = "DELETE FROM negotiation_links WHERE negotiation_hash = ?"
+SQL_ROUTING_LINKS = "SELECT negotiation_hash, buyer_id, seller_id FROM negotiation_links"
+SQL_TOUCH_LINK = "UPDATE negotiation_links SET last_seen = ? WHERE negotiation_hash = ?"
+SQL_EXPIRE_LINKS = """
+    DELETE FROM negotiation_links WHERE rowid IN (SELECT rowid FROM negotiation_links WHERE last_seen < ? LIMIT ?)
+    RETURNING negotiation_hash
+"""
+
+SQL_SAVE_NOTIFICATION = """
+    INSERT OR REPLACE INTO notification_messages (message_id, negotiation_hash, thread_id, event_type, created_at)
+    VALUES (?, ?, ?, ?, ?)
+"""
+SQL_GET_NOTIFICATION_HASH = "SELECT negotiation_hash FROM notification_messages WHERE message_id = ?"
+SQL_EXPIRE_NOTIFICATIONS = """
+    DELETE FROM notification_messages WHERE rowid IN (
+        SELECT rowid FROM notification_messages WHERE created_at < ? LIMIT ?
+    )
+    RETURNING message_id
+"""
+
+SQL_INBOX_ADD = """
+    INSERT INTO webhook_inbox (event_id, event_type, user_id, body, status, shard_id, attempts, next_attempt_at)
+    VALUES (?, ?, ?, ?, ?, ?, 0, 0)
+"""
+# {shards} è il predicato sugli shard di questo processo (sharding.ShardMap.sql_filter)
+SQL_INBOX_HAS_QUEUED = "SELECT 1 FROM webhook_inbox WHERE status = 'queued' AND {shards} LIMIT 1"
+SQL_INBOX_CLAIM = """
+    UPDATE webhook_inbox SET status = 'pending', shard_id = COALESCE(shard_id, ?)
+    WHERE event_id IN (
+        SELECT event_id FROM webhook_inbox WHERE status = 'queued' AND {shards} ORDER BY rowid LIMIT ?
+    )
+    RETURNING rowid, event_id, event_type, user_id, body
+"""
+SQL_INBOX_PENDING = """
+    SELECT event_id, event_type, user_id, body, attempts, next_attempt_at
+    FROM webhook_inbox WHERE status = 'pending' AND {shards} ORDER BY received_at, rowid
+"""
+SQL_INBOX_DONE = "DELETE FROM webhook_inbox WHERE event_id = ?"
+SQL_INBOX_RETRY = "UPDATE webhook_inbox SET attempts = ?, next_attempt_at = ?, last_error = ? WHERE event_id = ?"
+SQL_INBOX_DEAD = "UPDATE webhook_inbox SET status = 'dead', attempts = ?, last_error = ? WHERE event_id = ?"
+SQL_INBOX_COUNTS = "SELECT status, COUNT(*) FROM webhook_inbox GROUP BY status"
+SQL_INBOX_QUEUED = "SELECT COUNT(*) FROM webhook_inbox WHERE status = 'queued'"
+# received_at/created_at sono CURRENT_TIMESTAMP (testo UTC): il limite in epoch si converte nello stesso formato
+SQL_EXPIRE_INBOX_DEAD = """
+    DELETE FROM webhook_inbox WHERE rowid IN (
+        SELECT rowid FROM webhook_inbox WHERE status = 'dead' AND received_at < datetime(?, 'unixepoch') LIMIT ?
+    )
+    RETURNING event_id
+"""
+
+SQL_OUTBOX_ADD = """
+    INSERT INTO reply_outbox (reply_id, user_id, negotiation_hash, message, channel_id, message_id, shard_id, status, attempts, next_attempt_at)
+    VALUES (?, ?, ?, ?, ?, ?, ?, 'pending', 0, 0)
+"""
+# {shards} come per l'inbox: ogni processo riprende solo le risposte dei propri thread
+SQL_OUTBOX_PENDING = """
+    SELECT reply_id, user_id, negotiation_hash, message, channel_id, message_id, attempts, next_attempt_at
+    FROM reply_outbox WHERE status = 'pending' AND {shards} ORDER BY rowid
+"""
+SQL_OUTBOX_DONE = "DELETE FROM reply_outbox WHERE reply_id = ?"
+SQL_OUTBOX_SENDING = "UPDATE reply_outbox SET status = 'sending' WHERE reply_id = ?"
+SQL_OUTBOX_RETRY = "UPDATE reply_outbox SET status = 'pending', attempts = ?, next_attempt_at = ?, last_error = ? WHERE reply_id = ?"
+SQL_OUTBOX_DEAD = "UPDATE reply_outbox SET status = 'dead', attempts = ?, last_error = ? WHERE reply_id = ?"
+SQL_OUTBOX_UNCERTAIN = "UPDATE reply_outbox SET status = 'uncertain', attempts = ?, last_error = ? WHERE reply_id = ?"
+SQL_EXPIRE_OUTBOX_FAILED = """
+    DELETE FROM reply_outbox WHERE rowid IN (
+        SELECT rowid FROM reply_outbox
+        WHERE status IN ('dead', 'uncertain') AND created_at < datetime(?, 'unixepoch') LIMIT ?
+    )
+    RETURNING reply_id
+"""
+SQL_OUTBOX_INTERRUPTED = """
+    UPDATE reply_outbox SET status = 'uncertain', last_error = ? WHERE status = 'sending' AND {shards}
+    RETURNING reply_id, user_id, negotiation_hash, message, channel_id, message_id, attempts
+"""
+
+SQL_DIGEST_ADD = """
+    INSERT INTO digest_entries (entry_id, thread_id, shard_id, negotiation_hash, title, line, due_at)
+    VALUES (?, ?, ?, ?, ?, ?, ?)
+"""
+# {shards} è il predicato sugli shard di questo processo (sharding.ShardMap.sql_filter)
+SQL_DIGEST_PENDING = """
+    SELECT entry_id, thread_id, negotiation_hash, title, line, due_at
+    FROM digest_entries WHERE {shards} ORDER BY rowid
+"""
+SQL_DIGEST_DONE = "DELETE FROM digest_entries WHERE entry_id = ?"
+
+SQL_DEDUP_SEEN = "SELECT 1 FROM webhook_dedup WHERE fingerprint = ? AND seen_at >= ?"
+SQL_DEDUP_MARK = "INSERT OR REPLACE INTO webhook_dedup (fingerprint, seen_at) VALUES (?, ?)"
+SQL_DEDUP_FORGET = "DELETE FROM webhook_dedup WHERE fingerprint = ?"
+SQL_DEDUP_PRUNE = "DELETE FROM webhook_dedup WHERE seen_at < ?"
+
+SQL_GET_META = "SELECT value FROM meta WHERE key = ?"
+SQL_SET_META = "INSERT OR REPLACE INTO meta (key, value, updated_at) VALUES (?, ?, CURRENT_TIMESTAMP)"
+
+
+# ---------- Sessioni ----------
+def row_to_session(row) -> dict:
+    """Ricostruisce il dict di sessione dalle colonne + il JSON dei campi extra."""
+    session = json.loads(row[-1]) if row[-1] else {}
+    for key, value in zip(SESSION_COLUMNS, row):
+        if value is not None:
+            session[key] = value
+    return session
+
+@timed(DB_QUERY_LATENCY, function="get_user_session")
+async def get_user_session(user_id: str) -> dict | None:
+    key = str(user_id)
+    cached = session_cache.get(key, _MISSING)
+    if cached is not _MISSING:
+        return dict(cached) if cached is not None else None
+
+    row = await fetchone(SQL_GET_SESSION, (key,))
+    session = row_to_session(row) if row else None
+    # Se nel frattempo una save/remove ha già aggiornato la cache, il valore letto è vecchio
+    if key not in session_cache:
+        session_cache.set(key, session)
+    return dict(session) if session is not None else None
+
+def _forget_on_failure(key: str, value):
+    """
+    Se la scrittura fallisce, cache e indice non devono tenere un valore mai salvato:
+    la voce viene tolta (se nessuna scrittura successiva l'ha già sostituita) e la prossima lettura va sul DB.
+    """
+    def callback(future: asyncio.Future):
+        if not future.cancelled() and future.exception() is None:
+            return
+        if session_cache.get(key, _MISSING) is value:
+            session_cache.pop(key)
+            routing_index.remove_session(key)
+    return callback
+
+@timed(DB_QUERY_LATENCY, function="save_user_session")
+async def save_user_session(user_id: str, session: dict, durable: bool = True):
+    extra = {k: v for k, v in session.items() if k not in SESSION_COLUMNS}
+    uex_username = session.get("uex_username", "")  # valore di default vuoto
+    # La cache viene aggiornata subito: le letture vedono il nuovo valore anche prima del commit
+    cached = dict(session)
+    session_cache.set(str(user_id), cached)
+    routing_index.set_session(user_id, session)
+    future = await submit_write(
+        (SQL_SAVE_SESSION, (str(user_id), uex_username, *(session.get(key) for key in SESSION_COLUMNS), json.dumps(extra))),
+        durable=False
+    )
+    future.add_done_callback(_forget_on_failure(str(user_id), cached))
+    if durable:
+        await future
+    logging.info(f"💾 Sessione salvata per utente {user_id}", extra=SAMPLED)
+
+@timed(DB_QUERY_LATENCY, function="remove_user_session")
+async def remove_user_session(user_id: str, durable: bool = True):
+    session_cache.set(str(user_id), None)
+    routing_index.remove_session(user_id)
+    future = await submit_write((SQL_DELETE_SESSION, (str(user_id),)), durable=False)
+    future.add_done_callback(_forget_on_failure(str(user_id), None))
+    if durable:
+        await future
+    logging.info(f"🗑️ Sessione rimossa per utente {user_id}")
+
+@timed(DB_QUERY_LATENCY, function="remove_sessions_by_thread")
+async def remove_sessions_by_thread(thread_id: int) -> list[str]:
+    """Elimina le sessioni collegate al thread e restituisce gli user_id rimossi."""
+    user_ids = [row[0] for row in await fetchall(SQL_SESSIONS_BY_THREAD, (thread_id,))]
+    if user_ids:
+        for user_id in user_ids:
+            session_cache.set(user_id, None)
+            routing_index.remove_session(user_id)
+        await submit_write((SQL_DELETE_SESSIONS_BY_THREAD, (thread_id,)))
+    return user_ids
+
+async def touch_session(user_id: str):
+    """Segna l'attività dell'utente (write-behind, al più una scrittura ogni _TOUCH_EVERY)."""
+    key = ("session", str(user_id))
+    if key not in _touched:
+        _touched.set(key, True)
+        await submit_write((SQL_TOUCH_SESSION, (time.time(), str(user_id))), durable=False)
+
+@timed(DB_QUERY_LATENCY, function="expire_sessions")
+async def expire_sessions(before: float, limit: int) -> list[str]:
+    """Elimina fino a `limit` sessioni inattive da prima di `before` e restituisce gli user_id."""
+    async with writer() as conn:
+        async with conn.execute(SQL_EXPIRE_SESSIONS, (before, limit)) as cursor:
+            user_ids = [row[0] for row in await cursor.fetchall()]
+    for user_id in user_ids:
+        session_cache.set(user_id, None)
+        routing_index.remove_session(user_id)
+    return user_ids
+
+@timed(DB_QUERY_LATENCY, function="session_threads_after")
+async def session_threads_after(rowid: int, limit: int) -> list[tuple]:
+    """Pagina (rowid, thread_id, guild_id) delle sessioni con thread, per la riconciliazione."""
+    return await fetchall(SQL_SESSION_THREADS_AFTER, (rowid, limit))
+
+@timed(DB_QUERY_LATENCY, function="pollable_sessions")
+async def pollable_sessions() -> list[tuple]:
+    """(user_id, guild_id) degli utenti con thread e credenziali UEX."""
+    return await fetchall(SQL_POLLABLE_SESSIONS)
+
+async def get_user_thread_id(user_id: str) -> str | None:
+    session = await get_user_session(user_id)
+    if session:
+        return session.get("thread_id")
+    return None
+
+@timed(DB_QUERY_LATENCY, function="find_session_by_username")
+async def find_session_by_username(username: str):
+    row = await fetchone(SQL_FIND_SESSION_BY_USERNAME, (username,))
+    if row:
+        return {"user_id": row[0], **row_to_session(row[1:])}
+    return None
+
+@timed(DB_QUERY_LATENCY, function="warm_routing_index")
+async def warm_routing_index():
+    """Costruisce l'indice di routing in memoria da sessions e negotiation_links."""
+    sessions = await fetchall(SQL_ROUTING_SESSIONS)
+    links = await fetchall(SQL_ROUTING_LINKS)
+    routing_index.load(sessions, links)
+    logging.info(f"🧭 Indice di routing pronto: {len(sessions)} sessioni, {len(links)} link")
+
+@timed(DB_QUERY_LATENCY, function="count_sessions")
+async def count_sessions() -> tuple[int, int]:
+    """Restituisce (utenti registrati, sessioni con thread)."""
+    row = await fetchone(SQL_COUNT_SESSIONS)
+    return tuple(row) if row else (0, 0)
+
+
+# ---------- Negotiation links ----------
+@timed(DB_QUERY_LATENCY, function="save_negotiation_link")
+async def save_negotiation_link(negotiation_hash: str, buyer_id: str, seller_id: str, durable: bool = True):
+    routing_index.set_link(negotiation_hash, buyer_id, seller_id)
+    await submit_write((SQL_SAVE_LINK, (negotiation_hash, buyer_id, seller_id)), durable=durable)
+    logging.info(f"🔗 Link salvato: {negotiation_hash} → buyer={buyer_id}, seller={seller_id}", extra=SAMPLED)
+
+@timed(DB_QUERY_LATENCY, function="get_negotiation_link")
+async def get_negotiation_link(negotiation_hash: str):
+    link = routing_index.link(negotiation_hash) if routing_index.ready else None
+    if link is not None:
+        return link
+    # Il link può essere stato salvato da un altro processo (shard parziali, ingress separati) dopo il warm dell'indice
+    row = await fetchone(SQL_GET_LINK, (negotiation_hash,))
+    if row is None:
+        return None
+    if routing_index.ready:
+        routing_index.set_link(negotiation_hash, row[0], row[1])
+    return {"buyer_id": row[0], "seller_id": row[1]}
+
+@timed(DB_QUERY_LATENCY, function="delete_negotiation_link")
+async def delete_negotiation_link(negotiation_hash: str, durable: bool = True):
+    routing_index.remove_link(negotiation_hash)
+    await submit_write((SQL_DELETE_LINK, (negotiation_hash,)), durable=durable)
+    logging.info(f"❌ Link eliminato: {negotiation_hash}", extra=SAMPLED)
+
+
+async def touch_negotiation_link(negotiation_hash: str):
+    key = ("link", negotiation_hash)
+    if key not in _touched:
+        _touched.set(key, True)
+        await submit_write((SQL_TOUCH_LINK, (time.time(), negotiation_hash)), durable=False)
+
+@timed(DB_QUERY_LATENCY, function="expire_negotiation_links")
+async def expire_negotiation_links(before: float, limit: int) -> list[str]:
+    async with writer() as conn:
+        async with conn.execute(SQL_EXPIRE_LINKS, (before, limit)) as cursor:
+            hashes = [row[0] for row in await cursor.fetchall()]
+    for negotiation_hash in hashes:
+        routing_index.remove_link(negotiation_hash)
+    return hashes
+
+
+# ---------- Messaggi di notifica ----------
+async def save_notification_message(message_id: int, negotiation_hash: str, thread_id: int, event_type: str):
+    # Write-behind: una reply arriva comunque dopo il prossimo group commit
+    await submit_write(
+        (SQL_SAVE_NOTIFICATION, (message_id, negotiation_hash, thread_id, event_type, time.time())),
+        durable=False
+    )
+
+@timed(DB_QUERY_LATENCY, function="get_notification_hash")
+async def get_notification_hash(message_id: int) -> str | None:
+    row = await fetchone(SQL_GET_NOTIFICATION_HASH, (message_id,))
+    return row[0] if row else None
+
+@timed(DB_QUERY_LATENCY, function="expire_notification_messages")
+async def expire_notification_messages(before: float, limit: int) -> list[int]:
+    async with writer() as conn:
+        async with conn.execute(SQL_EXPIRE_NOTIFICATIONS, (before, limit)) as cursor:
+            return [row[0] for row in await cursor.fetchall()]
+
+
+# ---------- Webhook inbox ----------
+@timed(DB_QUERY_LATENCY, function="inbox_add")
+async def inbox_add(event_id: str, event_type: str, user_id: str, body: str, status: str = "pending", shard_id: int | None = None):
+    # Sempre durable: l'ACK al mittente parte solo dopo il commit
+    await submit_write((SQL_INBOX_ADD, (event_id, event_type, user_id, body, status, shard_id)))
+
+@timed(DB_QUERY_LATENCY, function="inbox_claim")
+async def inbox_claim(limit: int) -> list[tuple]:
+    """
+    Preleva gli eventi 'queued' degli shard di questo processo e li passa in 'pending'.
+    L'UPDATE ... RETURNING è atomico anche con più processi gateway sullo stesso DB.
+    """
+    if not await fetchone(SQL_INBOX_HAS_QUEUED.format(shards=shards.sql_filter)):
+        return []
+    async with writer() as conn:
+        async with conn.execute(SQL_INBOX_CLAIM.format(shards=shards.sql_filter), (shards.home, limit)) as cursor:
+            rows = await cursor.fetchall()
+    return [tuple(row[1:]) for row in sorted(rows)]
+
+@timed(DB_QUERY_LATENCY, function="inbox_pending")
+async def inbox_pending() -> list[tuple]:
+    return await fetchall(SQL_INBOX_PENDING.format(shards=shards.sql_filter))
+
+async def inbox_done(event_id: str):
+    # Se il commit andasse perso l'evento verrebbe solo rielaborato al riavvio
+    await submit_write((SQL_INBOX_DONE, (event_id,)), durable=False)
+
+async def inbox_retry(event_id: str, attempts: int, next_attempt_at: float, error: str):
+    await submit_write((SQL_INBOX_RETRY, (attempts, next_attempt_at, error, event_id)), durable=False)
+
+async def inbox_dead(event_id: str, attempts: int, error: str):
+    await submit_write((SQL_INBOX_DEAD, (attempts, error, event_id)))
+
+@timed(DB_QUERY_LATENCY, function="expire_inbox_dead")
+async def expire_inbox_dead(before: float, limit: int) -> list[str]:
+    """Elimina fino a `limit` eventi 'dead' ricevuti prima di `before`."""
+    async with writer() as conn:
+        async with conn.execute(SQL_EXPIRE_INBOX_DEAD, (before, limit)) as cursor:
+            return [row[0] for row in await cursor.fetchall()]
+
+@timed(DB_QUERY_LATENCY, function="inbox_counts")
+async def inbox_counts() -> dict:
+    return dict(await fetchall(SQL_INBOX_COUNTS))
+
+@timed(DB_QUERY_LATENCY, function="inbox_queued")
+async def inbox_queued() -> int:
+    """Eventi salvati e non ancora presi in carico da un processo gateway (tutti gli shard)."""
+    row = await fetchone(SQL_INBOX_QUEUED)
+    return row[0] if row else 0
+
+
+# ---------- Reply outbox ----------
+@timed(DB_QUERY_LATENCY, function="outbox_add")
+async def outbox_add(reply_id: str, user_id: str, negotiation_hash: str, message: str, channel_id: int, message_id: int, shard_id: int | None = None):
+    await submit_write((SQL_OUTBOX_ADD, (reply_id, str(user_id), negotiation_hash, message, channel_id, message_id, shard_id)))
+
+@timed(DB_QUERY_LATENCY, function="outbox_pending")
+async def outbox_pending() -> list[tuple]:
+    return await fetchall(SQL_OUTBOX_PENDING.format(shards=shards.sql_filter))
+
+async def outbox_done(reply_id: str):
+    await submit_write((SQL_OUTBOX_DONE, (reply_id,)), durable=False)
+
+async def outbox_sending(reply_id: str):
+    # Durevole prima della POST: dopo un crash la risposta risulta incerta invece di essere reinviata
+    await submit_write((SQL_OUTBOX_SENDING, (reply_id,)))
+
+async def outbox_retry(reply_id: str, attempts: int, next_attempt_at: float, error: str):
+    await submit_write((SQL_OUTBOX_RETRY, (attempts, next_attempt_at, error, reply_id)), durable=False)
+
+async def outbox_dead(reply_id: str, attempts: int, error: str):
+    await submit_write((SQL_OUTBOX_DEAD, (attempts, error, reply_id)))
+
+async def outbox_uncertain(reply_id: str, attempts: int, error: str):
+    await submit_write((SQL_OUTBOX_UNCERTAIN, (attempts, error, reply_id)))
+
+@timed(DB_QUERY_LATENCY, function="expire_outbox_failed")
+async def expire_outbox_failed(before: float, limit: int) -> list[str]:
+    """Elimina fino a `limit` risposte fallite o incerte create prima di `before`."""
+    async with writer() as conn:
+        async with conn.execute(SQL_EXPIRE_OUTBOX_FAILED, (before, limit)) as cursor:
+            return [row[0] for row in await cursor.fetchall()]
+
+async def outbox_interrupted(error: str) -> list[tuple]:
+    """
+    Risposte di questo processo rimaste 'sending' da un'esecuzione interrotta: passano a 'uncertain'
+    e vengono restituite. Quelle degli shard di altri processi possono essere invii ancora in corso.
+    """
+    async with writer() as conn:
+        async with conn.execute(SQL_OUTBOX_INTERRUPTED.format(shards=shards.sql_filter), (error,)) as cursor:
+            return await cursor.fetchall()
+
+
+# ---------- Digest ----------
+async def digest_add(entry_id: str, thread_id: int, shard_id: int | None, negotiation_hash: str | None, title: str | None, line: str, due_at: float):
+    # Write-behind: l'inbox_done dell'evento è accodato dopo, quindi finisce nello stesso commit o in uno successivo
+    await submit_write(
+        (SQL_DIGEST_ADD, (entry_id, thread_id, shard_id, negotiation_hash, title, line, due_at)),
+        durable=False
+    )
+
+@timed(DB_QUERY_LATENCY, function="digest_pending")
+async def digest_pending() -> list[tuple]:
+    return await fetchall(SQL_DIGEST_PENDING.format(shards=shards.sql_filter))
+
+async def digest_done(entry_ids: list[str]):
+    # Se il commit andasse perso il riepilogo verrebbe solo reinviato al riavvio
+    await submit_write(*((SQL_DIGEST_DONE, (entry_id,)) for entry_id in entry_ids), durable=False)
+
+
+# ---------- Dedup webhook ----------
+@timed(DB_QUERY_LATENCY, function="dedup_seen")
+async def dedup_seen(fingerprint: str, since: float) -> bool:
+    return await fetchone(SQL_DEDUP_SEEN, (fingerprint, since)) is not None
+
+async def dedup_mark(fingerprint: str, seen_at: float):
+    await submit_write((SQL_DEDUP_MARK, (fingerprint, seen_at)), durable=False)
+
+async def dedup_forget(fingerprint: str):
+    await submit_write((SQL_DEDUP_FORGET, (fingerprint,)), durable=False)
+
+async def dedup_prune(before: float):
+    await submit_write((SQL_DEDUP_PRUNE, (before,)), durable=False)
+
+
+# ---------- Meta ----------
+async def get_meta(key: str) -> str | None:
+    row = await fetchone(SQL_GET_META, (key,))
+    return row[0] if row else None
+
+async def set_meta(key: str, value: str):
+    await submit_write((SQL_SET_META, (key, value)))
+
+
+# ---------- Manutenzione ----------
+@timed(DB_QUERY_LATENCY, function="incremental_vacuum")
+async def incremental_vacuum(pages: int) -> int:
+    """Restituisce al filesystem fino a `pages` pagine libere; restituisce quante ne restano."""
+    async with writer() as conn:
+        # La pragma libera una pagina per step: va consumata fino in fondo
+        async with conn.execute(f"PRAGMA incremental_vacuum({int(pages)})") as cursor:
+            await cursor.fetchall()
+        async with conn.execute("PRAGMA freelist_count") as cursor:
+            return (await cursor.fetchone())[0]
@@ -0,0 +1,28 @@
+import os
+import sys
+import asyncio
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+# config legge l'ambiente all'import: valori minimi per caricare i moduli senza .env
+os.environ.setdefault("DB_PATH", os.path.join(ROOT, ".pytest_cache", "bot.db"))
+os.environ.setdefault("DISCORD_TOKEN", "test")
+
+import storage
+from routing import index as routing_index
+
+
+@pytest.fixture
+def db(tmp_path, monkeypatch):
+    """DB vuoto in tmp_path; lo stato in memoria di storage viene azzerato per ogni test."""
+    path = str(tmp_path / "db" / "bot.db")
+    monkeypatch.setattr(storage, "DB_PATH", path)
+    monkeypatch.setattr(storage, "_write_lock", asyncio.Lock())
+    storage.session_cache.clear()
+    storage._touched.clear()
+    routing_index.load([], [])
+    routing_index.ready = False
+    yield path
+    assert storage._writer is None, "il test deve chiudere il DB con storage.close_db()"
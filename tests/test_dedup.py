@@ -0,0 +1,51 @@
+import asyncio
+
+import dedup
+import storage
+
+
+REPLY = {"negotiation_hash": "h1", "client_username": "alice", "message": "ok"}
+
+
+def test_replies_with_the_same_text_are_not_duplicates():
+    assert dedup.fingerprint("user_reply", "7", REPLY) is None
+
+
+def test_replies_are_told_apart_by_message_id():
+    first = dedup.fingerprint("user_reply", "7", dict(REPLY, message_id=1))
+    retry = dedup.fingerprint("user_reply", "7", dict(REPLY, message_id=1))
+    second = dedup.fingerprint("user_reply", "7", dict(REPLY, message_id=2))
+    assert first == retry
+    assert first != second
+
+
+def test_replies_are_told_apart_by_timestamp():
+    first = dedup.fingerprint("user_reply", "7", dict(REPLY, date_added=1700000000))
+    second = dedup.fingerprint("user_reply", "7", dict(REPLY, date_added=1700000060))
+    assert first != second
+
+
+def test_both_completion_webhooks_share_a_fingerprint():
+    data = {"negotiation_hash": "h1", "client_username": "alice"}
+    assert dedup.fingerprint("negotiation_completed_client", "7", data) == \
+        dedup.fingerprint("negotiation_completed_advertiser", "7", data)
+
+
+def test_is_duplicate(db, monkeypatch):
+    monkeypatch.setattr(dedup, "_recent", type(dedup._recent)())
+
+    async def run():
+        await storage.open_db()
+        try:
+            fp = dedup.fingerprint("negotiation_started", "7", {"negotiation_hash": "h1"})
+            results = [await dedup.is_duplicate(fp), await dedup.is_duplicate(fp)]
+            await dedup.forget(fp)
+            await storage.flush_writes()
+            results.append(await dedup.is_duplicate(fp))
+            # Senza impronta non c'è dedup
+            results += [await dedup.is_duplicate(None), await dedup.is_duplicate(None)]
+        finally:
+            await storage.close_db()
+        return results
+
+    assert asyncio.run(run()) == [False, True, False, False, False]
@@ -0,0 +1,177 @@
+import asyncio
+
+import pytest
+
+import digest
+import storage
+from digest import DigestBuffer
+
+
+class FakeMessage:
+    def __init__(self, message_id: int):
+        self.id = message_id
+
+
+class FakeThread:
+    def __init__(self, thread_id: int = 100):
+        self.id = thread_id
+
+
+class FakeScheduler:
+    """Sostituisce sender.scheduler: registra i titoli inviati e fallisce le prime `fail` volte."""
+
+    def __init__(self, fail: int = 0, delay: float = 0):
+        self.fail = fail
+        self.delay = delay
+        self.sent: list[str] = []
+
+    async def send(self, channel, embed, key=None):
+        await asyncio.sleep(self.delay)
+        if self.fail:
+            self.fail -= 1
+            raise OSError("discord down")
+        self.sent.append(embed.title)
+        return FakeMessage(len(self.sent))
+
+
+@pytest.fixture
+def scheduler(monkeypatch):
+    fake = FakeScheduler()
+    monkeypatch.setattr(digest, "scheduler", fake)
+    monkeypatch.setattr(digest.unread, "mark", lambda thread: None)
+    return fake
+
+
+async def wait_for(condition, timeout: float = 5.0):
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    while not condition() and loop.time() < deadline:
+        await asyncio.sleep(0.01)
+
+
+async def digest_rows() -> list[tuple]:
+    await storage.flush_writes()
+    return await storage.fetchall("SELECT negotiation_hash, line FROM digest_entries ORDER BY rowid")
+
+
+def test_pending_events_survive_a_restart(db, scheduler):
+    thread = FakeThread()
+
+    async def before_restart():
+        await storage.open_db()
+        try:
+            # Senza start() il flusher non gira: simula un processo interrotto prima della finestra
+            buffer = DigestBuffer()
+            await buffer.add(thread, 0, "h1", "Titolo", "uno")
+            await buffer.add(thread, 0, "h2", None, "due")
+            return await digest_rows()
+        finally:
+            await storage.close_db()
+
+    async def after_restart():
+        await storage.open_db()
+        try:
+            async def get_channel(thread_id):
+                return thread if thread_id == thread.id else None
+
+            buffer = DigestBuffer()
+            await buffer.start(get_channel)
+            reloaded = buffer.pending()
+            await wait_for(lambda: scheduler.sent)
+            await buffer.stop()
+            return reloaded, await digest_rows()
+        finally:
+            await storage.close_db()
+
+    assert asyncio.run(before_restart()) == [("h1", "uno"), ("h2", "due")]
+    reloaded, rows = asyncio.run(after_restart())
+    assert reloaded == 2
+    assert scheduler.sent == ["🗞️ Riepilogo: 2 eventi in 2 negoziazioni"]
+    assert rows == []
+
+
+def test_failed_flush_is_retried_with_later_events(db, scheduler, monkeypatch):
+    monkeypatch.setattr(digest, "DIGEST_RETRY_BASE", 0.05)
+    scheduler.fail = 1
+    thread = FakeThread()
+
+    async def run():
+        await storage.open_db()
+        try:
+            buffer = DigestBuffer()
+            await buffer.start()
+            await buffer.add(thread, 0, "h1", "Titolo", "uno")
+            await wait_for(lambda: buffer.stats["errors"])
+            # Arriva durante il backoff: finisce nello stesso riepilogo ritentato
+            await buffer.add(thread, 60, "h1", None, "due")
+            await wait_for(lambda: scheduler.sent)
+            await buffer.stop()
+            return buffer.stats, await digest_rows()
+        finally:
+            await storage.close_db()
+
+    stats, rows = asyncio.run(run())
+    assert scheduler.sent == ["🗞️ Riepilogo: 2 eventi in 1 negoziazioni"]
+    assert stats["errors"] == 1 and stats["digests"] == 1
+    assert rows == []
+
+
+def test_events_of_a_missing_thread_are_dropped(db, scheduler):
+    async def run():
+        await storage.open_db()
+        try:
+            async def get_channel(thread_id):
+                return None
+
+            await storage.digest_add("e1", 100, None, "h1", None, "uno", 0)
+            await storage.flush_writes()
+            buffer = DigestBuffer()
+            await buffer.start(get_channel)
+            await wait_for(lambda: buffer.stats["dropped"])
+            await buffer.stop()
+            return buffer.stats, await digest_rows()
+        finally:
+            await storage.close_db()
+
+    stats, rows = asyncio.run(run())
+    assert stats["dropped"] == 1
+    assert scheduler.sent == []
+    assert rows == []
+
+
+def test_stop_waits_for_flushes_already_started(db, scheduler):
+    scheduler.delay = 0.2
+
+    async def run():
+        await storage.open_db()
+        try:
+            buffer = DigestBuffer()
+            await buffer.start()
+            await buffer.add(FakeThread(), 0, "h1", "Titolo", "uno")
+            await wait_for(lambda: buffer._flushing)
+            await buffer.stop(timeout=5)
+            return list(scheduler.sent), await digest_rows()
+        finally:
+            await storage.close_db()
+
+    sent, rows = asyncio.run(run())
+    assert sent == ["🗞️ Riepilogo: 1 eventi in 1 negoziazioni"]
+    assert rows == []
+
+
+def test_digests_not_sent_before_the_timeout_stay_in_the_db(db, scheduler):
+    scheduler.delay = 5
+
+    async def run():
+        await storage.open_db()
+        try:
+            buffer = DigestBuffer()
+            await buffer.start()
+            await buffer.add(FakeThread(), 60, "h1", "Titolo", "uno")
+            await buffer.stop(timeout=0.05)
+            return await digest_rows()
+        finally:
+            await storage.close_db()
+
+    assert asyncio.run(run()) == [("h1", "uno")]
+    assert scheduler.sent == []
@@ -0,0 +1,32 @@
+import asyncio
+
+import pytest
+
+import events
+import storage
+import event_types
+
+
+def test_target_falls_back_to_db_when_index_misses(db):
+    async def run():
+        await storage.open_db()
+        try:
+            await storage.warm_routing_index()
+            # Sessione salvata da un altro processo: nel DB ma non nell'indice di questo
+            await storage.submit_write((storage.SQL_SAVE_SESSION, ("7", "", 100, "alice", "bt", "sk", 1, "{}")))
+            assert storage.routing_index.thread_for_user("7") is None
+            handler = events.handler_for("negotiation_started")
+            thread_id = await handler.target("negotiation_started", "7", {})
+            with pytest.raises(events.Unroutable):
+                await handler.target("negotiation_started", "8", {})
+        finally:
+            await storage.close_db()
+        return thread_id
+
+    assert asyncio.run(run()) == 100
+    assert storage.routing_index.thread_for_user("7") == 100
+
+
+def test_light_event_type_list_matches_the_handlers():
+    # ingress etichetta le metriche con event_types senza importare events
+    assert event_types.REGISTERED == set(events._handlers)
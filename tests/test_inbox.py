@@ -0,0 +1,214 @@
+import asyncio
+
+import inbox
+import storage
+from sharding import shards
+
+
+def run_inbox(dispatcher, until, events=1, timeout=5.0):
+    """Avvia l'inbox con `dispatcher`, accoda `events` webhook e attende che `until()` sia vero."""
+    async def run():
+        await storage.open_db()
+        try:
+            await inbox.start(dispatcher, workers=2)
+            ids = [await inbox.enqueue("negotiation_started", "7", f'{{"n": {n}}}') for n in range(events)]
+            loop = asyncio.get_running_loop()
+            deadline = loop.time() + timeout
+            while not until() and loop.time() < deadline:
+                await asyncio.sleep(0.01)
+            await inbox.stop()
+            await storage.flush_writes()
+            rows = await storage.fetchall("SELECT event_id, status, attempts, last_error FROM webhook_inbox")
+        finally:
+            await storage.close_db()
+        return ids, rows
+    return asyncio.run(run())
+
+
+def test_delivered_events_leave_the_inbox(db):
+    delivered = []
+
+    async def dispatcher(event_type, user_id, body):
+        delivered.append(body)
+        return {"status": 200, "text": ""}
+
+    ids, rows = run_inbox(dispatcher, lambda: len(delivered) == 3, events=3)
+    assert sorted(delivered) == ['{"n": 0}', '{"n": 1}', '{"n": 2}']
+    assert rows == []
+
+
+def test_failed_events_are_retried(db, monkeypatch):
+    monkeypatch.setattr(inbox, "INBOX_RETRY_BASE", 0.01)
+    calls = []
+
+    async def dispatcher(event_type, user_id, body):
+        calls.append(body)
+        if len(calls) < 3:
+            return {"status": 503, "text": "discord down"}
+        return {"status": 200, "text": ""}
+
+    ids, rows = run_inbox(dispatcher, lambda: len(calls) == 3 and not inbox.depth())
+    assert len(calls) == 3
+    assert rows == []
+
+
+def test_events_go_dead_after_max_attempts(db, monkeypatch):
+    monkeypatch.setattr(inbox, "INBOX_RETRY_BASE", 0.01)
+    monkeypatch.setattr(inbox, "INBOX_MAX_ATTEMPTS", 3)
+    calls = []
+
+    async def dispatcher(event_type, user_id, body):
+        calls.append(body)
+        raise RuntimeError("boom")
+
+    ids, rows = run_inbox(dispatcher, lambda: len(calls) == 3)
+    assert len(calls) == 3
+    assert rows == [(ids[0], "dead", 3, "RuntimeError: boom")]
+
+
+def test_pending_events_are_replayed_on_start(db):
+    async def never(event_type, user_id, body):
+        await asyncio.sleep(3600)
+
+    delivered = []
+
+    async def dispatcher(event_type, user_id, body):
+        delivered.append(body)
+        return {"status": 200, "text": ""}
+
+    async def run():
+        await storage.open_db()
+        try:
+            # Primo avvio: l'evento resta in consegna quando il processo si ferma
+            await inbox.start(never, workers=1)
+            await inbox.enqueue("negotiation_started", "7", "{}")
+            await asyncio.sleep(0.05)
+            await inbox.stop()
+            await inbox.start(dispatcher, workers=1)
+            for _ in range(100):
+                if delivered:
+                    break
+                await asyncio.sleep(0.01)
+            await inbox.stop()
+        finally:
+            await storage.close_db()
+
+    asyncio.run(run())
+    assert delivered == ["{}"]
+
+
+def test_workers_do_not_wait_for_the_send(db):
+    dispatched, sent = [], []
+
+    async def send(body):
+        await asyncio.sleep(0.3)
+        sent.append(body)
+
+    async def dispatcher(event_type, user_id, body):
+        dispatched.append(asyncio.get_running_loop().time())
+        return {"status": 200, "text": "", "sent": asyncio.ensure_future(send(body))}
+
+    # 2 worker, 6 eventi: se i worker aspettassero l'invio servirebbero almeno 0.9s per instradarli
+    ids, rows = run_inbox(dispatcher, lambda: len(sent) == 6 and not inbox.depth(), events=6)
+    assert max(dispatched) - min(dispatched) < 0.2
+    assert rows == []
+
+
+def test_failed_sends_are_retried(db, monkeypatch):
+    monkeypatch.setattr(inbox, "INBOX_RETRY_BASE", 0.01)
+    attempts = []
+
+    async def send(attempt):
+        if attempt == 0:
+            raise RuntimeError("discord down")
+
+    async def dispatcher(event_type, user_id, body):
+        attempts.append(body)
+        return {"status": 200, "text": "", "sent": asyncio.ensure_future(send(len(attempts) - 1))}
+
+    ids, rows = run_inbox(dispatcher, lambda: len(attempts) == 2 and not inbox.depth())
+    assert len(attempts) == 2
+    assert rows == []
+
+
+async def wait_for(condition, timeout: float = 2.0):
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    while not condition() and loop.time() < deadline:
+        await asyncio.sleep(0.01)
+
+
+def test_single_process_claims_leftovers_once_without_polling(db):
+    delivered = []
+
+    async def dispatcher(event_type, user_id, body):
+        delivered.append(body)
+        return {"status": 200, "text": ""}
+
+    async def run():
+        await storage.open_db()
+        try:
+            # Riga 'queued' lasciata da un'esecuzione con processi di ingresso
+            await storage.inbox_add("old", "negotiation_started", "7", "old", status="queued")
+            await inbox.start(dispatcher, workers=1)
+            polling = len(inbox._workers) > 1
+            await wait_for(lambda: delivered)
+            await storage.inbox_add("late", "negotiation_started", "7", "late", status="queued")
+            await asyncio.sleep(0.2)
+            await inbox.stop()
+        finally:
+            await storage.close_db()
+        return polling
+
+    assert asyncio.run(run()) is False
+    assert delivered == ["old"]
+
+
+def test_polling_picks_up_events_stored_by_other_processes(db):
+    delivered = []
+
+    async def dispatcher(event_type, user_id, body):
+        delivered.append(body)
+        return {"status": 200, "text": ""}
+
+    async def run():
+        await storage.open_db()
+        try:
+            await inbox.start(dispatcher, workers=1, poll=True)
+            # Come un processo di ingresso: solo la riga nel DB, nessuna coda locale
+            await storage.inbox_add("e1", "negotiation_started", "7", "da ingress", status="queued")
+            await wait_for(lambda: delivered and not inbox.depth())
+            await inbox.stop()
+            await storage.flush_writes()
+            return await storage.fetchall("SELECT event_id FROM webhook_inbox")
+        finally:
+            await storage.close_db()
+
+    assert asyncio.run(run()) == []
+    assert delivered == ["da ingress"]
+
+
+def test_claim_takes_only_the_shards_of_this_process(db):
+    async def run():
+        await storage.open_db()
+        try:
+            # Guild (1 << 22) → shard 1 di 2, gestito da un altro processo
+            await storage.save_user_session("8", {"thread_id": 200, "guild_id": 1 << 22})
+            await inbox.enqueue("negotiation_started", "8", "remote")
+            for event_id, shard_id in (("local", 0), ("legacy", None)):
+                await storage.inbox_add(event_id, "negotiation_started", "7", event_id, status="queued", shard_id=shard_id)
+            claimed = await storage.inbox_claim(10)
+            rows = await storage.fetchall("SELECT body, status, shard_id FROM webhook_inbox ORDER BY rowid")
+        finally:
+            await storage.close_db()
+        return claimed, rows
+
+    shards.configure(2, [0])
+    try:
+        assert shards.sql_filter == "(shard_id IS NULL OR shard_id IN (0))"
+        claimed, rows = asyncio.run(run())
+    finally:
+        shards.configure(None, None)
+    assert [row[0] for row in claimed] == ["local", "legacy"]
+    # Le righe senza shard vengono assegnate al processo che le preleva
+    assert rows == [("remote", "queued", 1), ("local", "pending", 0), ("legacy", "pending", 0)]
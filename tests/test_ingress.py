@@ -0,0 +1,110 @@
+import signal
+import asyncio
+
+import pytest
+from aiohttp import web
+from aiohttp.test_utils import TestClient, TestServer
+
+import ingress
+import storage
+from cache import TTLCache
+
+
+@pytest.fixture
+def limits(monkeypatch):
+    """Middleware di backpressure con un burst di un webhook per utente e una ricarica trascurabile."""
+    monkeypatch.setattr(ingress, "_user_buckets", TTLCache())
+    monkeypatch.setattr(ingress, "_inflight", 0)
+    monkeypatch.setattr(ingress, "_draining", False)
+    monkeypatch.setattr(ingress, "WEBHOOK_USER_RATE", 0.001)
+    monkeypatch.setattr(ingress, "WEBHOOK_USER_BURST", 1)
+    monkeypatch.setattr(ingress, "overload_stats", dict.fromkeys(ingress.overload_stats, 0))
+    return monkeypatch
+
+
+async def post(requests: list[dict]) -> list[int]:
+    """Invia in ordine le richieste (kwargs di client.post) a un'app con il solo middleware; restituisce gli status."""
+    async def accepted(request):
+        return web.Response(status=202, text="accepted")
+
+    app = web.Application(middlewares=[ingress.backpressure])
+    app.router.add_post("/webhook/{event_type}/{user_id}", accepted)
+    async with TestClient(TestServer(app)) as client:
+        statuses = []
+        for kwargs in requests:
+            before = kwargs.pop("before", None)
+            if before:
+                before()
+            async with client.post("/webhook/user_reply/7", **kwargs) as response:
+                statuses.append(response.status)
+        return statuses
+
+def post_all(requests: list[dict]) -> list[int]:
+    return asyncio.run(post(requests))
+
+
+def test_overload_does_not_consume_the_user_burst(limits):
+    statuses = post_all([
+        {"data": "{}", "before": lambda: limits.setattr(ingress, "WEBHOOK_MAX_CONCURRENCY", 0)},
+        {"data": "{}", "before": lambda: limits.setattr(ingress, "WEBHOOK_MAX_CONCURRENCY", 10)},
+        {"data": "{}"},
+    ])
+    # Il 503 non tocca il bucket: il retry passa, solo il terzo webhook supera il burst
+    assert statuses == [503, 202, 429]
+
+
+def test_too_large_is_checked_before_overload_and_rate(limits):
+    limits.setattr(ingress, "WEBHOOK_MAX_BODY", 10)
+    limits.setattr(ingress, "WEBHOOK_MAX_CONCURRENCY", 0)
+    statuses = post_all([{"data": "x" * 100}, {"data": "x" * 100}])
+    assert statuses == [413, 413]
+    assert ingress._user_buckets.get("7") is None
+
+
+def test_draining_rejects_before_any_other_check(limits):
+    limits.setattr(ingress, "_draining", True)
+    limits.setattr(ingress, "WEBHOOK_MAX_BODY", 10)
+    assert post_all([{"data": "x" * 100}]) == [503]
+    assert ingress.overload_stats["draining"] == 1
+
+
+def test_ingress_processes_count_queued_rows_as_backlog(db, limits):
+    limits.setattr(ingress, "_ingress_process", True)
+    limits.setattr(ingress, "_queued_at", 0.0)
+    limits.setattr(ingress, "WEBHOOK_MAX_BACKLOG", 2)
+
+    async def run():
+        await storage.open_db()
+        try:
+            # Eventi salvati dagli altri processi di ingresso e non ancora prelevati dal gateway
+            for n in range(2):
+                await storage.inbox_add(f"e{n}", "user_reply", "7", "{}", status="queued")
+            return await post([{"data": "{}"}])
+        finally:
+            await storage.close_db()
+
+    assert asyncio.run(run()) == [503]
+    assert ingress.overload_stats["backlog"] == 1
+
+
+def test_stop_signal_falls_back_where_the_loop_has_no_signal_handlers(monkeypatch):
+    previous = {sig: signal.getsignal(sig) for sig in (signal.SIGTERM, signal.SIGINT)}
+
+    async def run():
+        loop = asyncio.get_running_loop()
+
+        def unsupported(*args):
+            raise NotImplementedError
+
+        # Come il ProactorEventLoop di Windows
+        monkeypatch.setattr(loop, "add_signal_handler", unsupported)
+        stop = asyncio.Event()
+        ingress.on_stop_signal(stop.set)
+        signal.raise_signal(signal.SIGTERM)
+        await asyncio.wait_for(stop.wait(), 1)
+
+    try:
+        asyncio.run(run())
+    finally:
+        for sig, handler in previous.items():
+            signal.signal(sig, handler)
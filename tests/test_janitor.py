@@ -0,0 +1,136 @@
+import time
+import asyncio
+
+import discord
+import pytest
+
+import janitor
+import storage
+from threads import ThreadResolver
+
+OLD = time.time() - 400 * janitor.DAY
+
+
+class FakeResponse:
+    status = 404
+    reason = "Not Found"
+
+
+class FakeClient:
+    """Gateway con i thread `cached` in cache; fetch_channel trova solo i thread `alive`."""
+
+    def __init__(self, cached=(), alive=()):
+        self.cached = set(cached)
+        self.alive = set(alive)
+        self.fetched: list[int] = []
+
+    def is_ready(self):
+        return True
+
+    def get_channel(self, thread_id):
+        return object() if thread_id in self.cached else None
+
+    async def fetch_channel(self, thread_id):
+        self.fetched.append(thread_id)
+        if thread_id not in self.alive:
+            raise discord.NotFound(FakeResponse(), "Unknown Channel")
+        return object()
+
+
+@pytest.fixture
+def client(monkeypatch):
+    fake = FakeClient(cached={101}, alive={102})
+    resolver = ThreadResolver(rate=1000, burst=10)
+    resolver.bind(fake)
+    monkeypatch.setattr(janitor, "resolver", resolver)
+    monkeypatch.setattr(janitor, "_cursor", 0)
+    monkeypatch.setattr(janitor, "janitor_stats", dict.fromkeys(janitor.janitor_stats, 0))
+    return fake
+
+
+async def execute(*statements):
+    async with storage.writer() as conn:
+        for sql, params in statements:
+            await conn.execute(sql, params)
+
+
+def test_expired_rows_are_deleted_in_batches(db, client, monkeypatch):
+    monkeypatch.setattr(janitor, "JANITOR_BATCH", 2)
+    # Stesso formato di CURRENT_TIMESTAMP
+    old, new = (time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime(t)) for t in (OLD, time.time()))
+
+    async def run():
+        await storage.open_db()
+        try:
+            await execute(
+                *((
+                    "INSERT INTO negotiation_links (negotiation_hash, buyer_id, seller_id, last_seen) VALUES (?, '1', '2', ?)",
+                    (f"h{n}", OLD),
+                ) for n in range(5)),
+                ("INSERT INTO negotiation_links (negotiation_hash, buyer_id, seller_id, last_seen) VALUES ('fresh', '1', '2', ?)", (time.time(),)),
+                *((
+                    "INSERT INTO webhook_inbox (event_id, event_type, user_id, body, status, received_at) VALUES (?, 'x', '7', '{}', ?, ?)",
+                    (event_id, status, received_at),
+                ) for event_id, status, received_at in (
+                    ("dead-old", "dead", old), ("dead-new", "dead", new), ("pending-old", "pending", old),
+                )),
+                *((
+                    "INSERT INTO reply_outbox (reply_id, user_id, negotiation_hash, message, status, created_at) VALUES (?, '7', 'h', 'm', ?, ?)",
+                    (reply_id, status, created_at),
+                ) for reply_id, status, created_at in (
+                    ("dead-old", "dead", old), ("uncertain-old", "uncertain", old),
+                    ("dead-new", "dead", new), ("pending-old", "pending", old),
+                )),
+            )
+            await janitor.run_once()
+            return (
+                await storage.fetchall("SELECT negotiation_hash FROM negotiation_links"),
+                await storage.fetchall("SELECT event_id FROM webhook_inbox ORDER BY event_id"),
+                await storage.fetchall("SELECT reply_id FROM reply_outbox ORDER BY reply_id"),
+            )
+        finally:
+            await storage.close_db()
+
+    links, events, replies = asyncio.run(run())
+    assert links == [("fresh",)]
+    assert events == [("dead-new",), ("pending-old",)]
+    assert replies == [("dead-new",), ("pending-old",)]
+    assert janitor.janitor_stats["links_expired"] == 5
+    assert janitor.janitor_stats["dead_events_expired"] == 1
+    assert janitor.janitor_stats["failed_replies_expired"] == 2
+
+
+def test_reconcile_removes_sessions_of_deleted_threads(db, client):
+    async def run():
+        await storage.open_db()
+        try:
+            for user_id, thread_id in (("1", 101), ("2", 102), ("3", 103)):
+                await storage.save_user_session(user_id, {"thread_id": thread_id, "guild_id": 1, "username": user_id})
+            missing = await janitor.reconcile_threads(limit=10, rate=1000)
+            return missing, await storage.fetchall("SELECT user_id FROM sessions ORDER BY user_id")
+        finally:
+            await storage.close_db()
+
+    missing, sessions = asyncio.run(run())
+    assert missing == 1
+    assert sessions == [("1",), ("2",)]
+    # Il thread nella cache del gateway non costa una fetch
+    assert client.fetched == [102, 103]
+    assert janitor.janitor_stats["threads_checked"] == 2
+
+
+def test_reconcile_resumes_from_the_last_checked_session(db, client):
+    client.alive = {102, 103}
+
+    async def run():
+        await storage.open_db()
+        try:
+            for user_id, thread_id in (("1", 102), ("2", 103)):
+                await storage.save_user_session(user_id, {"thread_id": thread_id, "guild_id": 1, "username": user_id})
+            await janitor.reconcile_threads(limit=1, rate=1000)
+            await janitor.reconcile_threads(limit=1, rate=1000)
+            return list(client.fetched)
+        finally:
+            await storage.close_db()
+
+    assert asyncio.run(run()) == [102, 103]
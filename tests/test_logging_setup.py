@@ -0,0 +1,58 @@
+import json
+import logging
+
+import pytest
+
+import logging_setup
+
+
+@pytest.fixture
+def logs(tmp_path, monkeypatch):
+    """setup_logging su un file temporaneo; gli handler del root logger vengono ripristinati dopo il test."""
+    root = logging.getLogger()
+    handlers, level = list(root.handlers), root.level
+    monkeypatch.setattr(logging_setup, "_listener", None)
+    path = tmp_path / "bot.log"
+
+    def read() -> list[dict]:
+        logging_setup.stop_logging()
+        return [json.loads(line) for line in path.read_text(encoding="utf-8").splitlines()]
+
+    yield path, read
+    logging_setup.stop_logging()
+    root.handlers[:] = handlers
+    root.setLevel(level)
+
+
+def test_each_record_is_written_once_through_the_queue(logs, capsys):
+    path, read = logs
+    logging_setup.setup_logging(str(path))
+    root = logging.getLogger()
+    assert [type(handler) for handler in root.handlers] == [logging_setup._QueueHandler]
+
+    logging.warning("Token salvato: bearer_token=abcdef123456")
+    entries = read()
+    assert len(entries) == 1
+    assert entries[0]["msg"] == "Token salvato: bearer_token=***"
+    # Con LOG_PATH impostato niente copia su stderr
+    assert capsys.readouterr().err == ""
+
+
+def test_sampled_records_are_dropped_everywhere(logs, monkeypatch):
+    path, read = logs
+    monkeypatch.setattr(logging_setup, "LOG_SAMPLE_RATE", 0)
+    logging_setup.setup_logging(str(path))
+
+    logging.info("per webhook", extra=logging_setup.SAMPLED)
+    logging.info("sempre")
+    logging.warning("avviso", extra=logging_setup.SAMPLED)
+    assert [entry["msg"] for entry in read()] == ["sempre", "avviso"]
+
+
+def test_context_fields_reach_the_file(logs):
+    path, read = logs
+    logging_setup.setup_logging(str(path))
+    with logging_setup.log_context(event_type="user_reply", user_id="7"):
+        logging.info("dentro")
+    entry = read()[0]
+    assert (entry["event_type"], entry["user_id"]) == ("user_reply", "7")
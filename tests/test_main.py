@@ -0,0 +1,105 @@
+import asyncio
+from unittest import mock
+
+import discord
+import pytest
+
+import main
+
+
+@pytest.fixture
+def on_message(monkeypatch):
+    """main.on_message con sessione, DB e indicatore sostituiti; restituisce i thread passati a unread.clear."""
+    session = {"thread_id": 100, "guild_id": 1, "bearer_token": "bt", "secret_key": "sk", "username": "alice"}
+    cleared = []
+
+    async def get_user_session(user_id):
+        return dict(session)
+
+    async def noop(*args, **kwargs):
+        return None
+
+    monkeypatch.setattr(main, "get_user_session", get_user_session)
+    monkeypatch.setattr(main, "touch_session", noop)
+    monkeypatch.setattr(main.unread, "clear", cleared.append)
+    monkeypatch.setattr(main.bot, "process_commands", noop)
+
+    def send(thread_id: int):
+        channel = mock.Mock(spec=discord.Thread)
+        channel.id = thread_id
+        message = mock.Mock(content="ciao", reference=None, channel=channel)
+        message.author.bot = False
+        message.author.id = 7
+        asyncio.run(main.on_message(message))
+        return cleared
+
+    return send
+
+
+def test_writing_in_the_session_thread_clears_the_unread_marker(on_message):
+    assert [thread.id for thread in on_message(100)] == [100]
+
+
+def test_other_threads_are_left_alone(on_message):
+    assert on_message(200) == []
+
+
+@pytest.fixture
+def open_thread(monkeypatch):
+    """Preme il bottone con il vecchio thread `old` restituito dal resolver; restituisce (risposta, thread creati)."""
+    saved = {}
+
+    async def get_user_thread_id(user_id):
+        return 100
+
+    async def save_user_session(user_id, session):
+        saved[user_id] = session
+
+    monkeypatch.setattr(main, "get_user_thread_id", get_user_thread_id)
+    monkeypatch.setattr(main, "save_user_session", save_user_session)
+    forgotten = []
+    monkeypatch.setattr(main.resolver, "forget", forgotten.append)
+
+    def press(old):
+        async def resolve(thread_id):
+            return old
+
+        monkeypatch.setattr(main.resolver, "resolve", resolve)
+        interaction = mock.Mock()
+        interaction.user.id = 7
+        interaction.user.name = "alice"
+        interaction.response.send_message = mock.AsyncMock()
+        new_thread = mock.AsyncMock(spec=discord.Thread)
+        new_thread.id = 200
+        new_thread.guild.id = 1
+        interaction.channel.create_thread = mock.AsyncMock(return_value=new_thread)
+
+        async def run():
+            view = main.OpenThreadButton()
+            await main.OpenThreadButton.open_thread(view, interaction, None)
+
+        asyncio.run(run())
+        reply = interaction.response.send_message.call_args.args[0]
+        return reply, interaction.channel.create_thread.await_count, saved, forgotten
+
+    return press
+
+
+def thread(archived: bool, locked: bool):
+    old = mock.Mock(spec=discord.Thread)
+    old.id, old.archived, old.locked = 100, archived, locked
+    return old
+
+
+def test_reachable_thread_is_reported_as_active(open_thread):
+    reply, created, saved, forgotten = open_thread(thread(archived=True, locked=False))
+    assert reply.startswith("⚠️ Hai già una chat attiva")
+    assert created == 0 and saved == {} and forgotten == []
+
+
+def test_archived_and_locked_thread_is_replaced(open_thread):
+    reply, created, saved, forgotten = open_thread(thread(archived=True, locked=True))
+    assert reply.startswith("🔒")
+    assert created == 1
+    assert saved[7]["thread_id"] == 200
+    assert forgotten == [100]
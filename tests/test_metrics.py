@@ -0,0 +1,19 @@
+import logging
+
+import metrics
+from metrics import DISCORD_RATE_LIMITED
+
+
+def test_each_discord_429_is_counted_once():
+    metrics.install_discord_ratelimit_hook()
+    metrics.install_discord_ratelimit_hook()
+    logger = logging.getLogger("discord.http")
+    before = DISCORD_RATE_LIMITED.value()
+
+    # Le righe che discord.py scrive per un 429 globale
+    logger.warning("We are being rate limited. %s %s responded with 429. Retrying in %.2f seconds.", "POST", "/x", 1.0)
+    logger.warning("Global rate limit has been hit. Retrying in %.2f seconds.", 1.0)
+    logger.warning("We are being rate limited. %s %s responded with 429. Timeout of %.2f was too long, erroring instead.", "POST", "/x", 99.0)
+    logger.warning("%s %s has returned %s", "GET", "/y", 429)
+
+    assert DISCORD_RATE_LIMITED.value() - before == 2
@@ -0,0 +1,123 @@
+import json
+import time
+import asyncio
+
+import pytest
+
+import poller
+import storage
+from poller import NotificationPoller
+
+GRACE = 60
+
+
+class FakeUex:
+    """Sostituisce uex_client.client: restituisce le notifiche in `notifications`."""
+
+    def __init__(self):
+        self.notifications: list[dict] = []
+
+    async def get_notifications(self, user_id, bearer_token, secret_key):
+        return 200, json.dumps({"data": self.notifications})
+
+
+def notification(notification_id: int, age: float, negotiation_hash: str = "abc") -> dict:
+    return {
+        "id": notification_id,
+        "date_added": time.time() - age,
+        "redir": f"https://uexcorp.space/marketplace/negotiate/hash/{negotiation_hash}",
+    }
+
+
+@pytest.fixture
+def uex(monkeypatch):
+    """UEX finto; gli eventi accodati finiscono in uex.enqueued."""
+    fake = FakeUex()
+    fake.enqueued = []
+
+    async def enqueue(event_type, user_id, body):
+        fake.enqueued.append(json.loads(body)["id"])
+        return f"e{len(fake.enqueued)}"
+
+    async def is_duplicate(fp):
+        return False
+
+    monkeypatch.setattr(poller, "uex", fake)
+    monkeypatch.setattr(poller.inbox, "enqueue", enqueue)
+    monkeypatch.setattr(poller.dedup, "is_duplicate", is_duplicate)
+    return fake
+
+
+async def save_session():
+    await storage.save_user_session("7", {"thread_id": 100, "guild_id": 1, "bearer_token": "bt", "secret_key": "sk"})
+
+
+def test_first_poll_sets_the_mark_without_delivering_history(db, uex):
+    uex.notifications = [notification(5, 3600), notification(9, 3600)]
+
+    async def run():
+        await storage.open_db()
+        try:
+            await save_session()
+            found = await NotificationPoller(grace=GRACE)._poll_user("7")
+            return found, await storage.get_meta("poll_hwm:7")
+        finally:
+            await storage.close_db()
+
+    assert asyncio.run(run()) == (0, "9")
+    assert uex.enqueued == []
+
+
+def test_recent_notifications_wait_for_the_grace_period(db, uex):
+    async def run():
+        await storage.open_db()
+        try:
+            await save_session()
+            await storage.set_meta("poll_hwm:7", "9")
+            uex.notifications = [notification(9, 3600), notification(10, 3600), notification(11, 1), notification(12, 3600)]
+            first = await NotificationPoller(grace=GRACE)._poll_user("7")
+            hwm = await storage.get_meta("poll_hwm:7")
+            # Passato il grace, al giro dopo (anche in un nuovo processo) arrivano le altre
+            uex.notifications[2] = notification(11, 3600)
+            second = await NotificationPoller(grace=GRACE)._poll_user("7")
+            return first, hwm, second, await storage.get_meta("poll_hwm:7")
+        finally:
+            await storage.close_db()
+
+    first, hwm, second, final = asyncio.run(run())
+    # La 12 non scavalca la 11 ancora in attesa: l'HWM resta alla 10
+    assert (first, hwm) == (3, "10")
+    assert (second, final) == (2, "12")
+    assert uex.enqueued == [10, 11, 12]
+
+
+def test_notifications_covered_by_a_webhook_are_skipped(db, uex):
+    async def run():
+        await storage.open_db()
+        try:
+            await save_session()
+            await storage.set_meta("poll_hwm:7", "9")
+            uex.notifications = [notification(10, 3600, "c0ffee"), notification(11, 3600, "bad-beef")]
+            instance = NotificationPoller(grace=GRACE)
+            instance.note_webhook("7", "c0ffee")
+            await instance._poll_user("7")
+            return instance.stats, await storage.get_meta("poll_hwm:7")
+        finally:
+            await storage.close_db()
+
+    stats, hwm = asyncio.run(run())
+    assert uex.enqueued == [11]
+    assert stats["covered"] == 1 and stats["enqueued"] == 1
+    assert hwm == "11"
+
+
+def test_users_without_credentials_leave_the_wheel(db, uex):
+    async def run():
+        await storage.open_db()
+        try:
+            await storage.save_user_session("7", {"thread_id": 100, "guild_id": 1})
+            return await NotificationPoller(grace=GRACE)._poll_user("7")
+        finally:
+            await storage.close_db()
+
+    assert asyncio.run(run()) is None
@@ -0,0 +1,182 @@
+import asyncio
+
+import aiohttp
+import pytest
+
+import storage
+import reply_outbox
+from sharding import shards
+
+
+class FakeUex:
+    def __init__(self, *results):
+        self.results = list(results)
+        self.posts = []
+
+    async def post_message(self, user_key, bearer_token, secret_key, negotiation_hash, message):
+        self.posts.append(message)
+        result = self.results.pop(0) if self.results else (200, "ok")
+        if isinstance(result, BaseException):
+            raise result
+        return result
+
+
+@pytest.fixture
+def outbox(db, monkeypatch):
+    monkeypatch.setattr(reply_outbox, "OUTBOX_RETRY_BASE", 0.01)
+    monkeypatch.setattr(reply_outbox, "_closing", False)
+    monkeypatch.setattr(reply_outbox, "_slots", None)
+    monkeypatch.setattr(reply_outbox, "_lanes", {})
+    monkeypatch.setattr(reply_outbox, "_tasks", {})
+    monkeypatch.setattr(reply_outbox, "_sending", set())
+    return db
+
+
+def run_outbox(fake: FakeUex, monkeypatch, until, prepare=None, notify=None, timeout=5.0):
+    monkeypatch.setattr(reply_outbox, "uex", fake)
+    states = []
+
+    async def record(item, state, detail):
+        states.append(state)
+
+    async def run():
+        await storage.open_db()
+        try:
+            await storage.save_user_session("7", {"bearer_token": "bt", "secret_key": "sk"})
+            if prepare:
+                await prepare()
+            await reply_outbox.start(notify or record)
+            item = await reply_outbox.enqueue("7", "h1", "ciao", 1, 2)
+            loop = asyncio.get_running_loop()
+            deadline = loop.time() + timeout
+            while not until(states) and loop.time() < deadline:
+                await asyncio.sleep(0.01)
+            await reply_outbox.stop()
+            await storage.flush_writes()
+            rows = await storage.fetchall("SELECT reply_id, status FROM reply_outbox ORDER BY rowid")
+        finally:
+            await storage.close_db()
+        return item, states, rows
+
+    return asyncio.run(run())
+
+
+def test_sent_replies_leave_the_outbox(outbox, monkeypatch):
+    fake = FakeUex((200, "ok"))
+    item, states, rows = run_outbox(fake, monkeypatch, lambda states: "sent" in states)
+    assert states == ["queued", "sent"]
+    assert fake.posts == ["ciao"]
+    assert rows == []
+
+
+def test_rejected_requests_are_retried(outbox, monkeypatch):
+    fake = FakeUex((503, "busy"), aiohttp.ClientConnectorError(None, OSError("refused")), (200, "ok"))
+    item, states, rows = run_outbox(fake, monkeypatch, lambda states: "sent" in states)
+    assert states == ["queued", "retry", "retry", "sent"]
+    assert len(fake.posts) == 3
+
+
+@pytest.mark.parametrize("result", [asyncio.TimeoutError(), aiohttp.ServerDisconnectedError(), (502, "bad gateway")])
+def test_possibly_delivered_replies_are_not_resent(outbox, monkeypatch, result):
+    fake = FakeUex(result, (200, "ok"))
+    item, states, rows = run_outbox(fake, monkeypatch, lambda states: "uncertain" in states)
+    assert states == ["queued", "uncertain"]
+    assert len(fake.posts) == 1
+    assert rows == [(item["reply_id"], "uncertain")]
+
+
+def test_replies_interrupted_mid_send_are_not_resent(outbox, monkeypatch):
+    async def prepare():
+        # Risposta rimasta 'sending' da un processo terminato durante la POST
+        await storage.outbox_add("old", "7", "h0", "vecchia", 1, 1)
+        await storage.outbox_sending("old")
+
+    fake = FakeUex()
+    item, states, rows = run_outbox(fake, monkeypatch, lambda states: states.count("sent") == 1 and "uncertain" in states, prepare)
+    assert sorted(states) == ["queued", "sent", "uncertain"]
+    assert fake.posts == ["ciao"]
+    assert rows == [("old", "uncertain")]
+
+
+def test_enqueue_does_not_wait_for_the_notification(outbox, monkeypatch):
+    async def slow_notify(item, state, detail):
+        await asyncio.sleep(0.5)
+
+    async def run():
+        monkeypatch.setattr(reply_outbox, "uex", FakeUex())
+        await storage.open_db()
+        try:
+            await storage.save_user_session("7", {"bearer_token": "bt", "secret_key": "sk"})
+            await reply_outbox.start(slow_notify)
+            loop = asyncio.get_running_loop()
+            start = loop.time()
+            await reply_outbox.enqueue("7", "h1", "ciao", 1, 2)
+            elapsed = loop.time() - start
+            await reply_outbox.stop()
+        finally:
+            await storage.close_db()
+        return elapsed
+
+    assert asyncio.run(run()) < 0.3
+
+
+def test_replies_of_other_shards_are_left_to_their_process(outbox, monkeypatch):
+    async def prepare():
+        # Righe dello shard 1, gestito da un altro processo sullo stesso DB
+        await storage.outbox_add("other-pending", "7", "h2", "altrui", 1, 3, shard_id=1)
+        await storage.outbox_add("other-sending", "7", "h3", "in corso", 1, 4, shard_id=1)
+        await storage.outbox_sending("other-sending")
+
+    shards.configure(2, [0])
+    try:
+        fake = FakeUex()
+        item, states, rows = run_outbox(fake, monkeypatch, lambda states: "sent" in states, prepare)
+    finally:
+        shards.configure(None, None)
+    assert states == ["queued", "sent"]
+    assert fake.posts == ["ciao"]
+    assert rows == [("other-pending", "pending"), ("other-sending", "sending")]
+
+
+def test_stop_lets_the_current_send_finish_and_restart_sends_the_rest_once(outbox, monkeypatch):
+    monkeypatch.setattr(reply_outbox, "OUTBOX_WORKERS", 1)
+
+    class SlowUex(FakeUex):
+        async def post_message(self, *args):
+            await asyncio.sleep(0.2)
+            return await super().post_message(*args)
+
+    async def ignore(item, state, detail):
+        pass
+
+    async def run():
+        await storage.open_db()
+        try:
+            await storage.save_user_session("7", {"bearer_token": "bt", "secret_key": "sk"})
+            slow = SlowUex()
+            monkeypatch.setattr(reply_outbox, "uex", slow)
+            await reply_outbox.start(ignore)
+            await reply_outbox.enqueue("7", "h1", "prima", 1, 1)
+            # Un solo slot: la seconda corsia aspetta il semaforo quando arriva lo stop
+            await reply_outbox.enqueue("7", "h2", "seconda", 1, 2)
+            await asyncio.sleep(0.05)
+            await reply_outbox.stop(timeout=2)
+
+            fast = FakeUex()
+            monkeypatch.setattr(reply_outbox, "uex", fast)
+            await reply_outbox.start(ignore)
+            for _ in range(100):
+                if fast.posts and not reply_outbox.depth():
+                    break
+                await asyncio.sleep(0.01)
+            await reply_outbox.stop()
+            await storage.flush_writes()
+            rows = await storage.fetchall("SELECT message, status FROM reply_outbox")
+        finally:
+            await storage.close_db()
+        return slow.posts, fast.posts, rows
+
+    first, second, rows = asyncio.run(run())
+    assert first == ["prima"]
+    assert second == ["seconda"]
+    assert rows == []
@@ -0,0 +1,94 @@
+import asyncio
+
+import discord
+import pytest
+
+from sender import ThreadSendScheduler
+
+
+class FakeMessage:
+    def __init__(self, message_id: int, embeds: list):
+        self.id = message_id
+        self.embeds = embeds
+
+
+class FakeChannel:
+    def __init__(self, channel_id: int = 1, fail: Exception | None = None):
+        self.id = channel_id
+        self.fail = fail
+        self.sent: list[list[str]] = []
+
+    async def send(self, embeds):
+        if self.fail:
+            raise self.fail
+        self.sent.append([embed.title for embed in embeds])
+        return FakeMessage(len(self.sent), embeds)
+
+
+def embed(title: str, size: int = 0) -> discord.Embed:
+    return discord.Embed(title=title, description="x" * size)
+
+
+def test_enqueue_returns_before_the_window_and_coalesces():
+    async def run():
+        scheduler = ThreadSendScheduler(window=0.05)
+        channel = FakeChannel()
+        futures = [scheduler.enqueue(channel, embed(str(n)), key="h") for n in range(3)]
+        # enqueue non aspetta la finestra di coalescing
+        assert not any(future.done() for future in futures)
+        messages = await asyncio.gather(*futures)
+        return channel, messages
+
+    channel, messages = asyncio.run(run())
+    assert channel.sent == [["0", "1", "2"]]
+    assert {message.id for message in messages} == {1}
+
+
+def test_batches_by_key_keeping_order_within_each_key():
+    async def run():
+        scheduler = ThreadSendScheduler(window=0.01)
+        channel = FakeChannel()
+        keys = ["a", "b", "a", "b", "a"]
+        await asyncio.gather(*(scheduler.enqueue(channel, embed(f"{key}{n}"), key=key) for n, key in enumerate(keys)))
+        return channel
+
+    channel = asyncio.run(run())
+    assert channel.sent == [["a0", "a2", "a4"], ["b1", "b3"]]
+
+
+def test_splits_messages_at_the_embed_and_character_limits():
+    async def run():
+        scheduler = ThreadSendScheduler(window=0.01)
+        channel = FakeChannel()
+        futures = [scheduler.enqueue(channel, embed(f"n{n}"), key="h") for n in range(12)]
+        futures += [scheduler.enqueue(channel, embed(f"big{n}", 2500), key="h") for n in range(3)]
+        await asyncio.gather(*futures)
+        return channel
+
+    channel = asyncio.run(run())
+    assert [len(message) for message in channel.sent] == [10, 4, 1]
+    assert channel.sent[1] == ["n10", "n11", "big0", "big1"]
+
+
+def test_send_errors_reach_every_future_of_the_batch():
+    async def run():
+        scheduler = ThreadSendScheduler(window=0.01)
+        channel = FakeChannel(fail=RuntimeError("discord down"))
+        futures = [scheduler.enqueue(channel, embed(str(n)), key="h") for n in range(2)]
+        return await asyncio.gather(*futures, return_exceptions=True)
+
+    results = asyncio.run(run())
+    assert all(isinstance(result, RuntimeError) for result in results)
+
+
+def test_drain_waits_for_queued_embeds():
+    async def run():
+        scheduler = ThreadSendScheduler(window=0.05)
+        channel = FakeChannel()
+        scheduler.enqueue(channel, embed("a"))
+        left = await scheduler.drain(1)
+        return channel, left
+
+    channel, left = asyncio.run(run())
+    assert left == 0
+    assert channel.sent == [["a"]]
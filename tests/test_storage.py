@@ -0,0 +1,196 @@
+import os
+import json
+import asyncio
+import sqlite3
+import threading
+
+import pytest
+
+import storage
+
+
+def make_baseline_db(path: str):
+    """Schema creato dalla versione originale del bot (user_version 0), con dati."""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    conn = sqlite3.connect(path)
+    conn.execute("""
+        CREATE TABLE sessions (
+            user_id TEXT PRIMARY KEY,
+            uex_username TEXT NOT NULL,
+            session_data TEXT NOT NULL,
+            last_update TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+    conn.execute("""
+        CREATE TABLE negotiation_links (
+            negotiation_hash TEXT PRIMARY KEY,
+            buyer_id TEXT NOT NULL,
+            seller_id TEXT NOT NULL
+        )
+    """)
+    session = {"thread_id": 123, "username": "alice", "bearer_token": "bt", "secret_key": "sk", "lang": "it"}
+    conn.execute("INSERT INTO sessions (user_id, uex_username, session_data) VALUES (?, ?, ?)", ("1", "alice", json.dumps(session)))
+    conn.execute("INSERT INTO sessions (user_id, uex_username, session_data) VALUES (?, ?, ?)", ("2", "bob", "not json"))
+    conn.execute("INSERT INTO negotiation_links VALUES ('h1', '1', '2')")
+    conn.commit()
+    conn.close()
+
+
+def test_migrates_baseline_db_with_rows(db):
+    make_baseline_db(db)
+
+    async def run():
+        await storage.open_db()
+        try:
+            version = (await storage.fetchone("PRAGMA user_version"))[0]
+            session = await storage.get_user_session("1")
+            broken = await storage.get_user_session("2")
+            link = await storage.fetchone(storage.SQL_GET_LINK, ("h1",))
+        finally:
+            await storage.close_db()
+        return version, session, broken, link
+
+    version, session, broken, link = asyncio.run(run())
+    assert version == storage.SCHEMA_VERSION
+    assert session["thread_id"] == 123
+    assert session["username"] == "alice"
+    assert session["bearer_token"] == "bt"
+    assert session["secret_key"] == "sk"
+    assert session["lang"] == "it"
+    assert broken is not None and broken.get("thread_id") is None
+    assert tuple(link) == ("1", "2")
+
+
+def test_migration_is_idempotent(db):
+    make_baseline_db(db)
+
+    async def run():
+        for _ in range(2):
+            await storage.open_db()
+            await storage.close_db()
+
+    asyncio.run(run())
+    conn = sqlite3.connect(db)
+    assert conn.execute("PRAGMA user_version").fetchone()[0] == storage.SCHEMA_VERSION
+    assert conn.execute("SELECT COUNT(*) FROM sessions").fetchone()[0] == 2
+    conn.close()
+
+
+def test_failed_migration_closes_connections(db, monkeypatch):
+    make_baseline_db(db)
+
+    async def broken(conn):
+        raise RuntimeError("boom")
+
+    monkeypatch.setitem(storage.MIGRATIONS, 5, broken)
+    before = set(threading.enumerate())
+
+    async def run():
+        await storage.open_db()
+
+    with pytest.raises(RuntimeError):
+        asyncio.run(run())
+    assert storage._writer is None
+    # aiosqlite usa un thread per connessione: se ne restasse uno il processo non terminerebbe
+    for thread in set(threading.enumerate()) - before:
+        thread.join(timeout=2)
+        assert not thread.is_alive()
+    conn = sqlite3.connect(db)
+    assert conn.execute("PRAGMA user_version").fetchone()[0] == 4
+    conn.close()
+
+
+def test_ingress_open_requires_a_migrated_schema(db):
+    make_baseline_db(db)
+
+    async def run(migrate: bool):
+        await storage.open_db(migrate=migrate, readers=1)
+        await storage.close_db()
+
+    # Senza migrazioni un processo di ingresso non deve toccare uno schema vecchio
+    with pytest.raises(RuntimeError):
+        asyncio.run(run(False))
+    asyncio.run(run(True))
+    asyncio.run(run(False))
+    conn = sqlite3.connect(db)
+    assert conn.execute("PRAGMA user_version").fetchone()[0] == storage.SCHEMA_VERSION
+    conn.close()
+
+
+def test_negotiation_link_falls_back_to_db_when_index_misses(db):
+    async def run():
+        await storage.open_db()
+        try:
+            await storage.warm_routing_index()
+            # Link salvato da un altro processo: nel DB ma non nell'indice di questo
+            await storage.submit_write((storage.SQL_SAVE_LINK, ("h2", "buyer", "seller")))
+            assert storage.routing_index.link("h2") is None
+            link = await storage.get_negotiation_link("h2")
+            missing = await storage.get_negotiation_link("nope")
+        finally:
+            await storage.close_db()
+        return link, missing
+
+    link, missing = asyncio.run(run())
+    assert link == {"buyer_id": "buyer", "seller_id": "seller"}
+    assert storage.routing_index.link("h2") == link
+    assert missing is None
+
+
+def test_group_commit_isolates_failing_writes(db):
+    async def run():
+        await storage.open_db()
+        try:
+            ok = storage.submit_write((storage.SQL_SET_META, ("a", "1")))
+            # Stessa transazione di gruppo: l'errore annulla solo il suo savepoint
+            bad = storage.submit_write((storage.SQL_SET_META, ("b", "2")), ("INSERT INTO missing_table VALUES (1)", ()))
+            last = storage.submit_write((storage.SQL_SET_META, ("c", "3")))
+            results = await asyncio.gather(ok, bad, last, return_exceptions=True)
+            values = [await storage.get_meta(key) for key in ("a", "b", "c")]
+        finally:
+            await storage.close_db()
+        return results, values
+
+    results, values = asyncio.run(run())
+    assert [isinstance(result, Exception) for result in results] == [False, True, False]
+    assert values == ["1", None, "3"]
+    assert storage.write_stats["batches"] >= 1
+
+
+def test_cancelled_writer_rolls_back(db):
+    async def hold_writer(entered: asyncio.Event):
+        async with storage.writer() as conn:
+            await conn.execute(storage.SQL_SET_META, ("half", "1"))
+            entered.set()
+            await asyncio.sleep(10)
+
+    async def run():
+        await storage.open_db()
+        try:
+            entered = asyncio.Event()
+            task = asyncio.create_task(hold_writer(entered))
+            await entered.wait()
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+            # Il batch successivo apre una nuova transazione sulla stessa connessione
+            await storage.set_meta("after", "2")
+            return await storage.get_meta("half"), await storage.get_meta("after")
+        finally:
+            await storage.close_db()
+
+    assert asyncio.run(run()) == (None, "2")
+
+
+def test_failed_session_write_leaves_no_phantom_session(db, monkeypatch):
+    async def run():
+        await storage.open_db()
+        try:
+            await storage.warm_routing_index()
+            monkeypatch.setattr(storage, "SQL_SAVE_SESSION", "INSERT INTO missing_table VALUES (?, ?, ?, ?, ?, ?, ?, ?)")
+            with pytest.raises(Exception):
+                await storage.save_user_session("7", {"thread_id": 100, "username": "alice"})
+            return storage.routing_index.thread_for_user("7"), await storage.get_user_session("7")
+        finally:
+            await storage.close_db()
+
+    assert asyncio.run(run()) == (None, None)
@@ -0,0 +1,119 @@
+import asyncio
+
+import discord
+
+import storage
+from threads import ThreadResolver
+
+
+class FakeResponse:
+    def __init__(self, status: int):
+        self.status = status
+        self.reason = "error"
+
+
+class FakeClient:
+    """Nessun thread nella cache del gateway; fetch_channel trova solo i thread `alive` e nega `forbidden`."""
+
+    def __init__(self, alive=(), forbidden=(), delay: float = 0):
+        self.alive = set(alive)
+        self.forbidden = set(forbidden)
+        self.delay = delay
+        self.fetched: list[int] = []
+
+    def get_channel(self, thread_id):
+        return None
+
+    async def fetch_channel(self, thread_id):
+        self.fetched.append(thread_id)
+        await asyncio.sleep(self.delay)
+        if thread_id in self.forbidden:
+            raise discord.Forbidden(FakeResponse(403), "Missing Access")
+        if thread_id not in self.alive:
+            raise discord.NotFound(FakeResponse(404), "Unknown Channel")
+        return object()
+
+
+def make_resolver(client: FakeClient) -> ThreadResolver:
+    resolver = ThreadResolver(rate=1000, burst=10)
+    resolver.bind(client)
+    return resolver
+
+
+def test_fetched_thread_is_cached_and_fetched_once():
+    client = FakeClient(alive={100}, delay=0.05)
+    resolver = make_resolver(client)
+
+    async def run():
+        # Webhook contemporanei per lo stesso thread: una sola fetch
+        first = await asyncio.gather(*(resolver.resolve(100) for _ in range(3)))
+        return first, await resolver.resolve(100)
+
+    first, cached = asyncio.run(run())
+    assert client.fetched == [100]
+    assert all(thread is cached for thread in first)
+    assert resolver.stats["fetched"] == 1 and resolver.stats["cached"] == 1
+
+
+def test_uncached_lookup_does_not_fill_the_cache():
+    client = FakeClient(alive={100})
+    resolver = make_resolver(client)
+
+    async def run():
+        await resolver.resolve(100, cache=False)
+        await resolver.resolve(100, cache=False)
+
+    asyncio.run(run())
+    assert client.fetched == [100, 100]
+
+
+def test_deleted_thread_is_cached_as_missing_and_its_sessions_removed(db):
+    client = FakeClient()
+    resolver = make_resolver(client)
+
+    async def run():
+        await storage.open_db()
+        try:
+            await storage.save_user_session("7", {"thread_id": 100, "guild_id": 1, "username": "alice"})
+            results = [await resolver.resolve(100), await resolver.resolve(100)]
+            return results, await storage.fetchall("SELECT user_id FROM sessions")
+        finally:
+            await storage.close_db()
+
+    results, sessions = asyncio.run(run())
+    assert results == [None, None]
+    assert client.fetched == [100]
+    assert resolver.stats["missing"] == 1 and resolver.stats["negative"] == 1
+    assert sessions == []
+
+
+def test_forbidden_thread_is_cached_as_missing_but_keeps_its_sessions(db):
+    client = FakeClient(forbidden={100})
+    resolver = make_resolver(client)
+
+    async def run():
+        await storage.open_db()
+        try:
+            await storage.save_user_session("7", {"thread_id": 100, "guild_id": 1, "username": "alice"})
+            results = [await resolver.resolve(100), await resolver.resolve(100)]
+            return results, await storage.fetchall("SELECT user_id FROM sessions")
+        finally:
+            await storage.close_db()
+
+    results, sessions = asyncio.run(run())
+    assert results == [None, None]
+    assert client.fetched == [100]
+    assert sessions == [("7",)]
+
+
+def test_forget_turns_a_cached_thread_into_a_miss():
+    client = FakeClient(alive={100})
+    resolver = make_resolver(client)
+
+    async def run():
+        assert await resolver.resolve(100) is not None
+        resolver.forget(100)
+        return await resolver.resolve(100)
+
+    assert asyncio.run(run()) is None
+    assert client.fetched == [100]
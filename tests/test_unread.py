@@ -0,0 +1,28 @@
+from collections import deque
+
+from unread import UnreadIndicator
+
+
+def test_history_older_than_the_window_is_dropped():
+    indicator = UnreadIndicator(renames=2, window=600)
+    indicator._history = {1: deque([0.0, 100.0]), 2: deque([0.0, 650.0]), 3: deque([150.0])}
+    indicator._prune(800.0)
+    # Il thread 2 ha un rename negli ultimi 10 minuti: il suo budget conta ancora
+    assert set(indicator._history) == {2}
+
+
+def test_free_slot_drops_an_emptied_history():
+    indicator = UnreadIndicator(renames=2, window=600)
+    indicator._history = {1: deque([0.0, 100.0]), 2: deque([0.0, 100.0])}
+    assert indicator._next_slot(1, now=700.0) == 700.0
+    assert indicator._next_slot(2, now=300.0) == 600.0
+    assert set(indicator._history) == {2}
+
+
+def test_deleted_thread_leaves_no_state():
+    indicator = UnreadIndicator()
+    indicator._history[1] = deque([0.0])
+    indicator._desired[1] = True
+    indicator._due[1] = 0.0
+    indicator.discard(1)
+    assert not indicator._history and not indicator._desired and not indicator._due
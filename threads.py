@@ -0,0 +1,117 @@
+import asyncio
+import logging
+
+import discord
+
+import storage
+from cache import TTLCache
+from ratelimit import TokenBucket
+from metrics import THREAD_LOOKUPS
+from config import THREAD_CACHE_SIZE, THREAD_CACHE_TTL, THREAD_MISSING_TTL, THREAD_FETCH_RATE, THREAD_FETCH_BURST
+
+
+# ---------- Risoluzione thread ----------
+class ThreadResolver:
+    """
+    thread_id → thread: prima la cache del gateway, poi una cache TTL dei thread letti
+    via REST, infine `fetch_channel` limitato da un token bucket (una sola richiesta
+    per thread anche con più webhook contemporanei). I thread archiviati vengono
+    riaperti; quelli che Discord non conosce più finiscono in una cache negativa e le
+    loro sessioni vengono rimosse.
+    """
+
+    def __init__(self, size: int = THREAD_CACHE_SIZE, ttl: float = THREAD_CACHE_TTL,
+                 missing_ttl: float = THREAD_MISSING_TTL, rate: float = THREAD_FETCH_RATE, burst: int = THREAD_FETCH_BURST):
+        self.client: discord.Client | None = None
+        self._found = TTLCache(maxsize=size, ttl=ttl)
+        self._missing = TTLCache(maxsize=size, ttl=missing_ttl)
+        self._bucket = TokenBucket(rate, burst)
+        self._inflight: dict[int, asyncio.Task] = {}
+        self.stats = {"gateway": 0, "cached": 0, "fetched": 0, "missing": 0, "negative": 0, "unarchived": 0}
+
+    def bind(self, client: discord.Client):
+        self.client = client
+
+    async def resolve(self, thread_id: int, unarchive: bool = True, cache: bool = True):
+        """
+        Restituisce il thread o None se non esiste più / non è accessibile. Gli altri errori HTTP
+        risalgono. Con cache=False un thread letto via REST non entra nella cache (controlli a tappeto).
+        """
+        thread_id = int(thread_id)
+        if thread_id in self._missing:
+            self._count("negative")
+            return None
+
+        thread = self.client.get_channel(thread_id)
+        if thread is not None:
+            self._count("gateway")
+        else:
+            thread = self._found.get(thread_id)
+            if thread is not None:
+                self._count("cached")
+            else:
+                thread = await self._fetch_once(thread_id, cache)
+                if thread is None:
+                    return None
+
+        if unarchive and isinstance(thread, discord.Thread) and thread.archived:
+            thread = await self._unarchive(thread)
+        return thread
+
+    def remember(self, thread: discord.Thread):
+        """Aggiorna la copia in cache (rename, archiviazione) se il thread era stato letto via REST."""
+        if thread.id in self._found:
+            self._found.set(thread.id, thread)
+
+    def forget(self, thread_id: int):
+        self._found.pop(int(thread_id))
+        self._missing.set(int(thread_id), True)
+
+    def _count(self, outcome: str):
+        self.stats[outcome] += 1
+        THREAD_LOOKUPS.inc(outcome=outcome)
+
+    async def _fetch_once(self, thread_id: int, cache: bool):
+        task = self._inflight.get(thread_id)
+        if task is None:
+            task = self._inflight[thread_id] = asyncio.create_task(self._fetch(thread_id, cache))
+            task.add_done_callback(lambda _: self._inflight.pop(thread_id, None))
+        return await asyncio.shield(task)
+
+    async def _fetch(self, thread_id: int, cache: bool):
+        await self._bucket.acquire()
+        try:
+            thread = await self.client.fetch_channel(thread_id)
+        except discord.NotFound:
+            self._count("missing")
+            self.forget(thread_id)
+            users = await storage.remove_sessions_by_thread(thread_id)
+            logging.warning(f"🗑️ Thread {thread_id} non esiste più → rimosse sessioni per {len(users)} utenti")
+            return None
+        except discord.Forbidden:
+            # Accesso perso (bot rimosso dal server o dal thread): non si riprova per un po', le sessioni restano
+            self._count("missing")
+            self._missing.set(thread_id, True)
+            logging.warning(f"⚠️ Accesso negato al thread {thread_id}")
+            return None
+
+        self._count("fetched")
+        if cache:
+            self._found.set(thread_id, thread)
+        return thread
+
+    async def _unarchive(self, thread: discord.Thread) -> discord.Thread:
+        if thread.locked:
+            return thread
+        try:
+            thread = await thread.edit(archived=False) or thread
+            self.stats["unarchived"] += 1
+            logging.info(f"📂 Thread {thread.id} riaperto")
+        except discord.HTTPException as e:
+            # L'invio può comunque riuscire: Discord riapre da sé i thread non bloccati
+            logging.warning(f"⚠️ Impossibile riaprire il thread {thread.id}: {e}")
+        self.remember(thread)
+        return thread
+
+
+resolver = ThreadResolver()
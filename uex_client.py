@@ -0,0 +1,195 @@
+import time
+import asyncio
+import logging
+
+import aiohttp
+
+import directory
+from cache import TTLCache
+from retry import backoff_delay
+from ratelimit import TokenBucket
+from metrics import UEX_API_LATENCY, UEX_API_REQUESTS
+from config import (
+    UEX_POOL_SIZE, UEX_DNS_CACHE_TTL,
+    UEX_TIMEOUT_GET_USER, UEX_TIMEOUT_POST_MESSAGE, UEX_TIMEOUT_NOTIFICATIONS,
+    UEX_MAX_RETRIES, UEX_RETRY_BASE, UEX_RETRY_MAX,
+    UEX_USER_RATE, UEX_USER_BURST, UEX_BREAKER_THRESHOLD, UEX_BREAKER_RESET,
+)
+
+
+class CircuitOpenError(Exception):
+    """UEX è considerata degradata: la richiesta fallisce subito senza toccare la rete."""
+
+
+# ---------- Circuit breaker ----------
+class CircuitBreaker:
+    """
+    Dopo `threshold` errori consecutivi il circuito si apre e per `reset_timeout`
+    secondi ogni richiesta fallisce subito; poi passa una sola richiesta di prova.
+    """
+
+    def __init__(self, threshold: int, reset_timeout: float):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at: float | None = None
+        self._probe_started: float | None = None
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at >= self.reset_timeout:
+            return "half-open"
+        return "open"
+
+    def allow(self) -> bool:
+        state = self.state
+        if state == "closed":
+            return True
+        if state == "half-open":
+            # Una sola richiesta di prova alla volta; se si perde (es. task cancellato) ne passa un'altra dopo reset_timeout
+            now = time.monotonic()
+            if self._probe_started is None or now - self._probe_started >= self.reset_timeout:
+                self._probe_started = now
+                return True
+        return False
+
+    def record_success(self):
+        self.failures = 0
+        self.opened_at = None
+        self._probe_started = None
+
+    def record_failure(self):
+        self.failures += 1
+        self._probe_started = None
+        if self.opened_at is not None or self.failures >= self.threshold:
+            if self.opened_at is None:
+                logging.warning(f"🔌 Circuito UEX aperto dopo {self.failures} errori consecutivi")
+            self.opened_at = time.monotonic()
+
+
+# ---------- Client UEX ----------
+class UexClient:
+    """
+    Client condiviso per le API UEX: un solo connector con keep-alive e cache DNS,
+    timeout per endpoint, retry con backoff per le chiamate idempotenti,
+    token bucket per utente e circuit breaker.
+    """
+
+    def __init__(self):
+        self._session: aiohttp.ClientSession | None = None
+        self._buckets = TTLCache(maxsize=10000, ttl=3600)
+        self.breaker = CircuitBreaker(UEX_BREAKER_THRESHOLD, UEX_BREAKER_RESET)
+        self.stats = {"requests": 0, "errors": 0, "retries": 0, "rejected": 0}
+
+    async def start(self):
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=UEX_POOL_SIZE,
+                ttl_dns_cache=UEX_DNS_CACHE_TTL,
+                keepalive_timeout=30,
+            )
+            self._session = aiohttp.ClientSession(connector=connector)
+            logging.info("🌐 Client UEX inizializzato")
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    def _bucket(self, user_key: str) -> TokenBucket:
+        bucket = self._buckets.get(user_key)
+        if bucket is None:
+            bucket = TokenBucket(UEX_USER_RATE, UEX_USER_BURST)
+            self._buckets.set(user_key, bucket)
+        return bucket
+
+    @staticmethod
+    def _headers(bearer_token: str, secret_key: str | None) -> dict:
+        headers = {
+            "Authorization": f"Bearer {bearer_token}",
+            "Content-Type": "application/json",
+        }
+        if secret_key:
+            headers["secret-key"] = secret_key
+        return headers
+
+    async def _request(self, method: str, url: str, *, endpoint: str, user_key: str, headers: dict,
+                       timeout: float, idempotent: bool, **kwargs) -> tuple[int, str]:
+        """Restituisce (status, testo). Solleva CircuitOpenError o l'ultimo errore di rete."""
+        await self.start()
+        await self._bucket(user_key).acquire()
+
+        attempts = 1 + (UEX_MAX_RETRIES if idempotent else 0)
+        for attempt in range(1, attempts + 1):
+            if not self.breaker.allow():
+                self.stats["rejected"] += 1
+                UEX_API_REQUESTS.inc(endpoint=endpoint, outcome="rejected")
+                raise CircuitOpenError("UEX temporaneamente non disponibile")
+
+            self.stats["requests"] += 1
+            retry_after = None
+            try:
+                with UEX_API_LATENCY.time(endpoint=endpoint):
+                    async with self._session.request(
+                        method, url, headers=headers, timeout=aiohttp.ClientTimeout(total=timeout), **kwargs
+                    ) as resp:
+                        text = await resp.text()
+                    UEX_API_REQUESTS.inc(endpoint=endpoint, outcome=f"{resp.status // 100}xx")
+                # Un 429 indica che UEX risponde: limita, ma non apre il circuito
+                if resp.status >= 500:
+                    self.breaker.record_failure()
+                else:
+                    self.breaker.record_success()
+                if resp.status < 500 and resp.status != 429:
+                    return resp.status, text
+                error = RuntimeError(f"UEX {resp.status}: {text[:200]}")
+                retry_after = resp.headers.get("Retry-After")
+                if attempt == attempts:
+                    self.stats["errors"] += 1
+                    return resp.status, text
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                UEX_API_REQUESTS.inc(endpoint=endpoint, outcome="error")
+                self.breaker.record_failure()
+                error = e
+                if attempt == attempts:
+                    self.stats["errors"] += 1
+                    raise
+
+            self.stats["retries"] += 1
+            delay = backoff_delay(attempt, UEX_RETRY_BASE, UEX_RETRY_MAX)
+            if retry_after and retry_after.isdigit():
+                delay = max(delay, float(retry_after))
+            logging.warning(f"🔁 {method} {url} fallita ({error}), nuovo tentativo tra {delay:.1f}s")
+            await asyncio.sleep(delay)
+
+    # ---------- Endpoint ----------
+    async def get_user(self, user_key: str, bearer_token: str, secret_key: str | None, username: str | None = None) -> tuple[int, str]:
+        # Con la secret key l'utente è identificato dagli header, altrimenti si usa ?username=
+        params = None if secret_key else {"username": username}
+        return await self._request(
+            "GET", directory.API_GET_USER, endpoint="user", user_key=user_key, headers=self._headers(bearer_token, secret_key),
+            timeout=UEX_TIMEOUT_GET_USER, idempotent=True, params=params
+        )
+
+    async def post_message(self, user_key: str, bearer_token: str, secret_key: str, negotiation_hash: str, message: str) -> tuple[int, str]:
+        payload = {
+            "is_production": 1,
+            "hash": negotiation_hash,
+            "message": message
+        }
+        # POST non idempotente: nessun retry automatico, un doppio invio duplicherebbe il messaggio
+        return await self._request(
+            "POST", directory.API_POST_MESSAGE, endpoint="message", user_key=user_key, headers=self._headers(bearer_token, secret_key),
+            timeout=UEX_TIMEOUT_POST_MESSAGE, idempotent=False, json=payload
+        )
+
+    async def get_notifications(self, user_key: str, bearer_token: str, secret_key: str) -> tuple[int, str]:
+        return await self._request(
+            "GET", directory.API_NOTIFICATIONS, endpoint="notifications", user_key=user_key, headers=self._headers(bearer_token, secret_key),
+            timeout=UEX_TIMEOUT_NOTIFICATIONS, idempotent=True
+        )
+
+
+client = UexClient()
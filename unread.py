@@ -0,0 +1,168 @@
+import time
+import asyncio
+import logging
+from collections import deque
+
+import discord
+
+from config import UNREAD_RENAMES_PER_WINDOW, UNREAD_RENAME_WINDOW
+
+
+# ---------- Indicatore non letti ----------
+MARKER = " 🟩"
+MAX_THREAD_NAME = 100
+
+
+class UnreadIndicator:
+    """
+    Tiene in memoria lo stato desiderato del marker 🟩 per thread e applica i rename
+    in background, entro il budget di Discord (~2 rename ogni 10 minuti per canale).
+    Più toggle arrivati prima del rename si riducono all'ultimo stato: se coincide con
+    il nome attuale non parte nessuna chiamata.
+    """
+
+    def __init__(self, renames: int = UNREAD_RENAMES_PER_WINDOW, window: float = UNREAD_RENAME_WINDOW):
+        self.renames = renames
+        self.window = window
+        self.stats = {"renames": 0, "coalesced": 0, "deferred": 0, "errors": 0}
+        self._desired: dict[int, bool] = {}
+        self._threads: dict[int, discord.Thread] = {}
+        self._history: dict[int, deque] = {}      # istanti degli ultimi rename per thread
+        self._pruned_at = 0.0                     # ultima pulizia di _history
+        self._due: dict[int, float] = {}          # thread_id → quando riprovare
+        self._inflight: set[int] = set()
+        self._wake: asyncio.Event | None = None
+        self._task: asyncio.Task | None = None
+
+    def start(self):
+        if self._task is None:
+            self._wake = asyncio.Event()
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    def mark(self, thread: discord.Thread):
+        self._set(thread, True)
+
+    def clear(self, thread: discord.Thread):
+        self._set(thread, False)
+
+    def discard(self, thread_id: int):
+        """Thread eliminato: non serve più nessuno stato, nemmeno lo storico dei rename."""
+        self._forget(thread_id)
+        self._history.pop(thread_id, None)
+
+    def pending(self) -> int:
+        return len(self._due) + len(self._inflight)
+
+    @staticmethod
+    def is_marked(thread: discord.Thread) -> bool:
+        return thread.name.endswith(MARKER)
+
+    def _set(self, thread: discord.Thread, unread: bool):
+        self._threads[thread.id] = thread
+        if thread.id in self._desired:
+            if self._desired[thread.id] != unread:
+                self.stats["coalesced"] += 1
+            self._desired[thread.id] = unread
+        elif self.is_marked(thread) != unread:
+            self._desired[thread.id] = unread
+            self._schedule(thread.id)
+        else:
+            self._threads.pop(thread.id, None)
+
+    def _schedule(self, thread_id: int):
+        if thread_id in self._inflight:
+            return
+        self._due[thread_id] = self._next_slot(thread_id)
+        if self._wake is not None:
+            self._wake.set()
+
+    def _next_slot(self, thread_id: int, now: float | None = None) -> float:
+        now = time.monotonic() if now is None else now
+        history = self._history.get(thread_id)
+        if not history:
+            return now
+        while history and now - history[0] >= self.window:
+            history.popleft()
+        if not history:
+            del self._history[thread_id]
+            return now
+        if len(history) < self.renames:
+            return now
+        return history[0] + self.window
+
+    def _forget(self, thread_id: int):
+        self._desired.pop(thread_id, None)
+        self._threads.pop(thread_id, None)
+        self._due.pop(thread_id, None)
+
+    def _prune(self, now: float):
+        # Lo storico di un thread serve solo finché il suo ultimo rename è dentro la finestra
+        self._pruned_at = now
+        for thread_id in [tid for tid, history in self._history.items() if now - history[-1] >= self.window]:
+            del self._history[thread_id]
+
+    async def _run(self):
+        while True:
+            self._wake.clear()
+            now = time.monotonic()
+            if now - self._pruned_at >= self.window:
+                self._prune(now)
+            for thread_id in [tid for tid, at in self._due.items() if at <= now]:
+                self._apply(thread_id, now)
+
+            timeout = max(0.0, min(self._due.values()) - time.monotonic()) if self._due else None
+            try:
+                await asyncio.wait_for(self._wake.wait(), timeout=timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    def _apply(self, thread_id: int, now: float):
+        self._due.pop(thread_id, None)
+        thread = self._threads.get(thread_id)
+        if thread is None or self._desired.get(thread_id) == self.is_marked(thread):
+            self._forget(thread_id)
+            return
+
+        slot = self._next_slot(thread_id, now)
+        if slot > now:
+            self.stats["deferred"] += 1
+            self._due[thread_id] = slot
+            return
+
+        # Ogni rename è un task a sé: se discord.py dorme su un 429 non blocca gli altri thread
+        self._history.setdefault(thread_id, deque()).append(now)
+        self._inflight.add(thread_id)
+        asyncio.create_task(self._rename(thread, self._desired[thread_id]))
+
+    async def _rename(self, thread: discord.Thread, unread: bool):
+        base = thread.name.removesuffix(MARKER)
+        name = base[:MAX_THREAD_NAME - len(MARKER)] + MARKER if unread else base
+        try:
+            thread = await thread.edit(name=name) or thread
+            self.stats["renames"] += 1
+            logging.info(f"🟩 Indicatore {'aggiunto' if unread else 'rimosso'} sul thread {thread.id}")
+        except (discord.NotFound, discord.Forbidden) as e:
+            self._inflight.discard(thread.id)
+            self.discard(thread.id)
+            logging.warning(f"⚠️ Impossibile aggiornare nome thread {thread.id}: {e}")
+            return
+        except Exception as e:
+            self.stats["errors"] += 1
+            logging.warning(f"⚠️ Impossibile aggiornare nome thread {thread.id}: {e}")
+
+        self._inflight.discard(thread.id)
+        self._threads[thread.id] = thread
+        # Lo stato può essere cambiato durante il rename: si riprova al prossimo slot libero
+        if thread.id in self._desired and self._desired[thread.id] != self.is_marked(thread):
+            self._schedule(thread.id)
+        else:
+            self._forget(thread.id)
+
+
+indicator = UnreadIndicator()